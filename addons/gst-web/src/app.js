@@ -639,7 +639,7 @@ window.addEventListener('focus', () => {
     // Send clipboard contents.
     navigator.clipboard.readText()
         .then(text => {
-            webrtc.sendDataChannelMessage("cw," + stringToBase64(text))
+            webrtc.sendClipboard(text);
         })
         .catch(err => {
             webrtc._setStatus('Failed to read clipboard contents: ' + err);
@@ -669,6 +669,8 @@ webrtc.oncursorchange = (handle, curdata, hotspot, override) => {
         return;
     }
     if (!webrtc.cursor_cache.has(handle)) {
+        // The server only sends the handle of images it has sent on this connection.
+        if (!curdata) return;
         // Add cursor to cache.
         const cursor_url = "url('data:image/png;base64," + curdata + "')";
         webrtc.cursor_cache.set(handle, cursor_url);
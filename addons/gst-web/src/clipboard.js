@@ -0,0 +1,297 @@
+/* This Source Code Form is subject to the terms of the Mozilla Public
+ * License, v. 2.0. If a copy of the MPL was not distributed with this
+ * file, You can obtain one at https://mozilla.org/MPL/2.0/.
+ */
+
+/*eslint no-unused-vars: ["error", { "vars": "local" }]*/
+
+// Clipboard transfer protocol on the "clipboard" data channel, must match
+// clipboard_transfer.py. Transfers are a clipboard_start JSON message, binary
+// chunks of <u32 id><encoded bytes> and a clipboard_end JSON message.
+const CLIPBOARD_CHANNEL_LABEL = "clipboard";
+const CLIPBOARD_CHUNK_SIZE = 16 * 1024;
+const CLIPBOARD_COMPRESS_MIN_BYTES = 1024;
+const CLIPBOARD_MAX_BYTES = 16 * 1024 * 1024;
+const CLIPBOARD_CHUNK_HEADER_SIZE = 4;
+// Chunks wait while more is queued on the channel, onbufferedamountlow fires
+// once the queue drains below the low threshold.
+const CLIPBOARD_MAX_BUFFERED = 256 * 1024;
+const CLIPBOARD_BUFFERED_AMOUNT_LOW = 64 * 1024;
+const CLIPBOARD_SEND_TIMEOUT_MS = 10000;
+
+class ClipboardTransfer {
+    /**
+     * Chunked clipboard transfers on a dedicated data channel
+     *
+     * @constructor
+     * @param {RTCDataChannel} [channel]
+     *    The clipboard data channel.
+     */
+    constructor(channel) {
+        /**
+         * @type {RTCDataChannel}
+         */
+        this.channel = channel;
+        this.channel.binaryType = "arraybuffer";
+        this.channel.bufferedAmountLowThreshold = CLIPBOARD_BUFFERED_AMOUNT_LOW;
+
+        /**
+         * Encodings the server accepts.
+         * @type {Array}
+         */
+        this.peerEncodings = ["identity"];
+
+        /**
+         * Digest of the contents both peers have, unchanged contents are not resent.
+         * @type {String}
+         */
+        this.lastDigest = null;
+
+        /**
+         * @type {Integer}
+         */
+        this.nextId = 1;
+
+        /**
+         * Transfer being sent, an older transfer stops when a newer one starts.
+         * @type {Integer}
+         */
+        this.sendingId = null;
+
+        /**
+         * Transfer being received.
+         * @type {Object}
+         */
+        this.incoming = null;
+
+        /**
+         * @type {function}
+         */
+        this.oncontent = null;
+
+        /**
+         * @type {function}
+         */
+        this.ondebug = null;
+
+        this.channel.onmessage = this._onMessage.bind(this);
+    }
+
+    /**
+     * Encodings this browser can decode, deflate needs the Compression Streams API.
+     */
+    static encodings() {
+        var encodings = ["identity"];
+        if (typeof CompressionStream !== 'undefined' && typeof DecompressionStream !== 'undefined') {
+            encodings.push("deflate");
+        }
+        return encodings;
+    }
+
+    /**
+     * Greets the server, call when the channel opens.
+     */
+    start() {
+        this.peerEncodings = ["identity"];
+        this.lastDigest = null;
+        this.incoming = null;
+        this._sendMessage("clipboard_hello", {"encodings": ClipboardTransfer.encodings()});
+    }
+
+    isOpen() {
+        return this.channel.readyState === 'open';
+    }
+
+    /**
+     * Sends clipboard contents to the server.
+     *
+     * @param {String} text
+     */
+    async send(text) {
+        var raw = new TextEncoder().encode(text);
+        if (raw.length > CLIPBOARD_MAX_BYTES) {
+            this._debug("not sending clipboard contents larger than " + CLIPBOARD_MAX_BYTES + " bytes");
+            return;
+        }
+        var digest = await ClipboardTransfer._digest(raw);
+        if (digest !== null && digest === this.lastDigest) {
+            return;
+        }
+        this.lastDigest = digest;
+
+        var encoding = "identity";
+        var payload = raw;
+        if (this.peerEncodings.includes("deflate") && ClipboardTransfer.encodings().includes("deflate") && raw.length >= CLIPBOARD_COMPRESS_MIN_BYTES) {
+            var compressed = await ClipboardTransfer._transform(raw, new CompressionStream("deflate"));
+            if (compressed.length < raw.length) {
+                encoding = "deflate";
+                payload = compressed;
+            }
+        }
+        if (!this.isOpen()) return;
+
+        var id = this.nextId;
+        this.nextId = (this.nextId % 0xffffffff) + 1;
+        this.sendingId = id;
+        this._sendMessage("clipboard_start", {
+            "id": id,
+            "size": raw.length,
+            "length": payload.length,
+            "encoding": encoding,
+            "sha256": digest
+        });
+        for (var offset = 0; offset < payload.length; offset += CLIPBOARD_CHUNK_SIZE) {
+            if (!(await this._waitWritable()) || this.sendingId !== id) {
+                this._debug("abandoning clipboard transfer " + id + ", the channel is closed, not draining or a newer transfer started");
+                // The server did not get these contents.
+                if (this.lastDigest === digest) this.lastDigest = null;
+                return;
+            }
+            var chunk = payload.subarray(offset, offset + CLIPBOARD_CHUNK_SIZE);
+            var frame = new Uint8Array(CLIPBOARD_CHUNK_HEADER_SIZE + chunk.length);
+            new DataView(frame.buffer).setUint32(0, id, true);
+            frame.set(chunk, CLIPBOARD_CHUNK_HEADER_SIZE);
+            this.channel.send(frame.buffer);
+        }
+        this._sendMessage("clipboard_end", {"id": id});
+        this._debug("sent clipboard contents, length: " + raw.length + ", encoded length: " + payload.length);
+    }
+
+    /**
+     * Waits until the channel queue is short, so a large paste does not fill
+     * the send buffer or hold back messages on other channels.
+     */
+    async _waitWritable() {
+        var deadline = Date.now() + CLIPBOARD_SEND_TIMEOUT_MS;
+        while (this.isOpen() && this.channel.bufferedAmount > CLIPBOARD_MAX_BUFFERED) {
+            var remaining = deadline - Date.now();
+            if (remaining <= 0) return false;
+            await new Promise((resolve) => {
+                var timer = setTimeout(done, Math.min(remaining, 1000));
+                var channel = this.channel;
+                function done() {
+                    clearTimeout(timer);
+                    channel.removeEventListener("bufferedamountlow", done);
+                    resolve();
+                }
+                channel.addEventListener("bufferedamountlow", done);
+            });
+        }
+        return this.isOpen();
+    }
+
+    /**
+     * Handles messages from the clipboard channel.
+     *
+     * @param {MessageEvent} event
+     */
+    _onMessage(event) {
+        if (event.data instanceof ArrayBuffer) {
+            this._onChunk(event.data);
+            return;
+        }
+
+        var msg;
+        try {
+            msg = JSON.parse(event.data);
+        } catch (e) {
+            this._debug("failed to parse clipboard message: " + event.data);
+            return;
+        }
+
+        if (msg.type === "clipboard_hello") {
+            this.peerEncodings = msg.data.encodings || ["identity"];
+        } else if (msg.type === "clipboard_start") {
+            var header = msg.data;
+            if (header.size > CLIPBOARD_MAX_BYTES || header.length > CLIPBOARD_MAX_BYTES) {
+                this._debug("rejecting clipboard transfer larger than " + CLIPBOARD_MAX_BYTES + " bytes");
+                this.incoming = null;
+                return;
+            }
+            this.incoming = {
+                header: header,
+                data: new Uint8Array(header.length),
+                received: 0
+            };
+        } else if (msg.type === "clipboard_end") {
+            var incoming = this.incoming;
+            this.incoming = null;
+            if (incoming === null || incoming.header.id !== msg.data.id) return;
+            this._finish(incoming).catch((err) => {
+                this._debug("discarding clipboard transfer " + incoming.header.id + ": " + err);
+            });
+        }
+    }
+
+    _onChunk(buffer) {
+        if (this.incoming === null || buffer.byteLength < CLIPBOARD_CHUNK_HEADER_SIZE) return;
+        var id = new DataView(buffer).getUint32(0, true);
+        if (id !== this.incoming.header.id) return;
+        var chunk = new Uint8Array(buffer, CLIPBOARD_CHUNK_HEADER_SIZE);
+        if (this.incoming.received + chunk.length > this.incoming.data.length) {
+            this._debug("clipboard transfer " + id + " exceeds its announced length, discarding");
+            this.incoming = null;
+            return;
+        }
+        this.incoming.data.set(chunk, this.incoming.received);
+        this.incoming.received += chunk.length;
+    }
+
+    async _finish(incoming) {
+        var header = incoming.header;
+        if (incoming.received !== header.length) {
+            throw new Error("received " + incoming.received + " of " + header.length + " bytes");
+        }
+        var raw = incoming.data;
+        if (header.encoding === "deflate") {
+            raw = await ClipboardTransfer._transform(raw, new DecompressionStream("deflate"));
+        } else if (header.encoding !== "identity") {
+            throw new Error("unsupported encoding " + header.encoding);
+        }
+        if (raw.length !== header.size) {
+            throw new Error("decoded " + raw.length + " of " + header.size + " bytes");
+        }
+        var digest = await ClipboardTransfer._digest(raw);
+        if (digest !== null && header.sha256 && digest !== header.sha256) {
+            throw new Error("digest mismatch");
+        }
+        // The server has these contents, do not send them back.
+        this.lastDigest = header.sha256 || digest;
+        this._debug("received clipboard contents, length: " + raw.length);
+        if (this.oncontent !== null) {
+            this.oncontent(new TextDecoder().decode(raw));
+        }
+    }
+
+    _sendMessage(type, data) {
+        if (this.isOpen()) {
+            this.channel.send(JSON.stringify({"type": type, "data": data}));
+        }
+    }
+
+    _debug(message) {
+        if (this.ondebug !== null) this.ondebug(message);
+    }
+
+    /**
+     * Hex SHA-256 digest, null where SubtleCrypto is unavailable (insecure contexts).
+     *
+     * @param {Uint8Array} data
+     */
+    static async _digest(data) {
+        if (typeof crypto === 'undefined' || !crypto.subtle) return null;
+        var hash = new Uint8Array(await crypto.subtle.digest("SHA-256", data));
+        return Array.from(hash, (b) => b.toString(16).padStart(2, "0")).join("");
+    }
+
+    /**
+     * Runs bytes through a CompressionStream or DecompressionStream.
+     *
+     * @param {Uint8Array} data
+     * @param {TransformStream} transform
+     */
+    static async _transform(data, transform) {
+        var stream = new Blob([data]).stream().pipeThrough(transform);
+        return new Uint8Array(await new Response(stream).arrayBuffer());
+    }
+}
@@ -23,6 +23,16 @@
 /*global GamepadManager*/
 /*eslint no-unused-vars: ["error", { "vars": "local" }]*/
 
+// Binary input protocol, frames are <u8 version><u8 type><payload> with
+// little-endian payloads, must match INPUT_FRAME_* in webrtc_input.py.
+// Version 2 adds binary cursor frames from the server, see DATA_FRAME_* in webrtc.js.
+const INPUT_PROTOCOL_VERSION = 2;
+const INPUT_FRAME_MOUSE = 1;
+const INPUT_FRAME_KEY = 2;
+const INPUT_FRAME_GAMEPAD_BUTTON = 3;
+const INPUT_FRAME_GAMEPAD_AXIS = 4;
+const INPUT_MOUSE_FLAG_RELATIVE = 0x01;
+
 class Input {
     /**
      * Input handling for WebRTC web application
@@ -49,6 +59,18 @@ class Input {
          */
         this.mouseRelative = false;
 
+        /**
+         * Binary input protocol version accepted from the server, 0 to send CSV.
+         * @type {Integer}
+         */
+        this.inputProtocol = 0;
+
+        /**
+         * Append the client send time to binary input frames, requested by the server.
+         * @type {boolean}
+         */
+        this.inputTimestamps = false;
+
         /**
          * @type {Object}
          */
@@ -221,15 +243,7 @@ class Input {
             }
         }
 
-        var toks = [
-            mtype,
-            this.x,
-            this.y,
-            this.buttonMask,
-            0
-        ];
-
-        this.send(toks.join(","));
+        this._sendMouse(mtype, this.x, this.y, this.buttonMask, 0);
 
         event.preventDefault();
     }
@@ -253,15 +267,47 @@ class Input {
         this.x = this._clientToServerX(event.changedTouches[0].clientX);
         this.y = this._clientToServerY(event.changedTouches[0].clientY);
 
-        var toks = [
-            mtype,
-            this.x,
-            this.y,
-            this.buttonMask,
-            0
-        ];
+        this._sendMouse(mtype, this.x, this.y, this.buttonMask, 0);
+    }
 
-        this.send(toks.join(","));
+    /**
+     * Sends a mouse event, as a binary frame when the server negotiated it.
+     *
+     * @param {String} mtype - "m" for absolute or "m2" for relative motion
+     * @param {number} x
+     * @param {number} y
+     * @param {number} mask - button mask
+     * @param {number} magnitude - scroll magnitude
+     */
+    _sendMouse(mtype, x, y, mask, magnitude) {
+        if (this.inputProtocol === INPUT_PROTOCOL_VERSION) {
+            var view = this._newFrame(INPUT_FRAME_MOUSE, 11);
+            view.setUint8(2, mtype === "m2" ? INPUT_MOUSE_FLAG_RELATIVE : 0);
+            view.setInt32(3, x, true);
+            view.setInt32(7, y, true);
+            view.setUint8(11, mask);
+            view.setUint8(12, magnitude);
+            this.send(this._finishFrame(view, 13));
+        } else {
+            this.send([mtype, x, y, mask, magnitude].join(","));
+        }
+    }
+
+    /**
+     * Sends a key event, as a binary frame when the server negotiated it.
+     *
+     * @param {boolean} down
+     * @param {number} keysym
+     */
+    _sendKey(down, keysym) {
+        if (this.inputProtocol === INPUT_PROTOCOL_VERSION) {
+            var view = this._newFrame(INPUT_FRAME_KEY, 5);
+            view.setUint8(2, down ? 1 : 0);
+            view.setUint32(3, keysym, true);
+            this.send(this._finishFrame(view, 7));
+        } else {
+            this.send((down ? "kd," : "ku,") + keysym);
+        }
     }
 
     /**
@@ -348,21 +394,13 @@ class Input {
         var magnitude = Math.min(deltaY, this._scrollMagnitude);
 
         var mask = 1 << button;
-        var toks;
         // Simulate button press and release.
         for (var i = 0; i < 2; i++) {
             if (i === 0)
                 this.buttonMask |= mask;
             else
                 this.buttonMask &= ~mask;
-            toks = [
-                mtype,
-                this.x,
-                this.y,
-                this.buttonMask,
-                magnitude
-            ];
-            this.send(toks.join(","));
+            this._sendMouse(mtype, this.x, this.y, this.buttonMask, magnitude);
         }
 
         event.preventDefault();
@@ -535,7 +573,11 @@ class Input {
      * @param {number} val - the button value, 1 or 0 for pressed or not-pressed.
      */
     _gamepadButton(gp_num, btn_num, val) {
-        this.send("js,b," + gp_num + "," + btn_num + "," + val);
+        if (this.inputProtocol === INPUT_PROTOCOL_VERSION) {
+            this.send(this._gamepadFrame(INPUT_FRAME_GAMEPAD_BUTTON, gp_num, btn_num, val));
+        } else {
+            this.send("js,b," + gp_num + "," + btn_num + "," + val);
+        }
     }
 
     /**
@@ -546,7 +588,57 @@ class Input {
      * @param {number} val - the normalize value between [0, 255]
      */
     _gamepadAxis(gp_num, axis_num, val) {
-        this.send("js,a," + gp_num + "," + axis_num + "," + val)
+        if (this.inputProtocol === INPUT_PROTOCOL_VERSION) {
+            this.send(this._gamepadFrame(INPUT_FRAME_GAMEPAD_AXIS, gp_num, axis_num, val));
+        } else {
+            this.send("js,a," + gp_num + "," + axis_num + "," + val)
+        }
+    }
+
+    /**
+     * Packs a gamepad button or axis event into a binary input frame.
+     *
+     * @param {number} frame_type - INPUT_FRAME_GAMEPAD_BUTTON or INPUT_FRAME_GAMEPAD_AXIS
+     * @param {number} gp_num - the gamepad number
+     * @param {number} num - the button or axis number
+     * @param {number} val - the button or axis value
+     * @returns {ArrayBuffer}
+     */
+    _gamepadFrame(frame_type, gp_num, num, val) {
+        var view = this._newFrame(frame_type, 6);
+        view.setUint8(2, gp_num);
+        view.setUint8(3, num);
+        view.setFloat32(4, val, true);
+        return this._finishFrame(view, 8);
+    }
+
+    /**
+     * Allocates a binary input frame and writes its header.
+     *
+     * @param {number} frame_type - one of INPUT_FRAME_*
+     * @param {number} payload_size - size of the payload in bytes
+     * @returns {DataView}
+     */
+    _newFrame(frame_type, payload_size) {
+        var size = 2 + payload_size + (this.inputTimestamps ? 8 : 0);
+        var view = new DataView(new ArrayBuffer(size));
+        view.setUint8(0, INPUT_PROTOCOL_VERSION);
+        view.setUint8(1, frame_type);
+        return view;
+    }
+
+    /**
+     * Appends the client send time in milliseconds when timestamps are enabled.
+     *
+     * @param {DataView} view - frame from _newFrame
+     * @param {number} offset - end of the payload
+     * @returns {ArrayBuffer}
+     */
+    _finishFrame(view, offset) {
+        if (view.byteLength > offset) {
+            view.setFloat64(offset, Date.now(), true);
+        }
+        return view.buffer;
     }
 
     /**
@@ -647,10 +739,10 @@ class Input {
         // Using guacamole keyboard because it has the keysym translations.
         this.keyboard = new Guacamole.Keyboard(window);
         this.keyboard.onkeydown = (keysym) => {
-            this.send("kd," + keysym);
+            this._sendKey(true, keysym);
         };
         this.keyboard.onkeyup = (keysym) => {
-            this.send("ku," + keysym);
+            this._sendKey(false, keysym);
         };
 
         if (document.fullscreenElement !== null && document.pointerLockElement === null) {
@@ -20,10 +20,18 @@
  *   limitations under the License.
  */
 
-/*global GamepadManager, Input*/
+/*global GamepadManager, Input, INPUT_PROTOCOL_VERSION, ClipboardTransfer, CLIPBOARD_CHANNEL_LABEL*/
 
 /*eslint no-unused-vars: ["error", { "vars": "local" }]*/
 
+// Binary messages from the server, <u8 version><u8 type><payload> with
+// little-endian payloads, must match DATA_FRAME_* in gstwebrtc_app.py.
+const DATA_FRAME_HEADER_SIZE = 2;
+const DATA_FRAME_CURSOR = 1;
+// handle u32, hotspot x i16, hotspot y i16, width u16, height u16, flags u8, then the PNG image
+const DATA_CURSOR_HEADER_SIZE = 13;
+const DATA_CURSOR_FLAG_HIDDEN = 0x01;
+
 /**
  * @typedef {Object} WebRTCDemo
  * @property {function} ondebug - Callback fired when new debug message is set.
@@ -38,6 +46,7 @@
  * @property {Objet} rtcPeerConfig - RTC configuration containing ICE servers and other connection properties.
  * @property {boolean} forceTurn - Force use of TURN server.
  * @property {fucntion} sendDataChannelMessage - Send a message to the peer though the data channel.
+ * @property {function} sendClipboard - Send clipboard contents to the peer.
  */
 class WebRTCDemo {
     /**
@@ -175,6 +184,12 @@ class WebRTCDemo {
          */
         this._send_channel = null;
 
+        /**
+         * Chunked transfers on the clipboard data channel, null when the server did not open it.
+         * @type {ClipboardTransfer}
+         */
+        this._clipboard_transfer = null;
+
         /**
          * @type {Input}
          */
@@ -350,8 +365,26 @@ class WebRTCDemo {
     _onPeerdDataChannel(event) {
         this._setStatus("Peer data channel created: " + event.channel.label);
 
+        if (event.channel.label === CLIPBOARD_CHANNEL_LABEL) {
+            this._clipboard_transfer = new ClipboardTransfer(event.channel);
+            this._clipboard_transfer.ondebug = this._setDebug.bind(this);
+            this._clipboard_transfer.oncontent = (text) => {
+                if (this.onclipboardcontent !== null) {
+                    this.onclipboardcontent(text);
+                }
+            };
+            event.channel.onopen = () => {
+                this._clipboard_transfer.start();
+            };
+            return;
+        }
+
         // Bind the data channel event handlers.
         this._send_channel = event.channel;
+        this._send_channel.binaryType = "arraybuffer";
+        // Input events use CSV until the server announces the binary protocol.
+        this.input.inputProtocol = 0;
+        this.input.inputTimestamps = false;
         this._send_channel.onmessage = this._onPeerDataChannelMessage.bind(this);
         this._send_channel.onopen = () => {
             if (this.ondatachannelopen !== null)
@@ -369,6 +402,11 @@ class WebRTCDemo {
      * @param {MessageEvent} event
      */
     _onPeerDataChannelMessage(event) {
+        if (event.data instanceof ArrayBuffer) {
+            this._onPeerDataChannelFrame(event.data);
+            return;
+        }
+
         // Attempt to parse message as JSON
         var msg;
         try {
@@ -413,7 +451,18 @@ class WebRTCDemo {
             if (msg.action !== null) {
                 this._setDebug("received system msg, action: " + msg.data.action);
                 var action = msg.data.action;
-                if (this.onsystemaction !== null) {
+                if (action.startsWith("input_protocol")) {
+                    // Switch input events to binary frames if the version is supported.
+                    var version = parseInt(action.split(",")[1]);
+                    if (version === INPUT_PROTOCOL_VERSION) {
+                        this.input.inputProtocol = version;
+                        this.sendDataChannelMessage("_proto," + version);
+                        this._setStatus("Using binary input protocol version " + version);
+                    }
+                } else if (action.startsWith("input_timestamps")) {
+                    // Used by the server to measure network and injection latency of input.
+                    this.input.inputTimestamps = (action.split(",")[1] === "1");
+                } else if (this.onsystemaction !== null) {
                     this.onsystemaction(action);
                 }
             }
@@ -434,6 +483,44 @@ class WebRTCDemo {
         }
     }
 
+    /**
+     * Handles binary frames from the peer data channel.
+     *
+     * @param {ArrayBuffer} buffer
+     */
+    _onPeerDataChannelFrame(buffer) {
+        if (buffer.byteLength < DATA_FRAME_HEADER_SIZE) return;
+        var view = new DataView(buffer);
+        if (view.getUint8(0) !== INPUT_PROTOCOL_VERSION) {
+            this._setError("unsupported binary data channel message version: " + view.getUint8(0));
+            return;
+        }
+        var type = view.getUint8(1);
+        if (type === DATA_FRAME_CURSOR) {
+            if (buffer.byteLength < DATA_FRAME_HEADER_SIZE + DATA_CURSOR_HEADER_SIZE) return;
+            var offset = DATA_FRAME_HEADER_SIZE;
+            var handle = view.getUint32(offset, true);
+            var hotspot = {
+                x: view.getInt16(offset + 4, true),
+                y: view.getInt16(offset + 6, true)
+            };
+            var flags = view.getUint8(offset + 12);
+            var png = new Uint8Array(buffer, offset + DATA_CURSOR_HEADER_SIZE);
+            this._setDebug(`received binary cursor, handle: ${handle}, hotspot: ${JSON.stringify(hotspot)} image length: ${png.length}`);
+            if (png.length > 0 && !this.cursor_cache.has(handle)) {
+                // Blob URLs avoid encoding the image to base64 again.
+                var url = URL.createObjectURL(new Blob([png], {type: "image/png"}));
+                this.cursor_cache.set(handle, "url('" + url + "')");
+            }
+            if (this.oncursorchange !== null) {
+                var override = (flags & DATA_CURSOR_FLAG_HIDDEN) ? "none" : null;
+                this.oncursorchange(handle, null, hotspot, override);
+            }
+        } else {
+            this._setError("Unhandled binary message received: " + type);
+        }
+    }
+
     /**
      * Handler for peer connection state change.
      * Possible values for state:
@@ -479,6 +566,22 @@ class WebRTCDemo {
         }
     }
 
+    /**
+     * Sends clipboard contents to the peer, large contents are chunked on the clipboard channel.
+     *
+     * @param {String} text
+     */
+    sendClipboard(text) {
+        if (this._clipboard_transfer !== null && this._clipboard_transfer.isOpen()) {
+            this._clipboard_transfer.send(text)
+                .catch(err => {
+                    this._setError("failed to send clipboard contents: " + err);
+                });
+        } else {
+            this.sendDataChannelMessage("cw," + stringToBase64(text));
+        }
+    }
+
     /**
      * Handler for gamepad disconnect message.
      *
@@ -744,6 +847,11 @@ class WebRTCDemo {
      */
     reset() {
         // Clear cursor cache.
+        for (const cursor_url of this.cursor_cache.values()) {
+            if (cursor_url.startsWith("url('blob:")) {
+                URL.revokeObjectURL(cursor_url.slice(5, -2));
+            }
+        }
         this.cursor_cache = new Map();
 
         var signalState = this.peerConnection.signalingState;
@@ -35,16 +35,20 @@ import traceback
 logger = logging.getLogger("main")
 logger.setLevel(logging.INFO)
 
-from watchdog.observers import Observer
-from watchdog.events import FileClosedEvent, FileSystemEventHandler
-from webrtc_input import WebRTCInput
+# Reference point of the startup timeline.
+PROCESS_START_TIME = time.monotonic()
+
+# Heavier subsystems (GStreamer, X11 input, metrics, GPU monitor, watchdog)
+# are imported in main() or on first use, after the arguments are parsed.
 from webrtc_signalling import WebRTCSignalling, WebRTCSignallingErrorNoPeer
-from gstwebrtc_app import GSTWebRTCApp
-from gpu_monitor import GPUMonitor
-from system_monitor import SystemMonitor
-from metrics import Metrics
+from scheduler import PeriodicScheduler
 from resize import resize_display, get_new_res, set_dpi, set_cursor_size
 from signalling_web import WebRTCSimpleServer, generate_rtc_config
+from clipboard_transfer import ClipboardTransfer
+
+# Startup phases that run concurrently are bounded by these timeouts in seconds.
+TURN_REST_TIMEOUT = 5
+X11_CONNECT_TIMEOUT = 30
 
 DEFAULT_RTC_CONFIG = """{
   "lifetimeDuration": "86400s",
@@ -59,6 +63,35 @@ DEFAULT_RTC_CONFIG = """{
   "iceTransportPolicy": "all"
 }"""
 
+class StartupTrace:
+    def __init__(self, start_time=PROCESS_START_TIME):
+        """Records the duration of each initialization phase
+
+        Arguments:
+            start_time {float} -- time.monotonic() value the timeline starts from
+        """
+        self.start_time = start_time
+        self.last_time = start_time
+        self.phases = []
+
+    def mark(self, phase):
+        """Ends the current phase
+
+        Arguments:
+            phase {string} -- name of the phase that just completed
+        """
+        now = time.monotonic()
+        self.phases.append((phase, self.last_time - self.start_time, now - self.last_time))
+        self.last_time = now
+
+    def report(self):
+        """Logs the timeline of all completed phases
+        """
+        logger.info("startup timeline (start offset, duration, phase):")
+        for phase, offset, duration in self.phases:
+            logger.info("  %9.1fms %9.1fms  %s" % (offset * 1000, duration * 1000, phase))
+        logger.info("startup completed in %.1fms" % ((self.last_time - self.start_time) * 1000))
+
 class HMACRTCMonitor:
     def __init__(self, turn_host, turn_port, turn_shared_secret, turn_username, turn_protocol='udp', turn_tls=False, stun_host=None, stun_port=None, period=60, enabled=True):
         self.turn_host = turn_host
@@ -73,24 +106,33 @@ class HMACRTCMonitor:
         self.enabled = enabled
 
         self.running = False
+        self.scheduler = None
 
         self.on_rtc_config = lambda stun_servers, turn_servers, rtc_config: logger.warning("unhandled on_rtc_config")
 
-    def start(self):
+    def start(self, scheduler):
+        """Refreshes the HMAC credentials as a periodic scheduler job
+
+        Arguments:
+            scheduler {PeriodicScheduler} -- scheduler that runs the job
+        """
         if self.enabled:
+            self.scheduler = scheduler
             self.running = True
-            while self.running:
-                if self.enabled and int(time.time()) % self.period == 0:
-                    try:
-                        hmac_data = generate_rtc_config(self.turn_host, self.turn_port, self.turn_shared_secret, self.turn_username, self.turn_protocol, self.turn_tls, self.stun_host, self.stun_port)
-                        stun_servers, turn_servers, rtc_config = parse_rtc_config(hmac_data)
-                        self.on_rtc_config(stun_servers, turn_servers, rtc_config)
-                    except Exception as e:
-                        logger.warning("could not fetch TURN HMAC config in periodic monitor: {}".format(e))
-                time.sleep(0.5)
-            logger.info("HMAC RTC monitor stopped")
+            scheduler.add_job("hmac_rtc_monitor", self.period, self.update, delay=self.period, jitter=0.5)
+
+    def update(self):
+        try:
+            hmac_data = generate_rtc_config(self.turn_host, self.turn_port, self.turn_shared_secret, self.turn_username, self.turn_protocol, self.turn_tls, self.stun_host, self.stun_port)
+            stun_servers, turn_servers, rtc_config = parse_rtc_config(hmac_data)
+            self.on_rtc_config(stun_servers, turn_servers, rtc_config)
+        except Exception as e:
+            logger.warning("could not fetch TURN HMAC config in periodic monitor: {}".format(e))
 
     def stop(self):
+        if self.running:
+            self.scheduler.remove_job("hmac_rtc_monitor")
+            logger.info("HMAC RTC monitor stopped")
         self.running = False
 
 class RESTRTCMonitor:
@@ -98,6 +140,7 @@ class RESTRTCMonitor:
         self.period = period
         self.enabled = enabled
         self.running = False
+        self.scheduler = None
 
         self.turn_rest_uri = turn_rest_uri
         self.turn_rest_username = turn_rest_username.replace(":", "-")
@@ -109,20 +152,28 @@ class RESTRTCMonitor:
 
         self.on_rtc_config = lambda stun_servers, turn_servers, rtc_config: logger.warning("unhandled on_rtc_config")
 
-    def start(self):
+    def start(self, scheduler):
+        """Refreshes the TURN REST API RTC config as a blocking periodic scheduler job
+
+        Arguments:
+            scheduler {PeriodicScheduler} -- scheduler that runs the job
+        """
         if self.enabled:
+            self.scheduler = scheduler
             self.running = True
-            while self.running:
-                if self.enabled and int(time.time()) % self.period == 0:
-                    try:
-                        stun_servers, turn_servers, rtc_config = fetch_turn_rest(self.turn_rest_uri, self.turn_rest_username, self.turn_rest_username_auth_header, self.turn_protocol, self.turn_rest_protocol_header, self.turn_tls, self.turn_rest_tls_header)
-                        self.on_rtc_config(stun_servers, turn_servers, rtc_config)
-                    except Exception as e:
-                        logger.warning("could not fetch TURN REST config in periodic monitor: {}".format(e))
-                time.sleep(0.5)
-            logger.info("TURN REST RTC monitor stopped")
+            scheduler.add_job("turn_rest_rtc_monitor", self.period, self.update, blocking=True, delay=self.period, jitter=0.5)
+
+    def update(self):
+        try:
+            stun_servers, turn_servers, rtc_config = fetch_turn_rest(self.turn_rest_uri, self.turn_rest_username, self.turn_rest_username_auth_header, self.turn_protocol, self.turn_rest_protocol_header, self.turn_tls, self.turn_rest_tls_header, timeout=TURN_REST_TIMEOUT)
+            self.on_rtc_config(stun_servers, turn_servers, rtc_config)
+        except Exception as e:
+            logger.warning("could not fetch TURN REST config in periodic monitor: {}".format(e))
 
     def stop(self):
+        if self.running:
+            self.scheduler.remove_job("turn_rest_rtc_monitor")
+            logger.info("TURN REST RTC monitor stopped")
         self.running = False
 
 class RTCConfigFileMonitor:
@@ -132,13 +183,19 @@ class RTCConfigFileMonitor:
         self.rtc_file = rtc_file
 
         self.on_rtc_config = lambda stun_servers, turn_servers, rtc_config: logger.warning("unhandled on_rtc_config")
-        
-        self.observer = Observer()
-        self.file_event_handler = FileSystemEventHandler()
-        self.file_event_handler.on_closed = self.event_handler
-        self.observer.schedule(self.file_event_handler, self.rtc_file, recursive=False)
+
+        self.observer = None
+        if self.enabled:
+            # watchdog is only needed when an RTC config file is used.
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+            self.observer = Observer()
+            self.file_event_handler = FileSystemEventHandler()
+            self.file_event_handler.on_closed = self.event_handler
+            self.observer.schedule(self.file_event_handler, self.rtc_file, recursive=False)
 
     def event_handler(self, event):
+        from watchdog.events import FileClosedEvent
         if type(event) is FileClosedEvent:
             print("Detected RTC JSON file change: {}".format(event.src_path))
             try:
@@ -155,7 +212,8 @@ class RTCConfigFileMonitor:
             self.running = True
 
     def stop(self):
-        self.observer.stop()
+        if self.observer is not None:
+            self.observer.stop()
         logger.info("RTC config file monitor stopped")
         self.running = False
 
@@ -224,12 +282,13 @@ def parse_rtc_config(data):
                 turn_uris.append(turn_uri)
     return stun_uris, turn_uris, data
 
-def fetch_turn_rest(uri, user, auth_header_username='x-auth-user', protocol='udp', header_protocol='x-turn-protocol', turn_tls=False, header_tls='x-turn-tls'):
+def fetch_turn_rest(uri, user, auth_header_username='x-auth-user', protocol='udp', header_protocol='x-turn-protocol', turn_tls=False, header_tls='x-turn-tls', timeout=None):
     """Fetches TURN uri from a REST API
 
     Arguments:
         uri {string} -- uri of REST API service, example: http://localhost:8081/
         user {string} -- username used to generate TURN credential, for example: <hostname>
+        timeout {float} -- socket timeout in seconds, None blocks indefinitely
 
     Raises:
         Exception -- if response http status code is >= 400
@@ -242,9 +301,9 @@ def fetch_turn_rest(uri, user, auth_header_username='x-auth-user', protocol='udp
 
     parsed_uri = urllib.parse.urlparse(uri)
 
-    conn = http.client.HTTPConnection(parsed_uri.netloc)
+    conn = http.client.HTTPConnection(parsed_uri.netloc, timeout=timeout)
     if parsed_uri.scheme == "https":
-        conn = http.client.HTTPSConnection(parsed_uri.netloc)
+        conn = http.client.HTTPSConnection(parsed_uri.netloc, timeout=timeout)
     auth_headers = {
         auth_header_username: user,
         header_protocol: protocol,
@@ -301,6 +360,9 @@ def set_json_app_argument(config_path, key, value):
     return True
 
 def main():
+    startup_trace = StartupTrace()
+    startup_trace.mark("python interpreter and core imports")
+
     parser = argparse.ArgumentParser()
     parser.add_argument('--json_config',
                         default=os.environ.get(
@@ -411,6 +473,21 @@ def main():
     parser.add_argument('--uinput_mouse_socket',
                         default=os.environ.get('SELKIES_UINPUT_MOUSE_SOCKET', ''),
                         help='Path to the uinput mouse socket, if not provided uinput is used directly')
+    parser.add_argument('--uinput_mouse_format',
+                        default=os.environ.get('SELKIES_UINPUT_MOUSE_FORMAT', 'msgpack'),
+                        help='Wire format of the uinput mouse socket, "msgpack" sends one datagram per event, "compact" batches the events of each input message into one fixed-layout datagram and requires a receiver that supports it')
+    parser.add_argument('--mouse_coalesce_window_ms',
+                        default=os.environ.get('SELKIES_MOUSE_COALESCE_WINDOW_MS', '-1'),
+                        help='Merge pointer motion received within this window in milliseconds, -1 for one frame interval, 0 to inject every event')
+    parser.add_argument('--gamepad_axis_deadzone',
+                        default=os.environ.get('SELKIES_GAMEPAD_AXIS_DEADZONE', '0.05'),
+                        help='Deadzone of gamepad stick axes as a fraction of the range, one value for all axes or a comma separated value per axis')
+    parser.add_argument('--gamepad_axis_threshold',
+                        default=os.environ.get('SELKIES_GAMEPAD_AXIS_THRESHOLD', '128'),
+                        help='Minimum change of a gamepad axis value in joystick units (-32767 to 32767) before an event is sent')
+    parser.add_argument('--gamepad_axis_rate_limit',
+                        default=os.environ.get('SELKIES_GAMEPAD_AXIS_RATE_LIMIT', '0'),
+                        help='Maximum events per second per gamepad axis, the latest value is sent once the limit allows, 0 to disable')
     parser.add_argument('--js_socket_path',
                         default=os.environ.get('SELKIES_JS_SOCKET_PATH', '/tmp'),
                         help='Directory to write the Selkies Joystick Interposer communication sockets to, default: /tmp, results in socket files: /tmp/selkies_js{0-3}.sock')
@@ -471,6 +548,9 @@ def main():
     parser.add_argument('--metrics_http_port',
                         default=os.environ.get('SELKIES_METRICS_HTTP_PORT', '8000'),
                         help='Port to start the Prometheus metrics server on')
+    parser.add_argument('--startup_trace',
+                        default=os.environ.get('SELKIES_STARTUP_TRACE', 'false'),
+                        help='Print a timeline of each initialization phase once startup completes')
     parser.add_argument('--debug', action='store_true',
                         help='Enable debug logging')
     args = parser.parse_args()
@@ -502,8 +582,18 @@ def main():
     else:
         logging.basicConfig(level=logging.INFO)
 
+    startup_trace.mark("argument parsing")
+
     # Wait for streaming app to initialize
     wait_for_app_ready(args.app_ready_file, args.app_wait_ready.lower() == "true")
+    startup_trace.mark("waiting for streaming app")
+
+    # Load the required subsystems, optional ones are loaded below only when enabled.
+    from gstwebrtc_app import GSTWebRTCApp
+    startup_trace.mark("GStreamer import")
+    from webrtc_input import WebRTCInput, INPUT_PROTOCOL_VERSION
+    from system_monitor import SystemMonitor
+    startup_trace.mark("X11 input and system monitor import")
 
     # Peer id for this app, default is 0, expecting remote peer id to be 1
     my_id = 0
@@ -514,7 +604,11 @@ def main():
     # Initialize metrics server
     using_metrics_http = args.enable_metrics_http.lower() == 'true'
     using_webrtc_csv = args.enable_webrtc_statistics.lower() == 'true'
-    metrics = Metrics(int(args.metrics_http_port), using_webrtc_csv)
+    metrics = None
+    if using_metrics_http or using_webrtc_csv:
+        from metrics import Metrics
+        metrics = Metrics(int(args.metrics_http_port), using_webrtc_csv)
+        startup_trace.mark("metrics import")
 
     # Initialize the signalling client
     using_https = args.enable_https.lower() == 'true'
@@ -536,17 +630,15 @@ def main():
     # Handle errors from the signalling server
     async def on_signalling_error(e):
        if isinstance(e, WebRTCSignallingErrorNoPeer):
-           # Waiting for peer to connect, retry in 2 seconds.
-           time.sleep(2)
-           await signalling.setup_call()
+           # Waiting for peer to connect, retry with backoff or as soon as it joins.
+           signalling.retry_setup_call()
        else:
            logger.error("signalling error: %s", str(e))
            app.stop_pipeline()
     async def on_audio_signalling_error(e):
        if isinstance(e, WebRTCSignallingErrorNoPeer):
-           # Waiting for peer to connect, retry in 2 seconds.
-           time.sleep(2)
-           await audio_signalling.setup_call()
+           # Waiting for peer to connect, retry with backoff or as soon as it joins.
+           audio_signalling.retry_setup_call()
        else:
            logger.error("signalling error: %s", str(e))
            audio_app.stop_pipeline()
@@ -569,36 +661,31 @@ def main():
     using_turn_rest = False
     using_hmac_turn = False
     using_rtc_config_json = False
+    pending_turn_rest = False
     if os.path.exists(args.rtc_config_json):
         logger.warning("using JSON file from argument for RTC config, overrides all other STUN/TURN configuration")
         with open(args.rtc_config_json, 'r') as f:
             stun_servers, turn_servers, rtc_config = parse_rtc_config(f.read())
         using_rtc_config_json = True
     else:
-        if args.turn_rest_uri:
-            try:
-                stun_servers, turn_servers, rtc_config = fetch_turn_rest(
-                    args.turn_rest_uri, turn_rest_username, args.turn_rest_username_auth_header, turn_protocol, args.turn_rest_protocol_header, using_turn_tls, args.turn_rest_tls_header)
-                logger.info("using TURN REST API RTC configuration, overrides long-term username/password or short-term shared secret STUN/TURN configuration")
-                using_turn_rest = True
-            except Exception as e:
-                logger.warning("error fetching TURN REST API RTC configuration, falling back to other methods: {}".format(str(e)))
-                using_turn_rest = False
-        if not using_turn_rest:
-            if (args.turn_username and args.turn_password) and (args.turn_host and args.turn_port):
-                config_json = make_turn_rtc_config_json_legacy(args.turn_host, args.turn_port, args.turn_username, args.turn_password, turn_protocol, using_turn_tls, args.stun_host, args.stun_port)
-                stun_servers, turn_servers, rtc_config = parse_rtc_config(config_json)
-                logger.info("using TURN long-term username/password credentials, prioritized over short-term shared secret configuration")
-            elif args.turn_shared_secret and (args.turn_host and args.turn_port):
-                hmac_data = generate_rtc_config(args.turn_host, args.turn_port, args.turn_shared_secret, turn_rest_username, turn_protocol, using_turn_tls, args.stun_host, args.stun_port)
-                stun_servers, turn_servers, rtc_config = parse_rtc_config(hmac_data)
-                logger.info("using TURN short-term shared secret HMAC credentials")
-                using_hmac_turn = True
-            else:
-                stun_servers, turn_servers, rtc_config = parse_rtc_config(DEFAULT_RTC_CONFIG)
-                logger.warning("missing TURN server information, using DEFAULT_RTC_CONFIG")
+        # The TURN REST API is queried in the background once the event loop
+        # runs, the other methods provide the fallback configuration.
+        pending_turn_rest = bool(args.turn_rest_uri)
+        if (args.turn_username and args.turn_password) and (args.turn_host and args.turn_port):
+            config_json = make_turn_rtc_config_json_legacy(args.turn_host, args.turn_port, args.turn_username, args.turn_password, turn_protocol, using_turn_tls, args.stun_host, args.stun_port)
+            stun_servers, turn_servers, rtc_config = parse_rtc_config(config_json)
+            logger.info("using TURN long-term username/password credentials, prioritized over short-term shared secret configuration")
+        elif args.turn_shared_secret and (args.turn_host and args.turn_port):
+            hmac_data = generate_rtc_config(args.turn_host, args.turn_port, args.turn_shared_secret, turn_rest_username, turn_protocol, using_turn_tls, args.stun_host, args.stun_port)
+            stun_servers, turn_servers, rtc_config = parse_rtc_config(hmac_data)
+            logger.info("using TURN short-term shared secret HMAC credentials")
+            using_hmac_turn = True
+        else:
+            stun_servers, turn_servers, rtc_config = parse_rtc_config(DEFAULT_RTC_CONFIG)
+            logger.warning("missing TURN server information, using DEFAULT_RTC_CONFIG")
 
     logger.info("initial server RTC configuration fetched")
+    startup_trace.mark("RTC configuration")
 
     # Extract arguments
     enable_resize = args.enable_resize.lower() == "true"
@@ -618,6 +705,7 @@ def main():
     # Create instance of app
     app = GSTWebRTCApp(stun_servers, turn_servers, audio_channels, curr_fps, args.encoder, gpu_id, curr_video_bitrate, curr_audio_bitrate, keyframe_distance, congestion_control, video_packetloss_percent, audio_packetloss_percent)
     audio_app = GSTWebRTCApp(stun_servers, turn_servers, audio_channels, curr_fps, args.encoder, gpu_id, curr_video_bitrate, curr_audio_bitrate, keyframe_distance, congestion_control, video_packetloss_percent, audio_packetloss_percent)
+    startup_trace.mark("GStreamer init and plugin check")
 
     # [END main_setup]
 
@@ -663,6 +751,9 @@ def main():
 
     # Initialize the Xinput instance
     cursor_scale = 1.0
+    mouse_coalesce_window_ms = float(args.mouse_coalesce_window_ms)
+    if mouse_coalesce_window_ms < 0:
+        mouse_coalesce_window_ms = 1000.0 / curr_fps
     webrtc_input = WebRTCInput(
         args.uinput_mouse_socket,
         args.js_socket_path,
@@ -670,16 +761,33 @@ def main():
         enable_cursors,
         cursor_size,
         cursor_scale,
-        cursor_debug)
+        cursor_debug,
+        mouse_coalesce_window=mouse_coalesce_window_ms / 1000.0,
+        uinput_mouse_format=args.uinput_mouse_format.lower(),
+        gamepad_axis_deadzone=[float(v) for v in args.gamepad_axis_deadzone.split(',')],
+        gamepad_axis_threshold=int(args.gamepad_axis_threshold),
+        gamepad_axis_rate_limit=float(args.gamepad_axis_rate_limit))
 
     # Handle changed cursors
     webrtc_input.on_cursor_change = lambda data: app.send_cursor_data(data)
 
+    # Cursors are sent as binary frames once the client accepted the binary protocol
+    def set_client_input_protocol(version):
+        app.client_data_protocol = version
+    webrtc_input.on_input_protocol = set_client_input_protocol
+
     # Log message when data channel is open
     def data_channel_ready():
         logger.info(
             "opened peer data channel for user input to X11")
 
+        # The client switches to binary input frames after acknowledging the version.
+        webrtc_input.client_input_protocol = 0
+        app.client_data_protocol = 0
+        app.send_input_protocol(INPUT_PROTOCOL_VERSION)
+        # Client timestamps are only useful for the latency metrics.
+        if metrics:
+            app.send_input_timestamps(True)
         app.send_framerate(app.framerate)
         app.send_video_bitrate(app.video_bitrate)
         app.send_audio_bitrate(audio_app.audio_bitrate)
@@ -691,6 +799,7 @@ def main():
 
     # Send incoming messages from data channel to input handler
     app.on_data_message = webrtc_input.on_message
+    app.on_data_binary_message = webrtc_input.on_binary_message
 
     # Send video bitrate messages to app
     webrtc_input.on_video_encoder_bit_rate = lambda bitrate: set_json_app_argument(args.json_config, "video_bitrate", bitrate) and (app.set_video_bitrate(int(bitrate)))
@@ -702,8 +811,21 @@ def main():
     webrtc_input.on_mouse_pointer_visible = lambda visible: app.set_pointer_visible(
         visible)
 
+    # Large clipboard contents are chunked on their own data channel, the
+    # input channel is only used by clients that did not open it.
+    clipboard_transfer = ClipboardTransfer()
+    clipboard_transfer.send_string = app.send_clipboard_string
+    clipboard_transfer.send_data = app.send_clipboard_chunk
+    clipboard_transfer.on_content = webrtc_input.receive_clipboard
+    app.on_clipboard_open = lambda: clipboard_transfer.start()
+    app.on_clipboard_close = lambda: clipboard_transfer.stop()
+    clipboard_transfer.buffered_amount = app.get_clipboard_buffered_amount
+    app.on_clipboard_buffered_amount_low = clipboard_transfer.on_buffered_amount_low
+    app.on_clipboard_message = clipboard_transfer.on_message
+    app.on_clipboard_binary_message = clipboard_transfer.on_binary_message
+
     # Send clipboard contents when requested
-    webrtc_input.on_clipboard_read = lambda data: app.send_clipboard_data(data)
+    webrtc_input.on_clipboard_read = lambda data, force=False: clipboard_transfer.send(data, force) or app.send_clipboard_data(data)
 
     # Write framerate argument to local configuration and then tell client to reload.
     def set_fps_handler(fps):
@@ -770,24 +892,50 @@ def main():
 
     webrtc_input.on_set_enable_resize = enable_resize_handler
 
-    # Send client FPS to metrics
-    webrtc_input.on_client_fps = lambda fps: metrics.set_fps(fps)
+    if metrics:
+        # Send client FPS to metrics
+        webrtc_input.on_client_fps = lambda fps: metrics.set_fps(fps)
+
+        # Send client latency to metrics
+        webrtc_input.on_client_latency = lambda latency_ms: metrics.set_latency(latency_ms)
+
+        # Send WebRTC stats to metrics
+        webrtc_input.on_client_webrtc_stats = lambda webrtc_stat_type, webrtc_stats: metrics.set_webrtc_stats(webrtc_stat_type, webrtc_stats)
 
-    # Send client latency to metrics
-    webrtc_input.on_client_latency = lambda latency_ms: metrics.set_latency(latency_ms)
+        # Count input messages and time their handlers
+        webrtc_input.on_input_message_timing = lambda command, duration_ms: metrics.set_input_message_timing(command, duration_ms)
+        webrtc_input.on_input_message_dropped = lambda reason: metrics.inc_input_message_dropped(reason)
+        webrtc_input.on_input_queue = lambda lane, depth, age_ms: metrics.set_input_queue(lane, depth, age_ms)
 
-    # Send WebRTC stats to metrics
-    webrtc_input.on_client_webrtc_stats = lambda webrtc_stat_type, webrtc_stats: metrics.set_webrtc_stats(webrtc_stat_type, webrtc_stats)
+        # Split input latency into network and server side injection
+        webrtc_input.on_input_network_latency = lambda command, latency_ms: metrics.set_input_network_latency(command, latency_ms)
+        webrtc_input.on_input_inject_latency = lambda command, latency_ms: metrics.set_input_inject_latency(command, latency_ms)
 
-    # Initialize GPU monitor
-    gpu_mon = GPUMonitor(enabled=args.encoder.startswith("nv"))
+        # Coalescing ratio and injection lag of pointer motion
+        webrtc_input.on_mouse_motion_flush = lambda count, lag_ms: metrics.set_mouse_motion_flush(count, lag_ms)
+
+        # Event rate and queue delay of the gamepad sockets
+        webrtc_input.on_gamepad_events = lambda js_num, count, delay_ms: metrics.set_gamepad_events(js_num, count, delay_ms)
+        webrtc_input.on_gamepad_event_suppressed = lambda js_num, reason: metrics.inc_gamepad_event_suppressed(js_num, reason)
+    else:
+        webrtc_input.on_client_fps = lambda fps: None
+        webrtc_input.on_client_latency = lambda latency_ms: None
+        webrtc_input.on_client_webrtc_stats = lambda webrtc_stat_type, webrtc_stats: None
 
-    # Send the GPU stats when available.
-    def on_gpu_stats(load, memory_total, memory_used):
-        app.send_gpu_stats(load, memory_total, memory_used)
-        metrics.set_gpu_utilization(load * 100)
+    # Initialize GPU monitor, only available with NVIDIA encoders.
+    gpu_mon = None
+    if args.encoder.startswith("nv"):
+        from gpu_monitor import GPUMonitor
+        gpu_mon = GPUMonitor()
+        startup_trace.mark("GPU monitor import")
 
-    gpu_mon.on_stats = on_gpu_stats
+        # Send the GPU stats when available.
+        def on_gpu_stats(load, memory_total, memory_used):
+            app.send_gpu_stats(load, memory_total, memory_used)
+            if metrics:
+                metrics.set_gpu_utilization(load * 100)
+
+        gpu_mon.on_stats = on_gpu_stats
 
     # Initialize the system monitor
     system_mon = SystemMonitor()
@@ -806,6 +954,13 @@ def main():
     loop.add_signal_handler(signal.SIGINT, lambda: sys.exit(1))
     loop.add_signal_handler(signal.SIGTERM, lambda: sys.exit(1))
     webrtc_input.loop = loop
+    app.loop = loop
+    audio_app.loop = loop
+
+    # Single scheduler for all periodic monitors, blocking jobs run in its own bounded pool.
+    scheduler = PeriodicScheduler(loop)
+    if metrics:
+        scheduler.on_job_timing = lambda name, duration_ms, lateness_ms: metrics.set_scheduler_job_timing(name, duration_ms, lateness_ms)
 
     # Initialize the signaling and web server
     options = argparse.Namespace()
@@ -823,15 +978,20 @@ def main():
     options.cert_restart = False # using_https
     options.rtc_config_file = args.rtc_config_json
     options.rtc_config = rtc_config
-    options.turn_shared_secret = args.turn_shared_secret if using_hmac_turn else ''
-    options.turn_host = args.turn_host if using_hmac_turn else ''
-    options.turn_port = args.turn_port if using_hmac_turn else ''
+    # The HMAC secret is handed to the server after the TURN REST API was tried.
+    using_server_hmac = using_hmac_turn and not pending_turn_rest
+    options.turn_shared_secret = args.turn_shared_secret if using_server_hmac else ''
+    options.turn_host = args.turn_host if using_server_hmac else ''
+    options.turn_port = args.turn_port if using_server_hmac else ''
     options.turn_protocol = turn_protocol
     options.turn_tls = using_turn_tls
     options.turn_auth_header_name = args.turn_rest_username_auth_header
     options.stun_host = args.stun_host
     options.stun_port = args.stun_port
     server = WebRTCSimpleServer(loop, options)
+    if pending_turn_rest:
+        # Hold /turn requests until the background fetch below has finished.
+        server.expect_rtc_config()
 
     # Callback method to update TURN servers of a running pipeline.
     def mon_rtc_config(stun_servers, turn_servers, rtc_config):
@@ -877,24 +1037,75 @@ def main():
         enabled=using_rtc_config_json)
     rtc_file_mon.on_rtc_config = mon_rtc_config
 
+    def start_rtc_monitors():
+        hmac_turn_mon.enabled = using_hmac_turn and not using_turn_rest
+        turn_rest_mon.enabled = using_turn_rest
+        hmac_turn_mon.start(scheduler)
+        turn_rest_mon.start(scheduler)
+
+    async def fetch_turn_rest_config():
+        """Fetches the TURN REST API RTC config without blocking the event loop
+
+        Falls back to the configuration resolved at startup when the REST API
+        fails or does not respond within TURN_REST_TIMEOUT.
+        """
+        nonlocal using_turn_rest
+        try:
+            stun_servers, turn_servers, rest_rtc_config = await asyncio.wait_for(loop.run_in_executor(None, lambda: fetch_turn_rest(
+                args.turn_rest_uri, turn_rest_username, args.turn_rest_username_auth_header, turn_protocol, args.turn_rest_protocol_header, using_turn_tls, args.turn_rest_tls_header, timeout=TURN_REST_TIMEOUT)),
+                timeout=TURN_REST_TIMEOUT)
+            logger.info("using TURN REST API RTC configuration, overrides long-term username/password or short-term shared secret STUN/TURN configuration")
+            using_turn_rest = True
+            for a in (app, audio_app):
+                a.stun_servers = stun_servers
+                a.turn_servers = turn_servers
+            server.set_rtc_config(rest_rtc_config)
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError):
+                e = "timed out after {}s".format(TURN_REST_TIMEOUT)
+            logger.warning("error fetching TURN REST API RTC configuration, falling back to other methods: {}".format(str(e)))
+            if using_hmac_turn:
+                server.set_turn_shared_secret(args.turn_shared_secret, args.turn_host, args.turn_port)
+            else:
+                server.set_rtc_config(rtc_config)
+        startup_trace.mark("TURN REST API RTC configuration")
+        start_rtc_monitors()
+
+    startup_trace.mark("signalling, web server and monitor setup")
+
     try:
+        # Serve /health right away, the asset cache, the TURN REST API
+        # config and the X11 connection are set up concurrently.
         asyncio.ensure_future(server.run(), loop=loop)
+        loop.run_in_executor(None, server.cache_web_root)
+        if pending_turn_rest:
+            asyncio.ensure_future(fetch_turn_rest_config(), loop=loop)
+        else:
+            start_rtc_monitors()
         if using_metrics_http:
             metrics.start_http()
-        loop.run_until_complete(webrtc_input.connect())
-        loop.run_in_executor(None, lambda: webrtc_input.start_clipboard())
-        loop.run_in_executor(None, lambda: webrtc_input.start_cursor_monitor())
-        loop.run_in_executor(None, lambda: gpu_mon.start(gpu_id))
-        loop.run_in_executor(None, lambda: hmac_turn_mon.start())
-        loop.run_in_executor(None, lambda: turn_rest_mon.start())
-        loop.run_in_executor(None, lambda: rtc_file_mon.start())
-        loop.run_in_executor(None, lambda: system_mon.start())
+        loop.run_until_complete(asyncio.wait_for(webrtc_input.connect(), timeout=X11_CONNECT_TIMEOUT))
+        startup_trace.mark("X11 input connection")
+        webrtc_input.start_clipboard(scheduler)
+        if enable_cursors:
+            webrtc_input.start_cursor_monitor(scheduler)
+            startup_trace.mark("cursor monitor")
+        if gpu_mon:
+            gpu_mon.start(scheduler, gpu_id)
+        rtc_file_mon.start()
+        system_mon.start(scheduler)
+
+        # Bus messages of every pipeline started by the sessions below.
+        asyncio.ensure_future(app.handle_bus_calls(), loop=loop)
+        asyncio.ensure_future(audio_app.handle_bus_calls(), loop=loop)
+        startup_trace.mark("monitor start")
+
+        if args.startup_trace.lower() == 'true':
+            startup_trace.report()
 
         while True:
-            if using_webrtc_csv:
+            if metrics and using_webrtc_csv:
                 metrics.initialize_webrtc_csv_file(args.webrtc_statistics_dir)
-            asyncio.ensure_future(app.handle_bus_calls(), loop=loop)
-            asyncio.ensure_future(audio_app.handle_bus_calls(), loop=loop)
 
             loop.run_until_complete(signalling.connect())
             loop.run_until_complete(audio_signalling.connect())
@@ -917,11 +1128,13 @@ def main():
         webrtc_input.stop_cursor_monitor()
         webrtc_input.stop_js_server()
         webrtc_input.disconnect()
-        gpu_mon.stop()
+        if gpu_mon:
+            gpu_mon.stop()
         hmac_turn_mon.stop()
         turn_rest_mon.stop()
         rtc_file_mon.stop()
         system_mon.stop()
+        scheduler.stop()
         loop.run_until_complete(server.stop())
         sys.exit(0)
     # [END main_start]
@@ -0,0 +1,299 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Clipboard transfer protocol on the "clipboard" data channel.
+#
+# The channel is reliable, ordered and low priority, so large transfers never
+# delay input events on the "input" channel. Both peers use the same protocol:
+#
+#   {"type": "clipboard_hello", "data": {"encodings": ["identity", "deflate"]}}
+#       sent by each peer when the channel opens, lists accepted encodings.
+#       Transfers are only sent after the peer's hello, peers that never send
+#       it get the clipboard through the JSON message on the input channel.
+#   {"type": "clipboard_start", "data": {"id": 1, "size": 1234, "length": 567,
+#                                        "encoding": "deflate", "sha256": "..."}}
+#       starts a transfer, size is the UTF-8 length and length the encoded length.
+#   binary chunks: <u32 id><encoded bytes>, little-endian, in order.
+#   {"type": "clipboard_end", "data": {"id": 1}}
+#       completes the transfer, the receiver decodes and verifies the digest.
+#
+# The "deflate" encoding is the zlib format, as decoded by the browser
+# DecompressionStream("deflate").
+
+import concurrent.futures
+import hashlib
+import json
+import struct
+import threading
+import time
+import zlib
+
+import logging
+logger = logging.getLogger("clipboard_transfer")
+logger.setLevel(logging.INFO)
+
+CLIPBOARD_CHANNEL_LABEL = "clipboard"
+# Chunks stay below the message size every browser accepts.
+CLIPBOARD_CHUNK_SIZE = 16 * 1024
+# Smaller contents are sent without compression.
+CLIPBOARD_COMPRESS_MIN_BYTES = 1024
+CLIPBOARD_MAX_BYTES = 16 * 1024 * 1024
+CLIPBOARD_CHUNK_HEADER = struct.Struct('<I')
+# Chunks wait while more is queued on the channel, the channel reports when the
+# queue drains below its buffered-amount-low threshold, which must be lower.
+CLIPBOARD_MAX_BUFFERED = 256 * 1024
+# Transfers are abandoned when the queue does not drain within this many seconds.
+CLIPBOARD_SEND_TIMEOUT = 10
+
+ENCODING_IDENTITY = "identity"
+ENCODING_DEFLATE = "deflate"
+CLIPBOARD_ENCODINGS = (ENCODING_IDENTITY, ENCODING_DEFLATE)
+
+
+class ClipboardTransferError(Exception):
+    pass
+
+
+class ClipboardTransfer:
+    def __init__(self, chunk_size=CLIPBOARD_CHUNK_SIZE, max_bytes=CLIPBOARD_MAX_BYTES):
+        """Sends and receives clipboard contents in chunks on a dedicated data channel
+
+        Keyword Arguments:
+            chunk_size {integer} -- maximum encoded bytes per binary message (default: {CLIPBOARD_CHUNK_SIZE})
+            max_bytes {integer} -- largest accepted contents in bytes (default: {CLIPBOARD_MAX_BYTES})
+        """
+
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        self.open = False
+        # Set once the peer greeted us, it handles transfers on this channel.
+        self.peer_ready = False
+        self.peer_encodings = (ENCODING_IDENTITY,)
+        # Digest of the contents both peers have, unchanged contents are not resent.
+        self.last_digest = None
+        self.next_id = 1
+        # Transfer being received: header dict and encoded bytes.
+        self.incoming = None
+        self.incoming_data = None
+        # Compresses, hashes and sends contents in order, off the caller's thread.
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="clipboard-transfer")
+        # Set by on_buffered_amount_low(), wakes a sender waiting for the queue to drain.
+        self.writable = threading.Event()
+
+        self.send_string = lambda msg: logger.warn('unhandled send_string')
+        self.send_data = lambda data: logger.warn('unhandled send_data')
+        self.on_content = lambda data: logger.warn('unhandled on_content')
+        # Bytes queued on the channel, chunks are paced on it.
+        self.buffered_amount = lambda: 0
+
+    def start(self):
+        """Greets the peer, call when the channel opens
+
+        The peer state is reset by stop(), its hello may arrive before this is called.
+        """
+        with self.lock:
+            self.open = True
+        self.__send_message("clipboard_hello", {"encodings": list(CLIPBOARD_ENCODINGS)})
+
+    def stop(self):
+        with self.lock:
+            self.open = False
+            self.peer_ready = False
+            self.peer_encodings = (ENCODING_IDENTITY,)
+            self.last_digest = None
+            self.incoming = None
+            self.incoming_data = None
+        # A sender waiting for the queue to drain gives up.
+        self.writable.set()
+
+    def on_buffered_amount_low(self):
+        """Call when the buffered amount of the channel drops below its low threshold
+        """
+        self.writable.set()
+
+    def send(self, data, force=False):
+        """Sends clipboard contents to the peer
+
+        Arguments:
+            data {string} -- clipboard contents
+
+        Keyword Arguments:
+            force {bool} -- send even if the peer has these contents, for explicit reads (default: {False})
+
+        Returns:
+            bool -- False if the peer does not handle transfers yet and the caller must fall back
+        """
+        if not (self.open and self.peer_ready):
+            return False
+        self.executor.submit(self.__send, data, force)
+        return True
+
+    def __send(self, data, force):
+        raw = data.encode("utf-8")
+        if len(raw) > self.max_bytes:
+            logger.warning("not sending clipboard contents larger than %d bytes" % self.max_bytes)
+            return
+        digest = hashlib.sha256(raw).hexdigest()
+
+        with self.lock:
+            if not self.open:
+                return
+            if digest == self.last_digest and not force:
+                logger.debug("skipping unchanged clipboard contents")
+                return
+            self.last_digest = digest
+            transfer_id = self.next_id
+            self.next_id = (self.next_id + 1) & 0xffffffff or 1
+            peer_encodings = self.peer_encodings
+
+        encoding, payload = ENCODING_IDENTITY, raw
+        if ENCODING_DEFLATE in peer_encodings and len(raw) >= CLIPBOARD_COMPRESS_MIN_BYTES:
+            compressed = zlib.compress(raw, 6)
+            if len(compressed) < len(raw):
+                encoding, payload = ENCODING_DEFLATE, compressed
+
+        logger.info("sending clipboard contents, length: %d, encoded length: %d, encoding: %s" % (
+            len(raw), len(payload), encoding))
+        try:
+            self.__send_message("clipboard_start", {
+                "id": transfer_id,
+                "size": len(raw),
+                "length": len(payload),
+                "encoding": encoding,
+                "sha256": digest,
+            })
+            header = CLIPBOARD_CHUNK_HEADER.pack(transfer_id)
+            view = memoryview(payload)
+            for offset in range(0, len(payload), self.chunk_size):
+                if not self.__wait_writable():
+                    logger.warning("abandoning clipboard transfer %d, the channel is closed or not draining" % transfer_id)
+                    with self.lock:
+                        # The peer did not get these contents.
+                        if self.last_digest == digest:
+                            self.last_digest = None
+                    return
+                self.send_data(header + view[offset:offset + self.chunk_size])
+            self.__send_message("clipboard_end", {"id": transfer_id})
+        except Exception as e:
+            logger.warning("failed to send clipboard transfer %d: %s" % (transfer_id, e))
+
+    def __wait_writable(self):
+        # Keeps the channel queue short so messages on other channels are not held behind a paste.
+        deadline = time.monotonic() + CLIPBOARD_SEND_TIMEOUT
+        while self.open and self.buffered_amount() > CLIPBOARD_MAX_BUFFERED:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self.writable.clear()
+            # The queue may have drained before the event was cleared.
+            if self.buffered_amount() <= CLIPBOARD_MAX_BUFFERED:
+                break
+            self.writable.wait(min(remaining, 1.0))
+        return self.open
+
+    def on_message(self, msg):
+        """Handles a string message from the clipboard channel
+        """
+        try:
+            msg = json.loads(msg)
+            msg_type, data = msg["type"], msg["data"]
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning("malformed clipboard message: %s" % e)
+            return
+
+        if msg_type == "clipboard_hello":
+            encodings = tuple(e for e in data.get("encodings", []) if e in CLIPBOARD_ENCODINGS)
+            with self.lock:
+                self.peer_encodings = encodings or (ENCODING_IDENTITY,)
+                self.peer_ready = True
+            logger.info("clipboard peer accepts encodings: %s" % ", ".join(self.peer_encodings))
+        elif msg_type == "clipboard_start":
+            self.__on_start(data)
+        elif msg_type == "clipboard_end":
+            self.__on_end(data)
+        else:
+            logger.warning("unhandled clipboard message: %s" % msg_type)
+
+    def on_binary_message(self, data):
+        """Handles a binary chunk from the clipboard channel
+        """
+        with self.lock:
+            if self.incoming is None or len(data) < CLIPBOARD_CHUNK_HEADER.size:
+                return
+            transfer_id, = CLIPBOARD_CHUNK_HEADER.unpack_from(data)
+            if transfer_id != self.incoming["id"]:
+                return
+            if len(self.incoming_data) + len(data) - CLIPBOARD_CHUNK_HEADER.size > self.incoming["length"]:
+                logger.warning("clipboard transfer %d exceeds its announced length, discarding" % transfer_id)
+                self.incoming = None
+                self.incoming_data = None
+                return
+            self.incoming_data.extend(memoryview(data)[CLIPBOARD_CHUNK_HEADER.size:])
+
+    def __on_start(self, header):
+        try:
+            header = {
+                "id": int(header["id"]),
+                "size": int(header["size"]),
+                "length": int(header["length"]),
+                "encoding": header.get("encoding", ENCODING_IDENTITY),
+                "sha256": header.get("sha256"),
+            }
+        except (KeyError, ValueError, TypeError) as e:
+            logger.warning("malformed clipboard transfer header: %s" % e)
+            return
+        if header["size"] > self.max_bytes or header["length"] > self.max_bytes:
+            logger.warning("rejecting clipboard transfer larger than %d bytes" % self.max_bytes)
+            return
+        if header["encoding"] not in CLIPBOARD_ENCODINGS:
+            logger.warning("rejecting clipboard transfer with unsupported encoding: %s" % header["encoding"])
+            return
+        with self.lock:
+            self.incoming = header
+            self.incoming_data = bytearray()
+
+    def __on_end(self, data):
+        with self.lock:
+            header, payload = self.incoming, self.incoming_data
+            self.incoming = None
+            self.incoming_data = None
+        if header is None or data.get("id") != header["id"]:
+            return
+
+        try:
+            raw = self.__decode(header, payload)
+        except ClipboardTransferError as e:
+            logger.warning("discarding clipboard transfer %d: %s" % (header["id"], e))
+            return
+
+        with self.lock:
+            # The peer has these contents, do not send them back.
+            self.last_digest = header["sha256"] or hashlib.sha256(raw).hexdigest()
+        logger.info("received clipboard contents, length: %d" % len(raw))
+        self.on_content(raw.decode("utf-8", "replace"))
+
+    def __decode(self, header, payload):
+        if len(payload) != header["length"]:
+            raise ClipboardTransferError("received %d of %d bytes" % (len(payload), header["length"]))
+        if header["encoding"] == ENCODING_DEFLATE:
+            decompressor = zlib.decompressobj()
+            try:
+                raw = decompressor.decompress(bytes(payload), self.max_bytes)
+            except zlib.error as e:
+                raise ClipboardTransferError("invalid deflate data: %s" % e)
+            if decompressor.unconsumed_tail:
+                raise ClipboardTransferError("contents larger than %d bytes" % self.max_bytes)
+        else:
+            raw = bytes(payload)
+        if len(raw) != header["size"]:
+            raise ClipboardTransferError("decoded %d of %d bytes" % (len(raw), header["size"]))
+        if header["sha256"] and hashlib.sha256(raw).hexdigest() != header["sha256"]:
+            raise ClipboardTransferError("digest mismatch")
+        return raw
+
+    def __send_message(self, msg_type, data):
+        self.send_string(json.dumps({"type": msg_type, "data": data}))
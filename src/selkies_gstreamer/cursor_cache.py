@@ -0,0 +1,218 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import collections
+import hashlib
+import os
+import struct
+import sys
+import threading
+from array import array
+
+import logging
+logger = logging.getLogger("cursor_cache")
+logger.setLevel(logging.INFO)
+
+# Converted cursors kept for the lifetime of the process.
+CURSOR_CACHE_MAX_ENTRIES = 256
+# X cursor serials remembered, serials of re-created cursors are never reused.
+CURSOR_SERIALS_MAX_ENTRIES = 1024
+
+# Xcursor file format, all fields are little-endian 32-bit words.
+XCURSOR_MAGIC = b'Xcur'
+XCURSOR_HEADER = struct.Struct('<4sIII')
+XCURSOR_TOC_ENTRY = struct.Struct('<III')
+# header size, type, nominal size, version, width, height, xhot, yhot, delay
+XCURSOR_IMAGE_HEADER = struct.Struct('<IIIIIIIII')
+XCURSOR_IMAGE_TYPE = 0xfffd0002
+XCURSOR_MAX_IMAGE_SIZE = 0x7fff
+
+XCURSOR_DEFAULT_PATH = "~/.local/share/icons:~/.icons:/usr/share/icons:/usr/share/pixmaps"
+XCURSOR_DEFAULT_SIZE = 24
+
+# Cursors shown by most applications, converted ahead of the first use.
+XCURSOR_WARM_UP_NAMES = (
+    "left_ptr", "default", "xterm", "text", "hand1", "hand2", "pointer",
+    "watch", "wait", "left_ptr_watch", "progress", "crosshair", "fleur",
+    "move", "grabbing", "not-allowed", "question_arrow", "help",
+    "sb_h_double_arrow", "sb_v_double_arrow", "col-resize", "row-resize",
+    "top_side", "bottom_side", "left_side", "right_side",
+    "top_left_corner", "top_right_corner", "bottom_left_corner", "bottom_right_corner",
+)
+
+# Same fields as the XFixes GetCursorImage reply used by cursor conversion.
+CursorImage = collections.namedtuple(
+    "CursorImage", ["width", "height", "xhot", "yhot", "cursor_image", "cursor_serial"])
+
+
+def cursor_key(cursor):
+    """Returns the content key of a cursor from its pixels, size and hotspot
+
+    Arguments:
+        cursor {object} -- XFixes cursor image reply or CursorImage
+
+    Returns:
+        bytes -- the key
+    """
+    pixels = cursor.cursor_image
+    if not isinstance(pixels, array):
+        pixels = array('I', pixels)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(struct.pack('<IIII', cursor.width, cursor.height, cursor.xhot, cursor.yhot))
+    h.update(pixels)
+    return h.digest()
+
+
+class CursorCache:
+    def __init__(self, max_entries=CURSOR_CACHE_MAX_ENTRIES):
+        """Bounded LRU cache of converted cursors keyed by content
+
+        Each cached cursor gets a short integer handle that is stable while it
+        stays cached, so clients that have seen the image only need the handle.
+
+        Keyword Arguments:
+            max_entries {integer} -- converted cursors to keep (default: {CURSOR_CACHE_MAX_ENTRIES})
+        """
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # content key -> cursor message, least recently used first
+        self.entries = collections.OrderedDict()
+        # X cursor serial -> content key
+        self.serials = collections.OrderedDict()
+        # 0 is reserved by clients for the default cursor.
+        self.next_handle = 1
+
+    def __len__(self):
+        return len(self.entries)
+
+    def key_for_serial(self, serial):
+        with self.lock:
+            key = self.serials.get(serial)
+            if key is not None:
+                self.serials.move_to_end(serial)
+            return key
+
+    def set_serial(self, serial, key):
+        with self.lock:
+            self.serials[serial] = key
+            self.serials.move_to_end(serial)
+            while len(self.serials) > CURSOR_SERIALS_MAX_ENTRIES:
+                self.serials.popitem(last=False)
+
+    def get(self, key):
+        with self.lock:
+            msg = self.entries.get(key)
+            if msg is not None:
+                self.entries.move_to_end(key)
+            return msg
+
+    def put(self, key, msg):
+        """Caches a cursor message and assigns its handle
+
+        Arguments:
+            key {bytes} -- content key from cursor_key()
+            msg {dict} -- cursor message, its handle is replaced
+
+        Returns:
+            dict -- the cached message
+        """
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is not None:
+                self.entries.move_to_end(key)
+                return cached
+            msg["handle"] = self.next_handle
+            self.next_handle += 1
+            self.entries[key] = msg
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return msg
+
+
+def load_xcursor(path, size):
+    """Reads the images of the nominal size closest to size from an Xcursor file
+
+    Arguments:
+        path {string} -- path of the cursor file
+        size {integer} -- preferred nominal size
+
+    Returns:
+        [list of CursorImage] -- one image per animation frame
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    magic, header_size, _, ntoc = XCURSOR_HEADER.unpack_from(data)
+    if magic != XCURSOR_MAGIC:
+        raise ValueError("not an Xcursor file: %s" % path)
+
+    toc = [XCURSOR_TOC_ENTRY.unpack_from(data, header_size + i * XCURSOR_TOC_ENTRY.size) for i in range(ntoc)]
+    images = [(subtype, position) for entry_type, subtype, position in toc if entry_type == XCURSOR_IMAGE_TYPE]
+    if not images:
+        return []
+    nominal = min(set(subtype for subtype, _ in images), key=lambda s: abs(s - size))
+
+    result = []
+    for subtype, position in images:
+        if subtype != nominal:
+            continue
+        _, _, _, _, width, height, xhot, yhot, _ = XCURSOR_IMAGE_HEADER.unpack_from(data, position)
+        if width > XCURSOR_MAX_IMAGE_SIZE or height > XCURSOR_MAX_IMAGE_SIZE:
+            raise ValueError("invalid image size %dx%d in %s" % (width, height, path))
+        start = position + XCURSOR_IMAGE_HEADER.size
+        pixels = array('I')
+        pixels.frombytes(data[start:start + width * height * 4])
+        if sys.byteorder == 'big':
+            pixels.byteswap()
+        result.append(CursorImage(width, height, xhot, yhot, pixels, 0))
+    return result
+
+
+def find_theme_cursors(theme, names, search_path=None):
+    """Finds cursor files of a theme, following the themes it inherits
+
+    Arguments:
+        theme {string} -- cursor theme name
+        names {[list of string]} -- cursor names to look up
+
+    Keyword Arguments:
+        search_path {string} -- colon separated icon directories (default: {XCURSOR_PATH})
+
+    Returns:
+        [list of string] -- existing cursor file paths, symlinks resolved and deduplicated
+    """
+    if search_path is None:
+        search_path = os.environ.get("XCURSOR_PATH", XCURSOR_DEFAULT_PATH)
+    dirs = [os.path.expanduser(d) for d in search_path.split(":") if d]
+
+    found = {}
+    visited = set()
+    pending = [theme]
+    while pending:
+        name = pending.pop(0)
+        if name in visited:
+            continue
+        visited.add(name)
+        for d in dirs:
+            theme_dir = os.path.join(d, name)
+            for cursor_name in names:
+                path = os.path.join(theme_dir, "cursors", cursor_name)
+                if cursor_name not in found and os.path.isfile(path):
+                    found[cursor_name] = os.path.realpath(path)
+            index = os.path.join(theme_dir, "index.theme")
+            if os.path.isfile(index):
+                pending.extend(_read_inherits(index))
+    return sorted(set(found.values()))
+
+
+def _read_inherits(index_path):
+    try:
+        with open(index_path, 'r', errors='replace') as f:
+            for line in f:
+                key, _, value = line.partition("=")
+                if key.strip() == "Inherits":
+                    return [t.strip() for t in value.split(",") if t.strip()]
+    except OSError as e:
+        logger.debug("failed to read %s: %s" % (index_path, e))
+    return []
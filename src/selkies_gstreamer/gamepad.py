@@ -3,11 +3,12 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 import asyncio
+import math
 import os
 import struct
 import socket
+import threading
 import time
-from queue import Queue
 from input_event_codes import *
 from signal import (
     signal,
@@ -116,6 +117,19 @@ MAX_AXES = 64
 ABS_MIN = -32767
 ABS_MAX = 32767
 
+# Axis values that are always sent when they change, so sticks settle on center and stops.
+AXIS_ENDPOINTS = (ABS_MIN, 0, ABS_MAX)
+
+# Default axis event filtering, see SelkiesGamepad.
+AXIS_DEADZONE = 0.05
+AXIS_THRESHOLD = 128
+AXIS_RATE_LIMIT = 0
+
+# Pending connections, games open every joystick device at once on launch.
+JS_LISTEN_BACKLOG = 16
+# Batches buffered per client, a client that falls this far behind is disconnected.
+JS_CLIENT_QUEUE_SIZE = 256
+
 # Joystick event struct
 # https://www.kernel.org/doc/Documentation/input/joystick-api.txt
 # struct js_event {
@@ -125,32 +139,21 @@ ABS_MAX = 32767
 #    __u8 number;    /* axis/button number */
 # };
 
-def get_btn_event(btn_num, btn_val):
-    ts = int((time.time() * 1000) % 1000000000)
+JS_EVENT_STRUCT = struct.Struct('IhBB')
 
-    # see js_event struct definition above.
-    # https://docs.python.org/3/library/struct.html
-    struct_format = 'IhBB'
-    event = struct.pack(struct_format, ts, btn_val,
-                        JS_EVENT_BUTTON, btn_num)
-
-    logger.debug(struct.unpack(struct_format, event))
 
-    return event
+def get_js_timestamp():
+    return int(time.time() * 1000) % 1000000000
 
 
-def get_axis_event(axis_num, axis_val):
-    ts = int((time.time() * 1000) % 1000000000)
-
+def get_btn_event(btn_num, btn_val):
     # see js_event struct definition above.
-    # https://docs.python.org/3/library/struct.html
-    struct_format = 'IhBB'
-    event = struct.pack(struct_format, ts, axis_val,
-                        JS_EVENT_AXIS, axis_num)
+    return JS_EVENT_STRUCT.pack(get_js_timestamp(), btn_val, JS_EVENT_BUTTON, btn_num)
 
-    logger.debug(struct.unpack(struct_format, event))
 
-    return event
+def get_axis_event(axis_num, axis_val):
+    # see js_event struct definition above.
+    return JS_EVENT_STRUCT.pack(get_js_timestamp(), axis_val, JS_EVENT_AXIS, axis_num)
 
 def detect_gamepad_config(name):
     # TODO switch mapping based on name.
@@ -167,17 +170,45 @@ def get_num_axes_for_mapping(cfg):
 
 
 def normalize_axis_val(val):
-    return round(ABS_MIN + ((val+1) * (ABS_MAX - ABS_MIN)) / 2)
+    # Clamped, browsers may report values slightly outside of [-1, 1].
+    return min(ABS_MAX, max(ABS_MIN, round(ABS_MIN + ((val+1) * (ABS_MAX - ABS_MIN)) / 2)))
 
 
 def normalize_trigger_val(val):
-    return round(val * (ABS_MAX - ABS_MIN)) + ABS_MIN
+    return min(ABS_MAX, max(ABS_MIN, round(val * (ABS_MAX - ABS_MIN)) + ABS_MIN))
+
+
+def normalize_btn_val(val):
+    return 1 if int(val) >= 1 else 0
 
 class SelkiesGamepad:
-    def __init__(self, socket_path, loop):
+    def __init__(self, socket_path, loop, axis_deadzone=(AXIS_DEADZONE,), axis_threshold=AXIS_THRESHOLD, axis_rate_limit=AXIS_RATE_LIMIT):
+        """Serves joystick events to the Selkies Joystick Interposer
+
+        Stick axis events are filtered before they are queued: values within
+        the deadzone are centered, changes smaller than the threshold are
+        dropped, and the rate limit keeps the latest value of an axis until it
+        can be sent.
+
+        Arguments:
+            socket_path {string} -- path of the interposer socket
+            loop {asyncio.AbstractEventLoop} -- loop that serves the socket
+
+        Keyword Arguments:
+            axis_deadzone {[list of float]} -- deadzone per input axis as a fraction of the range, a single value applies to all axes (default: {(AXIS_DEADZONE,)})
+            axis_threshold {integer} -- minimum change of an axis value in joystick units (default: {AXIS_THRESHOLD})
+            axis_rate_limit {float} -- maximum events per second per axis, 0 for no limit (default: {AXIS_RATE_LIMIT})
+        """
         self.socket_path = socket_path
         self.loop = loop
 
+        self.axis_deadzone = list(axis_deadzone)
+        self.axis_threshold = axis_threshold
+        self.axis_min_interval = 1.0 / axis_rate_limit if axis_rate_limit > 0 else 0.0
+        # Target axis -> [last sent value, last send time, held back event, flush scheduled]
+        self.axis_state = {}
+        self.axis_lock = threading.Lock()
+
         # Gamepad input mapper instance
         # created when calling set_config()
         self.mapper = None
@@ -189,14 +220,24 @@ class SelkiesGamepad:
         # Joystick config, set dynamically.
         self.config = None
 
-        # Map of client file descriptors to sockets.
+        # Map of client file descriptors to (socket, batch queue, writer task).
         self.clients = {}
+        # Clients receiving their configuration, not yet sent events.
+        self.setup_tasks = set()
 
-        # queue of events to send.
-        self.events = Queue()
+        # Queue of (enqueue time, js_event fields) to send, created on the loop by run_server().
+        self.events = None
+        # Batches of js_event structs are packed into this buffer, grown as needed.
+        self.send_buffer = bytearray(JS_EVENT_STRUCT.size * 64)
+        self.send_task = None
 
         # flag indicating that loop is running.
         self.running = False
+
+        # Called for every batch written to the clients, no-op unless metrics are enabled.
+        self.on_events_sent = lambda count, delay_ms: None
+        # Called for every axis event filtered out, reason is deadzone, threshold or rate.
+        self.on_event_suppressed = lambda reason: None
     
     def set_config(self, name, num_btns, num_axes):
         self.name = name
@@ -234,11 +275,34 @@ class SelkiesGamepad:
 
     async def __send_events(self):
         while self.running:
-            if self.events.empty():
-                await asyncio.sleep(0.001)
+            enqueued, event = await self.events.get()
+            # Everything queued meanwhile goes out in the same write.
+            size = (1 + self.events.qsize()) * JS_EVENT_STRUCT.size
+            if size > len(self.send_buffer):
+                self.send_buffer = bytearray(size)
+            count = 0
+            while True:
+                try:
+                    JS_EVENT_STRUCT.pack_into(self.send_buffer, count * JS_EVENT_STRUCT.size, *event)
+                    count += 1
+                except struct.error as e:
+                    # A bad event must not stop the sender for the rest of the session.
+                    logger.warning("dropping invalid js event %s: %s" % (event, e))
+                if self.events.empty():
+                    break
+                event = self.events.get_nowait()[1]
+            if count == 0:
                 continue
-            while self.running and not self.events.empty():
-                await self.send_event(self.events.get())
+            self.on_events_sent(count, (time.monotonic() - enqueued) * 1000)
+            # Clients are written to independently, each gets the same copy of the batch.
+            await self.send_event(bytes(memoryview(self.send_buffer)[:count * JS_EVENT_STRUCT.size]))
+
+    def __queue_event(self, event):
+        if self.events is None:
+            # The server is not running yet, there is no client to receive the event.
+            return
+        # Called from the input worker thread.
+        self.loop.call_soon_threadsafe(self.events.put_nowait, (time.monotonic(), event))
 
     def send_btn(self, btn_num, btn_val):
         if not self.mapper:
@@ -246,51 +310,141 @@ class SelkiesGamepad:
             return
         event = self.mapper.get_mapped_btn(btn_num, btn_val)
         if event is not None:
-            self.events.put(event)
+            self.__queue_event(event)
 
-    def send_axis(self, axis_num, axis_val):
+    def send_axis(self, axis_num, axis_val, force=False):
         if not self.mapper:
             logger.warning("failed to send js axis event because mapper was not set")
             return
+
+        if len(self.axis_deadzone) == 1:
+            deadzone = self.axis_deadzone[0]
+        else:
+            deadzone = self.axis_deadzone[axis_num] if 0 <= axis_num < len(self.axis_deadzone) else 0.0
+        in_deadzone = abs(axis_val) < deadzone
+        if in_deadzone:
+            axis_val = 0
+
         event = self.mapper.get_mapped_axis(axis_num, axis_val)
-        if event is not None:
-            self.events.put(event)
+        if event is None:
+            return
+
+        _, value, _, axis = event
+        now = time.monotonic()
+        with self.axis_lock:
+            state = self.axis_state.get(axis)
+            if state is None:
+                state = self.axis_state[axis] = [None, 0.0, None, False]
+
+            if not force:
+                # Compare with the value the client will end up with.
+                last = state[2][1] if state[2] is not None else state[0]
+                if last is not None and (value == last or (abs(value - last) < self.axis_threshold and value not in AXIS_ENDPOINTS)):
+                    self.on_event_suppressed("deadzone" if in_deadzone else "threshold")
+                    return
+
+                remaining = state[1] + self.axis_min_interval - now
+                if remaining > 0:
+                    # Hold back the latest value until the rate limit allows it.
+                    if state[2] is not None:
+                        self.on_event_suppressed("rate")
+                    state[2] = event
+                    if not state[3]:
+                        state[3] = True
+                        self.loop.call_soon_threadsafe(self.loop.call_later, remaining, self.__flush_axis, axis)
+                    return
+
+            if state[2] is not None:
+                # Superseded by this event.
+                self.on_event_suppressed("rate")
+                state[2] = None
+            state[0] = value
+            state[1] = now
+            self.__queue_event(event)
+
+    def __flush_axis(self, axis):
+        with self.axis_lock:
+            state = self.axis_state[axis]
+            state[3] = False
+            event, state[2] = state[2], None
+            if event is None:
+                return
+            state[0] = event[1]
+            state[1] = time.monotonic()
+            self.__queue_event((get_js_timestamp(),) + event[1:])
 
     async def send_event(self, event):
-        if len(self.clients) < 1:
-            return
+        """Queues event data for every connected client
+
+        Each client has its own writer, a slow client does not delay the others
+        and is disconnected once JS_CLIENT_QUEUE_SIZE batches are pending.
 
-        closed_clients = []
-        for fd in self.clients:
+        Arguments:
+            event {bytes} -- packed js_event structs
+        """
+        for fd, (client, queue, writer) in list(self.clients.items()):
             try:
-                client = self.clients[fd]
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                logger.warning("Client %d is not reading events, disconnecting" % fd)
+                writer.cancel()
+                del self.clients[fd]
+
+    async def __write_client(self, fd, client, queue):
+        try:
+            while True:
+                event = await queue.get()
                 logger.debug("Sending event to client with fd: %d" % fd)
                 await self.loop.sock_sendall(client, event)
-            except BrokenPipeError:
-                logger.info("Client %d disconnected" % fd)
-                closed_clients.append(fd)
-                client.close()
+        except (BrokenPipeError, ConnectionResetError):
+            logger.info("Client %d disconnected" % fd)
+        finally:
+            if fd in self.clients and self.clients[fd][0] is client:
+                del self.clients[fd]
+            client.close()
 
-        for fd in closed_clients:
-            del self.clients[fd]
+    async def __add_client(self, client):
+        fd = client.fileno()
+        # Send client the joystick configuration
+        try:
+            if not await self.setup_client(client):
+                return
+        except asyncio.CancelledError:
+            client.close()
+            raise
+        if not self.running:
+            client.close()
+            return
+
+        # Add client to dictionary to receive events.
+        queue = asyncio.Queue(maxsize=JS_CLIENT_QUEUE_SIZE)
+        writer = self.loop.create_task(self.__write_client(fd, client, queue))
+        self.clients[fd] = (client, queue, writer)
 
     async def setup_client(self, client):
+        """Sends the joystick configuration and initial state to a new client
+
+        Returns:
+            bool -- False if the client disconnected and was closed
+        """
         logger.info("Sending config to client with fd: %d" % client.fileno())
         try:
             config_data = self.__make_config()
             if not config_data:
-                return
+                return True
             await self.loop.sock_sendall(client, config_data)
             await asyncio.sleep(0.5)
             # Send zero values for all buttons and axis.
             for btn_num in range(len(self.config["btn_map"])):
                 self.send_btn(btn_num, 0)
             for axis_num in range(len(self.config["axes_map"])):
-                self.send_axis(axis_num, 0)
+                self.send_axis(axis_num, 0, force=True)
 
-        except BrokenPipeError:
+        except (BrokenPipeError, ConnectionResetError):
             client.close()
             logger.info("Client disconnected")
+            return False
+        return True
 
     async def run_server(self):
         try:
@@ -301,15 +455,15 @@ class SelkiesGamepad:
 
         self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self.server.bind(self.socket_path)
-        self.server.listen(1)
+        self.server.listen(JS_LISTEN_BACKLOG)
         self.server.setblocking(False)
 
         logger.info('Listening for connections on %s' % self.socket_path)
 
         # start loop to process event queue.
-        self.loop.create_task(self.__send_events())
-
+        self.events = asyncio.Queue()
         self.running = True
+        self.send_task = self.loop.create_task(self.__send_events())
         try:
             while self.running:
                 try:
@@ -317,15 +471,17 @@ class SelkiesGamepad:
                 except asyncio.TimeoutError:
                     continue
 
-                fd = client.fileno()
-                logger.info("Client connected with fd: %d" % fd)
+                logger.info("Client connected with fd: %d" % client.fileno())
 
-                # Send client the joystick configuration
-                await self.setup_client(client)
-
-                # Add client to dictionary to receive events.
-                self.clients[fd] = client
+                # Setup waits for the client to read its config, accept others meanwhile.
+                task = self.loop.create_task(self.__add_client(client))
+                self.setup_tasks.add(task)
+                task.add_done_callback(self.setup_tasks.discard)
         finally:
+            for task in list(self.setup_tasks):
+                task.cancel()
+            for client, _, writer in list(self.clients.values()):
+                writer.cancel()
             self.server.close()
             try:
                 os.unlink(self.socket_path)
@@ -336,6 +492,10 @@ class SelkiesGamepad:
 
     def stop_server(self):
         self.running = False
+        if self.send_task is not None:
+            # The sender waits on the queue, wake it up to exit.
+            self.loop.call_soon_threadsafe(self.send_task.cancel)
+            self.send_task = None
         self.server.close()
         try:
             os.unlink(self.socket_path)
@@ -344,52 +504,82 @@ class SelkiesGamepad:
 
 class GamepadMapper:
     def __init__(self, config, name, num_btns, num_axes):
+        """Maps browser gamepad buttons and axes to joystick events
+
+        The config is compiled into lookup tables indexed by the input button
+        and axis numbers, so mapping an event is a list lookup.
+
+        Arguments:
+            config {dict} -- joystick config, see STANDARD_XPAD_CONFIG
+            name {string} -- name reported by the browser
+            num_btns {integer} -- number of buttons reported by the browser
+            num_axes {integer} -- number of axes reported by the browser
+        """
         self.config = config
         self.input_name = name
         self.input_num_btns = num_btns
         self.input_num_axes = num_axes
-    
+
+        mapping = config["mapping"]
+        num_out_btns = len(config["btn_map"])
+        num_out_axes = len(config["axes_map"])
+
+        # Input button -> (event type, target number, normalizer), None if out of range.
+        size = max([num_btns, num_out_btns] + [b + 1 for b in mapping["btns"]] +
+                   [b + 1 for btns in mapping["axes_to_btn"].values() for b in btns])
+        self.btn_table = [None] * size
+        for btn_num in range(size):
+            mapped_btn = mapping["btns"].get(btn_num, btn_num)
+            if mapped_btn < num_out_btns:
+                self.btn_table[btn_num] = (JS_EVENT_BUTTON, mapped_btn, normalize_btn_val)
+        for axis_num, btns in mapping["axes_to_btn"].items():
+            for btn_num in btns:
+                if axis_num in mapping["trigger_axes"]:
+                    # Full range for input between 0 and 1.
+                    normalizer = normalize_trigger_val
+                elif len(btns) > 1 and btns[0] != btn_num:
+                    # Second button of a pair drives the negative half of the axis.
+                    normalizer = lambda val: normalize_axis_val(-val)
+                else:
+                    normalizer = normalize_axis_val
+                self.btn_table[btn_num] = (JS_EVENT_AXIS, axis_num, normalizer)
+
+        # Input axis -> target axis number, None if out of range.
+        size = max([num_axes, num_out_axes] + [a + 1 for a in mapping["axes"]])
+        self.axis_table = [None] * size
+        for axis_num in range(size):
+            mapped_axis = mapping["axes"].get(axis_num, axis_num)
+            if mapped_axis < num_out_axes:
+                self.axis_table[axis_num] = mapped_axis
+
     def get_mapped_btn(self, btn_num, btn_val):
         '''
-        return either a button or axis event based on mapping. 
+        return the js_event fields of either a button or axis event based on mapping.
         '''
-
-        # Check to see if button is mapped to an axis
-        axis_num = None
-        axis_sign = 1
-        for axis, mapping in self.config["mapping"]["axes_to_btn"].items():
-            if btn_num in mapping:
-                axis_num = axis
-                if len(mapping) > 1:
-                    axis_sign = 1 if mapping[0] == btn_num else -1
-                break
-
-        if axis_num is not None:
-            # Remap button to axis
-            # Normalize for input between -1 and 1
-            axis_val = normalize_axis_val(btn_val*axis_sign)
-
-            if axis_num in self.config["mapping"]["trigger_axes"]:
-                # Normalize to full range for input between 0 and 1.
-                axis_val = normalize_trigger_val(btn_val)
-            
-            return get_axis_event(axis_num, axis_val)
-
-        # Perform button mapping.
-        mapped_btn = self.config["mapping"]["btns"].get(btn_num, btn_num)
-        if mapped_btn >= len(self.config["btn_map"]):
+        entry = self.btn_table[btn_num] if 0 <= btn_num < len(self.btn_table) else None
+        if entry is None:
             logger.error("cannot send button num %d, max num buttons is %d" % (
-                mapped_btn, len(self.config["btn_map"]) - 1))
+                btn_num, len(self.config["btn_map"]) - 1))
             return None
-        
-        return get_btn_event(mapped_btn, int(btn_val))
+        if not math.isfinite(btn_val):
+            logger.warning("dropping button %d event with invalid value: %s" % (btn_num, btn_val))
+            return None
+
+        event_type, number, normalizer = entry
+        return (get_js_timestamp(), normalizer(btn_val), event_type, number)
 
     def get_mapped_axis(self, axis_num, axis_val):
-        mapped_axis = self.config["mapping"]["axes"].get(axis_num, axis_num)
-        if mapped_axis >= len(self.config["axes_map"]):
+        '''
+        return the js_event fields of an axis event.
+        '''
+        mapped_axis = self.axis_table[axis_num] if 0 <= axis_num < len(self.axis_table) else None
+        if mapped_axis is None:
             logger.error("cannot send axis %d, max axis num is %d" %
-                         (mapped_axis, len(self.config["axes_map"]) - 1))
+                         (axis_num, len(self.config["axes_map"]) - 1))
+            return None
+        if not math.isfinite(axis_val):
+            logger.warning("dropping axis %d event with invalid value: %s" % (axis_num, axis_val))
             return None
 
         # Normalize axis value to be within range.
-        return get_axis_event(mapped_axis, normalize_axis_val(axis_val))
+        return (get_js_timestamp(), normalize_axis_val(axis_val), JS_EVENT_AXIS, mapped_axis)
@@ -20,7 +20,6 @@
 #   limitations under the License.
 
 import GPUtil
-import time
 
 import logging
 logger = logging.getLogger("gpu_monitor")
@@ -32,18 +31,32 @@ class GPUMonitor:
         self.period = period
         self.enabled = enabled
         self.running = False
+        self.scheduler = None
+        self.gpu_id = 0
 
         self.on_stats = lambda load, memoryTotal, memoryUsed: logger.warn(
             "unhandled on_stats")
 
-    def start(self, gpu_id=0):
+    def start(self, scheduler, gpu_id=0):
+        """Polls the GPU stats as a blocking periodic scheduler job
+
+        Arguments:
+            scheduler {PeriodicScheduler} -- scheduler that runs the job
+            gpu_id {integer} -- index of the GPU to monitor
+        """
+        if not self.enabled:
+            return
+        self.gpu_id = gpu_id
+        self.scheduler = scheduler
         self.running = True
-        while self.running:
-            if self.enabled and int(time.time()) % self.period == 0:
-                gpu = GPUtil.getGPUs()[gpu_id]
-                self.on_stats(gpu.load, gpu.memoryTotal, gpu.memoryUsed)
-            time.sleep(0.5)
-        logger.info("GPU monitor stopped")
+        scheduler.add_job("gpu_monitor", self.period, self.update, blocking=True, jitter=0.5)
+
+    def update(self):
+        gpu = GPUtil.getGPUs()[self.gpu_id]
+        self.on_stats(gpu.load, gpu.memoryTotal, gpu.memoryUsed)
 
     def stop(self):
+        if self.running:
+            self.scheduler.remove_job("gpu_monitor")
+            logger.info("GPU monitor stopped")
         self.running = False
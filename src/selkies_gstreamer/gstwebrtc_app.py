@@ -25,20 +25,36 @@ import json
 import logging
 import os
 import re
+import struct
 import sys
+import threading
 import time
 
 logger = logging.getLogger("gstwebrtc_app")
 logger.setLevel(logging.INFO)
 
+# Binary messages to the client, <u8 version><u8 type><payload> with
+# little-endian payloads, sent once the client accepted input protocol 2.
+DATA_PROTOCOL_VERSION = 2
+DATA_FRAME_HEADER = struct.Struct('<BB')
+DATA_FRAME_CURSOR = 1
+# handle, hotspot x, hotspot y, width, height, flags, followed by the PNG
+# image, no image when the client has the handle cached.
+DATA_CURSOR_STRUCT = struct.Struct('<IhhHHB')
+DATA_CURSOR_FLAG_HIDDEN = 0x01
+
+# on-buffered-amount-low of the clipboard channel fires below this many queued bytes.
+CLIPBOARD_BUFFERED_AMOUNT_LOW = 64 * 1024
+
 try:
     import gi
     gi.require_version('GLib', "2.0")
+    gi.require_version('GObject', "2.0")
     gi.require_version('Gst', "1.0")
     gi.require_version('GstRtp', "1.0")
     gi.require_version('GstSdp', "1.0")
     gi.require_version('GstWebRTC', "1.0")
-    from gi.repository import GLib, Gst, GstRtp, GstSdp, GstWebRTC
+    from gi.repository import GLib, GObject, Gst, GstRtp, GstSdp, GstWebRTC
     fract = Gst.Fraction(60, 1)
     del fract
 except Exception as e:
@@ -65,6 +81,9 @@ class GSTWebRTCAppError(Exception):
     pass
 
 class GSTWebRTCApp:
+    # Encoder and congestion control combinations that passed check_plugins.
+    checked_plugins = set()
+
     def __init__(self, stun_servers=None, turn_servers=None, audio_channels=2, framerate=30, encoder=None, gpu_id=0, video_bitrate=2000, audio_bitrate=96000, keyframe_distance=-1.0, congestion_control=False, video_packetloss_percent=0.0, audio_packetloss_percent=0.0):
         """Initialize GStreamer WebRTC app.
 
@@ -83,6 +102,7 @@ class GSTWebRTCApp:
         self.pipeline = None
         self.webrtcbin = None
         self.data_channel = None
+        self.clipboard_channel = None
         self.rtpgccbwe = None
         self.congestion_control = congestion_control
         self.encoder = encoder
@@ -115,20 +135,51 @@ class GSTWebRTCApp:
             'unhandled ice event')
         self.on_sdp = lambda sdp_type, sdp: logger.warn('unhandled sdp event')
 
+        # Event loop that runs the on_ice and on_sdp coroutines, set by the caller.
+        self.loop = None
+
+        # ICE candidates gathered on streaming threads waiting to be sent.
+        self.pending_ice = []
+        self.pending_ice_lock = threading.Lock()
+
         # Data channel events
         self.on_data_open = lambda: logger.warn('unhandled on_data_open')
         self.on_data_close = lambda: logger.warn('unhandled on_data_close')
         self.on_data_error = lambda: logger.warn('unhandled on_data_error')
         self.on_data_message = lambda msg: logger.warn(
             'unhandled on_data_message')
-
-        Gst.init(None)
-
-        self.check_plugins()
+        self.on_data_binary_message = lambda data: logger.warn(
+            'unhandled on_data_binary_message')
+
+        # Clipboard data channel events
+        self.on_clipboard_open = lambda: logger.warn('unhandled on_clipboard_open')
+        self.on_clipboard_close = lambda: logger.warn('unhandled on_clipboard_close')
+        self.on_clipboard_buffered_amount_low = lambda: None
+        self.on_clipboard_message = lambda msg: logger.warn(
+            'unhandled on_clipboard_message')
+        self.on_clipboard_binary_message = lambda data: logger.warn(
+            'unhandled on_clipboard_binary_message')
+
+        # GStreamer and the plugin registry only need to be set up once per process.
+        if not Gst.is_initialized():
+            Gst.init(None)
+
+        if (self.encoder, self.congestion_control) not in GSTWebRTCApp.checked_plugins:
+            self.check_plugins()
+            GSTWebRTCApp.checked_plugins.add((self.encoder, self.congestion_control))
 
         self.ximagesrc = None
         self.ximagesrc_caps = None
         self.last_cursor_sent = None
+        # Cursor handles sent on the current data channel.
+        self.cursors_sent = set()
+        # Binary protocol version accepted by the client on the current data channel.
+        self.client_data_protocol = 0
+
+        # Set when a pipeline is started, cleared when it is stopped.
+        self.pipeline_started = asyncio.Event()
+        # Resolved when bus handling of the current pipeline ends, see handle_bus_calls().
+        self.bus_done = None
 
     def stop_ximagesrc(self):
         """Helper function to stop the ximagesrc, useful when resizing
@@ -1378,10 +1429,73 @@ class GSTWebRTCApp:
         else:
             logger.warning("clipboard may not be sent to the client because the base64 message length {} is above the maximum length of {}".format(clipboard_length, CLIPBOARD_RESTRICTION))
 
+    def send_clipboard_string(self, msg):
+        """Sends a string message to the clipboard data channel
+
+        Arguments:
+            msg {string} -- serialized clipboard protocol message
+        """
+        if not self.is_clipboard_channel_ready():
+            logger.debug("skipping message because clipboard channel is not ready")
+            return
+        self.clipboard_channel.emit("send-string", msg)
+
+    def send_clipboard_chunk(self, data):
+        """Sends a binary message to the clipboard data channel
+
+        Arguments:
+            data {bytes} -- clipboard chunk
+        """
+        if not self.is_clipboard_channel_ready():
+            logger.debug("skipping chunk because clipboard channel is not ready")
+            return
+        self.clipboard_channel.emit("send-data", GLib.Bytes.new(data))
+
+    def get_clipboard_buffered_amount(self):
+        """Returns the bytes queued on the clipboard data channel, 0 when it is not open
+        """
+        if not self.is_clipboard_channel_ready():
+            return 0
+        return self.clipboard_channel.get_property("buffered-amount")
+
     def send_cursor_data(self, data):
+        """Sends a cursor to the data channel
+
+        Clients that accepted the binary protocol get a binary frame with the
+        raw PNG, others a JSON message with the PNG in base64. The image is
+        left out when it was sent on this data channel before.
+
+        Arguments:
+            data {dict} -- cursor message from WebRTCInput.cursor_to_msg, or None
+        """
         self.last_cursor_sent = data
-        self.__send_data_channel_message(
-            "cursor", data)
+        if data is None:
+            self.__send_data_channel_message("cursor", None)
+            return
+        if not self.is_data_channel_ready():
+            logger.debug("skipping cursor because data channel is not ready")
+            return
+
+        png = data["png"]
+        if data["handle"] in self.cursors_sent:
+            # The client has cached the image, only the handle is sent.
+            png = b""
+        else:
+            self.cursors_sent.add(data["handle"])
+
+        if self.client_data_protocol >= DATA_PROTOCOL_VERSION:
+            flags = DATA_CURSOR_FLAG_HIDDEN if data["override"] == "none" else 0
+            header = DATA_FRAME_HEADER.pack(DATA_PROTOCOL_VERSION, DATA_FRAME_CURSOR) + DATA_CURSOR_STRUCT.pack(
+                data["handle"], data["hotspot"]["x"], data["hotspot"]["y"], data["width"], data["height"], flags)
+            self.data_channel.emit("send-data", GLib.Bytes.new(header + png))
+            return
+
+        self.__send_data_channel_message("cursor", {
+            "curdata": base64.b64encode(png).decode(),
+            "handle": data["handle"],
+            "override": data["override"],
+            "hotspot": data["hotspot"],
+        })
 
     def send_gpu_stats(self, load, memory_total, memory_used):
         """Sends GPU stats to the data channel
@@ -1405,6 +1519,20 @@ class GSTWebRTCApp:
         self.__send_data_channel_message(
             "system", {"action": "reload"})
 
+    def send_input_protocol(self, version):
+        """Announces the binary input protocol version to the data channel
+        """
+        logger.info("sending input protocol version")
+        self.__send_data_channel_message(
+            "system", {"action": "input_protocol,"+str(version)})
+
+    def send_input_timestamps(self, enabled):
+        """Asks the client to append its send time to binary input frames
+        """
+        logger.info("sending input timestamps setting")
+        self.__send_data_channel_message(
+            "system", {"action": "input_timestamps,"+str(int(enabled))})
+
     def send_framerate(self, framerate):
         """Sends the current framerate to the data channel
         """
@@ -1477,6 +1605,14 @@ class GSTWebRTCApp:
         """
         return self.data_channel and self.data_channel.get_property("ready-state") == GstWebRTC.WebRTCDataChannelState.OPEN
 
+    def is_clipboard_channel_ready(self):
+        """Checks to see if the clipboard data channel is open.
+
+        Returns:
+            [bool] -- true if clipboard data channel is open
+        """
+        return self.clipboard_channel and self.clipboard_channel.get_property("ready-state") == GstWebRTC.WebRTCDataChannelState.OPEN
+
     def __send_data_channel_message(self, msg_type, data):
         """Sends message to the peer through the data channel
 
@@ -1510,10 +1646,6 @@ class GSTWebRTCApp:
         promise.wait()
         reply = promise.get_reply()
         offer = reply.get_value('offer')
-        promise = Gst.Promise.new()
-        self.webrtcbin.emit('set-local-description', offer, promise)
-        promise.interrupt()
-        loop = asyncio.new_event_loop()
         sdp_text = offer.sdp.as_text()
         # rtx-time needs to be set to 125 milliseconds for optimal performance
         if 'rtx-time' not in sdp_text:
@@ -1549,8 +1681,12 @@ class GSTWebRTCApp:
         if "opus/" in sdp_text.lower():
             # OPUS_FRAME: Add ptime explicitly to SDP offer
             sdp_text = re.sub(r'([^-]sprop-[^\r\n]+)', r'\1\r\na=ptime:10', sdp_text)
-        # Set final SDP offer
-        loop.run_until_complete(self.on_sdp('offer', sdp_text))
+        # Set final SDP offer, queued before set-local-description starts
+        # ICE gathering so the offer reaches the peer ahead of any candidate.
+        self.__run_on_loop(self.on_sdp('offer', sdp_text))
+        promise = Gst.Promise.new()
+        self.webrtcbin.emit('set-local-description', offer, promise)
+        promise.interrupt()
 
     def __request_aux_sender_gcc(self, webrtcbin, dtls_transport):
         """Handles request-aux-header signal, initializing the rtpgccbwe element for WebRTC
@@ -1643,14 +1779,51 @@ class GSTWebRTCApp:
     def __send_ice(self, webrtcbin, mlineindex, candidate):
         """Handles on-ice-candidate signal, generates on_ice event
 
+        Candidates are queued and sent in order by a single flush on the
+        event loop, so a burst of trickled candidates costs one loop wakeup.
+
         Arguments:
             webrtcbin {GstWebRTCBin gobject} -- webrtcbin gobject
             mlineindex {integer} -- ice candidate mlineindex
             candidate {string} -- ice candidate string
         """
         logger.debug("received ICE candidate: %d %s", mlineindex, candidate)
-        loop = asyncio.new_event_loop()
-        loop.run_until_complete(self.on_ice(mlineindex, candidate))
+        with self.pending_ice_lock:
+            self.pending_ice.append((mlineindex, candidate))
+            if len(self.pending_ice) > 1:
+                # A flush is already scheduled and will pick this one up.
+                return
+        self.__run_on_loop(self.__flush_ice())
+
+    async def __flush_ice(self):
+        """Sends all queued ICE candidates to the on_ice handler
+        """
+        with self.pending_ice_lock:
+            candidates = self.pending_ice
+            self.pending_ice = []
+        logger.debug("sending batch of %d ICE candidates", len(candidates))
+        for mlineindex, candidate in candidates:
+            await self.on_ice(mlineindex, candidate)
+
+    def __run_on_loop(self, coro):
+        """Schedules a coroutine on the event loop from a GStreamer thread
+
+        Arguments:
+            coro {coroutine} -- coroutine to run on self.loop
+        """
+        if self.loop is None or self.loop.is_closed():
+            logger.error("dropping signalling message because the event loop is not set")
+            coro.close()
+            return
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self.__on_loop_coroutine_done)
+
+    def __on_loop_coroutine_done(self, future):
+        if future.cancelled():
+            return
+        e = future.exception()
+        if e is not None:
+            logger.error("error sending signalling message: %s" % e)
 
     def bus_call(self, message):
         t = message.type
@@ -1700,38 +1873,111 @@ class GSTWebRTCApp:
             # Create the data channel, this has to be done after the pipeline is PLAYING.
             options = Gst.Structure("application/data-channel")
             options.set_value("ordered", True)
-            options.set_value("priority", "high")
+            # webrtcbin reads the priority as a GstWebRTCPriorityType enum, strings are ignored.
+            options.set_value("priority", GObject.Value(
+                GstWebRTC.WebRTCPriorityType, GstWebRTC.WebRTCPriorityType.HIGH))
             options.set_value("max-retransmits", 0)
             self.data_channel = self.webrtcbin.emit(
                 'create-data-channel', "input", options)
+            self.cursors_sent = set()
+            self.client_data_protocol = 0
             self.data_channel.connect('on-open', lambda _: self.on_data_open())
             self.data_channel.connect('on-close', lambda _: self.on_data_close())
             self.data_channel.connect('on-error', lambda _: self.on_data_error())
             self.data_channel.connect(
                 'on-message-string', lambda _, msg: self.on_data_message(msg))
+            self.data_channel.connect(
+                'on-message-data', lambda _, data: self.on_data_binary_message(data.get_data()))
 
+            # Clipboard transfers are reliable and low priority, senders pace their
+            # chunks on the buffered amount so input events are not queued behind them.
+            options = Gst.Structure("application/data-channel")
+            options.set_value("ordered", True)
+            options.set_value("priority", GObject.Value(
+                GstWebRTC.WebRTCPriorityType, GstWebRTC.WebRTCPriorityType.LOW))
+            self.clipboard_channel = self.webrtcbin.emit(
+                'create-data-channel', "clipboard", options)
+            self.clipboard_channel.set_property("buffered-amount-low-threshold", CLIPBOARD_BUFFERED_AMOUNT_LOW)
+            self.clipboard_channel.connect('on-open', lambda _: self.on_clipboard_open())
+            self.clipboard_channel.connect(
+                'on-buffered-amount-low', lambda _: self.on_clipboard_buffered_amount_low())
+            self.clipboard_channel.connect('on-close', lambda _: self.on_clipboard_close())
+            self.clipboard_channel.connect(
+                'on-message-string', lambda _, msg: self.on_clipboard_message(msg))
+            self.clipboard_channel.connect(
+                'on-message-data', lambda _, data: self.on_clipboard_binary_message(data.get_data()))
+
+        self.pipeline_started.set()
         logger.info("{} pipeline started".format("audio" if audio_only else "video"))
 
     async def handle_bus_calls(self):
-        # Start bus call loop
-        running = True
-        bus = None
-        while running:
-            if self.pipeline is not None:
-                bus = self.pipeline.get_bus()
-            if bus is not None:
-                while bus.have_pending():
-                    msg = bus.pop()
+        """Dispatches bus messages of each started pipeline to bus_call.
+
+        The bus poll file descriptor is registered as a reader on the asyncio
+        loop, so messages are handled as soon as they are posted and the loop
+        stays idle while the bus is empty. Handling of a pipeline ends on EOS,
+        errors or when stop_pipeline() is called. Runs until cancelled.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            await self.pipeline_started.wait()
+            pipeline = self.pipeline
+            if pipeline is None:
+                self.pipeline_started.clear()
+                continue
+
+            bus = pipeline.get_bus()
+            bus_fd = bus.get_pollfd().fd
+            bus_done = loop.create_future()
+            self.bus_done = bus_done
+
+            def on_bus_readable():
+                # Popping a message consumes its wakeup on the poll fd.
+                msg = bus.pop()
+                while msg is not None:
                     if not self.bus_call(msg):
-                        running = False
-            await asyncio.sleep(0.1)
+                        if not bus_done.done():
+                            bus_done.set_result(None)
+                        return
+                    msg = bus.pop()
+
+            loop.add_reader(bus_fd, on_bus_readable)
+            try:
+                # Messages posted before the reader was added are pending already.
+                on_bus_readable()
+                await bus_done
+            finally:
+                loop.remove_reader(bus_fd)
+                if self.bus_done is bus_done:
+                    self.bus_done = None
+
+            # Wait for the next pipeline unless it has already been restarted.
+            if self.pipeline is pipeline or self.pipeline is None:
+                self.pipeline_started.clear()
+            logger.info("stopped bus message handling")
+
+    def __end_bus_wait(self, bus_done):
+        if not bus_done.done():
+            bus_done.set_result(None)
 
     def stop_pipeline(self):
         logger.info("stopping pipeline")
+        with self.pending_ice_lock:
+            self.pending_ice = []
         if self.data_channel:
             self.data_channel.emit('close')
             self.data_channel = None
             logger.info("data channel closed")
+        if self.clipboard_channel:
+            self.clipboard_channel.emit('close')
+            self.clipboard_channel = None
+            logger.info("clipboard channel closed")
+        if self.bus_done is not None:
+            # The bus is flushed when the pipeline goes to NULL, its state change
+            # messages never reach bus_call, so end the wait here.
+            bus_done = self.bus_done
+            self.bus_done = None
+            bus_done.get_loop().call_soon_threadsafe(self.__end_bus_wait, bus_done)
         if self.pipeline:
             logger.info("setting pipeline state to NULL")
             self.pipeline.set_state(Gst.State.NULL)
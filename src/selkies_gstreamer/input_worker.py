@@ -0,0 +1,168 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import collections
+import concurrent.futures
+import struct
+import threading
+import time
+
+import logging
+logger = logging.getLogger("input_worker")
+logger.setLevel(logging.INFO)
+
+# Fast lane queue bound, superseded motion is discarded when full. Other events
+# are never dropped, the queue grows past the bound instead.
+INPUT_QUEUE_MAX_DEPTH = 256
+# Superseded motion older than this in seconds is discarded when dequeued.
+INPUT_MOTION_MAX_AGE = 0.1
+
+LANE_FAST = "fast"
+LANE_SLOW = "slow"
+
+
+class InputWorker:
+    def __init__(self, max_depth=INPUT_QUEUE_MAX_DEPTH, max_motion_age=INPUT_MOTION_MAX_AGE):
+        """Runs input handlers off the data channel thread
+
+        The fast lane is a dedicated thread with a bounded queue for mouse,
+        keyboard and gamepad events. The slow lane is a single worker executor
+        for clipboard, resize and configuration commands, so a slow subprocess
+        or file write never delays pointer and key injection. Both lanes keep
+        the order of their own events.
+
+        Droppable motion is superseded when the event queued right behind it is
+        droppable motion too, only superseded motion is ever discarded so key,
+        button and the last motion before them always reach the desktop.
+
+        Keyword Arguments:
+            max_depth {integer} -- maximum number of queued fast lane events (default: {INPUT_QUEUE_MAX_DEPTH})
+            max_motion_age {float} -- seconds after which droppable motion is stale (default: {INPUT_MOTION_MAX_AGE})
+        """
+
+        self.max_depth = max_depth
+        self.max_motion_age = max_motion_age
+
+        # Fast lane entries: (enqueue time, command, func, args, droppable)
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.thread = None
+
+        self.slow_executor = None
+        self.slow_depth = 0
+        self.slow_lock = threading.Lock()
+
+        self.running = False
+
+        self.on_timing = lambda command, duration_ms: None
+        self.on_latency = lambda command, latency_ms: None
+        self.on_queue = lambda lane, depth, age_ms: None
+        self.on_dropped = lambda reason: None
+
+    def start(self):
+        self.running = True
+        self.slow_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="input-slow")
+        self.thread = threading.Thread(target=self.__run, name="input-fast", daemon=True)
+        self.thread.start()
+        logger.info("input worker started")
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.queue.clear()
+            self.cond.notify()
+        if self.slow_executor is not None:
+            self.slow_executor.shutdown(wait=False)
+            self.slow_executor = None
+        logger.info("input worker stopped")
+
+    def submit(self, command, func, args, droppable=False):
+        """Queues an event on the fast lane, runs it inline when the worker is not started
+
+        Arguments:
+            command {string} -- command name, used in metrics
+            func {callable} -- handler
+            args {tuple} -- handler arguments
+
+        Keyword Arguments:
+            droppable {bool} -- the event may be discarded once later droppable motion is queued behind it (default: {False})
+        """
+        if not self.running:
+            self.__call(time.monotonic(), command, func, args)
+            return
+
+        with self.cond:
+            if len(self.queue) >= self.max_depth:
+                self.__drop_one_locked(droppable)
+            self.queue.append((time.monotonic(), command, func, args, droppable))
+            self.cond.notify()
+
+    def submit_slow(self, command, func, args):
+        """Runs a handler on the slow lane, inline when the worker is not started
+        """
+        if not self.running:
+            self.__call(time.monotonic(), command, func, args)
+            return
+
+        with self.slow_lock:
+            self.slow_depth += 1
+        self.slow_executor.submit(self.__run_slow, time.monotonic(), command, func, args)
+
+    def __drop_one_locked(self, next_droppable):
+        # Discards the oldest superseded motion, next_droppable is the event being queued.
+        entries = iter(self.queue)
+        previous = next(entries)
+        for i, entry in enumerate(entries):
+            if previous[4] and entry[4]:
+                del self.queue[i]
+                self.on_dropped("stale")
+                return
+            previous = entry
+        if previous[4] and next_droppable:
+            self.queue.pop()
+            self.on_dropped("stale")
+            return
+        if len(self.queue) == self.max_depth:
+            logger.warning("input queue full without superseded motion, growing past %d events" % self.max_depth)
+
+    def __run(self):
+        while True:
+            with self.cond:
+                while self.running and not self.queue:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                enqueued, command, func, args, droppable = self.queue.popleft()
+                depth = len(self.queue)
+                superseded = droppable and depth > 0 and self.queue[0][4]
+
+            age = time.monotonic() - enqueued
+            self.on_queue(LANE_FAST, depth, age * 1000)
+            if superseded and age > self.max_motion_age:
+                self.on_dropped("stale")
+                continue
+            self.__call(enqueued, command, func, args)
+
+    def __run_slow(self, enqueued, command, func, args):
+        with self.slow_lock:
+            self.slow_depth -= 1
+            depth = self.slow_depth
+        self.on_queue(LANE_SLOW, depth, (time.monotonic() - enqueued) * 1000)
+        self.__call(enqueued, command, func, args)
+
+    def __call(self, enqueued, command, func, args):
+        start = time.perf_counter()
+        try:
+            func(*args)
+        except (IndexError, ValueError, struct.error) as e:
+            self.on_dropped("malformed")
+            logger.debug('malformed input message %s: %s' % (command, e))
+            return
+        except Exception as e:
+            logger.error('input handler for %s failed: %s' % (command, e))
+            return
+        self.on_timing(command, (time.perf_counter() - start) * 1000)
+        # Receive to inject, includes the time spent in the queue.
+        self.on_latency(command, (time.monotonic() - enqueued) * 1000)
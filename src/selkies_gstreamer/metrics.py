@@ -20,7 +20,7 @@
 #   limitations under the License.
 
 from prometheus_client import start_http_server, Summary
-from prometheus_client import Gauge, Histogram, Info
+from prometheus_client import Counter, Gauge, Histogram, Info
 from datetime import datetime
 import csv
 import json
@@ -34,6 +34,13 @@ logger = logging.getLogger("metrics")
 logger.setLevel(logging.INFO)
 
 FPS_HIST_BUCKETS = (0, 20, 40, 60)
+SCHEDULER_HIST_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+INPUT_HANDLER_HIST_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 50)
+INPUT_QUEUE_AGE_HIST_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 50, 100, 500)
+INPUT_LATENCY_HIST_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+MOUSE_COALESCED_HIST_BUCKETS = (1, 2, 4, 8, 16, 32)
+MOUSE_LAG_HIST_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50)
+GAMEPAD_QUEUE_DELAY_HIST_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 50)
 
 class Metrics:
     def __init__(self, port=8000, using_webrtc_csv=False):
@@ -44,6 +51,20 @@ class Metrics:
         self.gpu_utilization = Gauge('gpu_utilization', 'Utilization percentage reported by GPU')
         self.latency = Gauge('latency', 'Latency observed by client')
         self.webrtc_statistics = Info('webrtc_statistics', 'WebRTC Statistics from the client')
+        self.scheduler_job_duration = Histogram('scheduler_job_duration', 'Run time of periodic jobs in milliseconds', ['job'], buckets=SCHEDULER_HIST_BUCKETS)
+        self.scheduler_job_lateness = Histogram('scheduler_job_lateness', 'Delay between the scheduled and actual start of periodic jobs in milliseconds', ['job'], buckets=SCHEDULER_HIST_BUCKETS)
+        self.input_messages = Counter('input_messages', 'Input data channel messages handled', ['command'])
+        self.input_messages_dropped = Counter('input_messages_dropped', 'Input data channel messages dropped', ['reason'])
+        self.input_handler_duration = Histogram('input_handler_duration', 'Run time of input message handlers in milliseconds', ['command'], buckets=INPUT_HANDLER_HIST_BUCKETS)
+        self.input_queue_depth = Gauge('input_queue_depth', 'Input events waiting in the input worker lane', ['lane'])
+        self.input_queue_age = Histogram('input_queue_age', 'Time input events waited in the input worker lane in milliseconds', ['lane'], buckets=INPUT_QUEUE_AGE_HIST_BUCKETS)
+        self.input_network_latency = Histogram('input_network_latency', 'Client send to server receive time of input events in milliseconds, from client timestamps', ['command'], buckets=INPUT_LATENCY_HIST_BUCKETS)
+        self.input_inject_latency = Histogram('input_inject_latency', 'Server receive to inject time of input events in milliseconds', ['command'], buckets=INPUT_LATENCY_HIST_BUCKETS)
+        self.mouse_motion_coalesced = Histogram('mouse_motion_coalesced', 'Pointer motion events merged into one injection, sum/count is the coalescing ratio', buckets=MOUSE_COALESCED_HIST_BUCKETS)
+        self.mouse_injection_lag = Histogram('mouse_injection_lag', 'Delay between receiving and injecting pointer motion in milliseconds', buckets=MOUSE_LAG_HIST_BUCKETS)
+        self.gamepad_events = Counter('gamepad_events', 'Joystick events written to the gamepad interposer sockets', ['js'])
+        self.gamepad_events_suppressed = Counter('gamepad_events_suppressed', 'Joystick axis events filtered out before the gamepad interposer sockets', ['js', 'reason'])
+        self.gamepad_queue_delay = Histogram('gamepad_queue_delay', 'Time the oldest joystick event of a batched write waited in the queue in milliseconds', ['js'], buckets=GAMEPAD_QUEUE_DELAY_HIST_BUCKETS)
         self.using_webrtc_csv = using_webrtc_csv
         self.stats_video_file_path = None
         self.stats_audio_file_path = None
@@ -60,6 +81,38 @@ class Metrics:
     def set_latency(self, latency_ms):
         self.latency.set(latency_ms)
 
+    def set_scheduler_job_timing(self, job, duration_ms, lateness_ms):
+        self.scheduler_job_duration.labels(job=job).observe(duration_ms)
+        self.scheduler_job_lateness.labels(job=job).observe(lateness_ms)
+
+    def set_input_message_timing(self, command, duration_ms):
+        self.input_messages.labels(command=command).inc()
+        self.input_handler_duration.labels(command=command).observe(duration_ms)
+
+    def inc_input_message_dropped(self, reason):
+        self.input_messages_dropped.labels(reason=reason).inc()
+
+    def set_input_queue(self, lane, depth, age_ms):
+        self.input_queue_depth.labels(lane=lane).set(depth)
+        self.input_queue_age.labels(lane=lane).observe(age_ms)
+
+    def set_input_network_latency(self, command, latency_ms):
+        self.input_network_latency.labels(command=command).observe(latency_ms)
+
+    def set_input_inject_latency(self, command, latency_ms):
+        self.input_inject_latency.labels(command=command).observe(latency_ms)
+
+    def set_mouse_motion_flush(self, count, lag_ms):
+        self.mouse_motion_coalesced.observe(count)
+        self.mouse_injection_lag.observe(lag_ms)
+
+    def set_gamepad_events(self, js_num, count, delay_ms):
+        self.gamepad_events.labels(js=str(js_num)).inc(count)
+        self.gamepad_queue_delay.labels(js=str(js_num)).observe(delay_ms)
+
+    def inc_gamepad_event_suppressed(self, js_num, reason):
+        self.gamepad_events_suppressed.labels(js=str(js_num), reason=reason).inc()
+
     def start_http(self):
         start_http_server(self.port)
 
@@ -0,0 +1,150 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import concurrent.futures
+import random
+import time
+
+import logging
+logger = logging.getLogger("scheduler")
+logger.setLevel(logging.INFO)
+
+
+class PeriodicSchedulerError(Exception):
+    pass
+
+
+class PeriodicJob:
+    def __init__(self, name, period, func, blocking=False):
+        self.name = name
+        self.period = period
+        self.func = func
+        self.blocking = blocking
+
+        # Loop time of the next run and the timer handle that fires it.
+        self.deadline = None
+        self.handle = None
+
+        # True while a blocking run is executing in the pool.
+        self.in_flight = False
+
+        self.runs = 0
+        self.skipped = 0
+        self.last_duration_ms = 0.0
+        self.max_lateness_ms = 0.0
+
+
+class PeriodicScheduler:
+    def __init__(self, loop, max_workers=4):
+        """Runs periodic jobs from the asyncio event loop
+
+        Jobs are fired at absolute deadlines on the loop clock, so the cadence
+        does not drift with the run time of the job. Blocking jobs run in a
+        dedicated bounded thread pool and a tick is skipped rather than queued
+        when the previous run of the same job has not finished yet.
+
+        Arguments:
+            loop {asyncio.AbstractEventLoop} -- loop that fires the jobs
+            max_workers {integer} -- number of threads for blocking jobs
+        """
+
+        self.loop = loop
+        self.jobs = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="scheduler")
+
+        self.on_job_timing = lambda name, duration_ms, lateness_ms: logger.debug(
+            "job %s ran for %.2fms, started %.2fms late" % (name, duration_ms, lateness_ms))
+
+    def add_job(self, name, period, func, blocking=False, delay=0.0, jitter=0.0):
+        """Adds a job that is called every period seconds
+
+        Arguments:
+            name {string} -- unique job name, used in logs and metrics
+            period {float} -- interval between runs in seconds
+            func {callable} -- function called without arguments
+
+        Keyword Arguments:
+            blocking {bool} -- run func in the thread pool instead of the loop (default: {False})
+            delay {float} -- seconds before the first run (default: {0.0})
+            jitter {float} -- random fraction of the period added to the first run,
+                              spreads jobs that share a period (default: {0.0})
+
+        Returns:
+            PeriodicJob -- the scheduled job
+        """
+        if name in self.jobs:
+            raise PeriodicSchedulerError("job already scheduled: %s" % name)
+        if period <= 0:
+            raise PeriodicSchedulerError("invalid period for job %s: %s" % (name, period))
+
+        job = PeriodicJob(name, period, func, blocking)
+        job.deadline = self.loop.time() + delay + random.uniform(0, jitter * period)
+        job.handle = self.loop.call_at(job.deadline, self.__run, job)
+        self.jobs[name] = job
+        logger.info("scheduled job %s every %ss" % (name, period))
+        return job
+
+    def remove_job(self, name):
+        """Cancels future runs of a job, a run in progress is not interrupted
+
+        Arguments:
+            name {string} -- name of the job
+        """
+        job = self.jobs.pop(name, None)
+        if job is not None:
+            job.handle.cancel()
+            logger.info("removed job %s after %d runs, %d skipped" % (name, job.runs, job.skipped))
+
+    def stop(self):
+        """Cancels all jobs and releases the thread pool
+        """
+        for name in list(self.jobs):
+            self.remove_job(name)
+        self.executor.shutdown(wait=False)
+
+    def __schedule_next(self, job, now):
+        job.deadline += job.period
+        if job.deadline <= now:
+            # Keep the cadence when the loop was stalled, skip missed ticks.
+            missed = int((now - job.deadline) // job.period) + 1
+            job.deadline += missed * job.period
+            job.skipped += missed
+        job.handle = self.loop.call_at(job.deadline, self.__run, job)
+
+    def __run(self, job):
+        now = self.loop.time()
+        lateness_ms = max(0.0, (now - job.deadline) * 1000)
+        self.__schedule_next(job, now)
+
+        if job.in_flight:
+            job.skipped += 1
+            logger.debug("skipping run of job %s because the previous run is still in progress" % job.name)
+            return
+
+        start = time.monotonic()
+        if job.blocking:
+            job.in_flight = True
+            future = self.loop.run_in_executor(self.executor, job.func)
+            future.add_done_callback(
+                lambda f: self.__on_blocking_done(job, start, lateness_ms, f))
+            return
+
+        try:
+            job.func()
+        except Exception as e:
+            logger.error("job %s failed: %s" % (job.name, e))
+        self.__record(job, start, lateness_ms)
+
+    def __on_blocking_done(self, job, start, lateness_ms, future):
+        job.in_flight = False
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("job %s failed: %s" % (job.name, future.exception()))
+        self.__record(job, start, lateness_ms)
+
+    def __record(self, job, start, lateness_ms):
+        job.runs += 1
+        job.last_duration_ms = (time.monotonic() - start) * 1000
+        job.max_lateness_ms = max(job.max_lateness_ms, lateness_ms)
+        self.on_job_timing(job.name, job.last_duration_ms, lateness_ms)
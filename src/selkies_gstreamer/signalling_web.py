@@ -28,11 +28,19 @@ import http
 import concurrent
 import functools
 import json
+import gzip
+import re
+import collections
 
 import hashlib
 import hmac
 import base64
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 from pathlib import Path
 from http import HTTPStatus
 
@@ -43,9 +51,37 @@ MIME_TYPES = {
     "html": "text/html",
     "js": "text/javascript",
     "css": "text/css",
-    "ico": "image/x-icon"
+    "ico": "image/x-icon",
+    "json": "application/json",
+    "map": "application/json",
+    "png": "image/png",
+    "ttf": "font/ttf"
 }
 
+# Static files compressed once when cached, images are already compressed
+COMPRESSIBLE_EXTENSIONS = {"html", "js", "css", "json", "map", "ttf", "svg", "txt"}
+# Smaller files are always sent as is
+COMPRESS_MIN_BYTES = 1024
+# Content codings in order of preference, brotli is used when the module is installed
+WEB_ENCODINGS = ("br", "gzip")
+
+# Paths under web_root that change name when their contents change: versioned
+# libraries, hashed build outputs and the content addressed web fonts.
+FINGERPRINTED_PATHS = (
+    re.compile(r'[-.]v?\d+\.\d+\.\d+[-.]'),
+    re.compile(r'[-.][0-9a-f]{8,}\.[a-z0-9]+$'),
+    re.compile(r'(^|/)font/[A-Za-z0-9_-]{16,}\.(ttf|woff2?)$'),
+)
+CACHE_CONTROL_IMMUTABLE = "public, max-age=31536000, immutable"
+# Everything else is revalidated with its ETag on each use
+CACHE_CONTROL_REVALIDATE = "no-cache"
+
+# Cached static file, bodies maps content codings to the encoded data
+WebFile = collections.namedtuple("WebFile", ["mtime", "size", "digest", "bodies", "cache_control"])
+
+# Maximum time a /turn request waits for a pending RTC config, in seconds
+RTC_CONFIG_WAIT_TIMEOUT = 10
+
 def generate_rtc_config(turn_host, turn_port, shared_secret, user, protocol='udp', turn_tls=False, stun_host=None, stun_port=None):
     # Use shared secret to generate HMAC credential
 
@@ -87,6 +123,71 @@ def generate_rtc_config(turn_host, turn_port, shared_secret, user, protocol='udp
 
     return json.dumps(rtc_config, indent=2)
 
+def compress_web_file(extension, data):
+    """Returns the compressed variants of a static file worth sending
+
+    Arguments:
+        extension {string} -- file extension
+        data {bytes} -- file contents
+
+    Returns:
+        dict -- content coding to encoded data, only variants smaller than data
+    """
+    bodies = {}
+    if extension not in COMPRESSIBLE_EXTENSIONS or len(data) < COMPRESS_MIN_BYTES:
+        return bodies
+    if brotli is not None:
+        bodies["br"] = brotli.compress(data, quality=11)
+    # Fixed mtime so the output, and the ETag derived from the contents, is stable
+    bodies["gzip"] = gzip.compress(data, compresslevel=9, mtime=0)
+    return {coding: body for coding, body in bodies.items() if len(body) < len(data)}
+
+def select_encoding(accept_encoding, available):
+    """Picks the preferred content coding accepted by the client
+
+    Arguments:
+        accept_encoding {string} -- Accept-Encoding request header
+        available {iterable} -- content codings of the file
+
+    Returns:
+        string -- the content coding, None when not even identity is acceptable
+    """
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    for coding in WEB_ENCODINGS:
+        if coding in available and accepted.get(coding, accepted.get("*", 0.0)) > 0:
+            return coding
+    # identity is acceptable unless refused explicitly, or by *;q=0 without an identity entry
+    if accepted.get("identity", accepted.get("*", 1.0)) > 0:
+        return "identity"
+    return None
+
+def etag_matches(if_none_match, etag):
+    """Weak comparison of an If-None-Match request header with an ETag
+    """
+    if if_none_match.strip() == "*":
+        return True
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
 class WebRTCSimpleServer(object):
 
     def __init__(self, loop, options):
@@ -103,6 +204,9 @@ class WebRTCSimpleServer(object):
         # Format: {room_id: {peer1_id, peer2_id, peer3_id, ...}}
         # Room dict with a set of peers in each room
         self.rooms = dict()
+        # Format: {callee_uid: {caller1_id, caller2_id, ...}}
+        # Peers that requested a session with a peer that was not registered yet
+        self.peer_waiters = dict()
 
         # Event loop
         self.loop = loop
@@ -151,9 +255,9 @@ class WebRTCSimpleServer(object):
             logger.info("parsing rtc_config_file: {}".format(options.rtc_config_file))
             self.rtc_config = open(options.rtc_config_file, 'rb').read()
 
-        # Perform initial cache of web_root files
-        for f in Path(self.web_root).rglob('*.*'):
-            self.cache_file(os.path.realpath(f))
+        # Cleared by expect_rtc_config() while the RTC config is fetched in the background
+        self.rtc_config_ready = asyncio.Event()
+        self.rtc_config_ready.set()
 
         # Validate TURN arguments
         if self.turn_shared_secret:
@@ -167,17 +271,84 @@ class WebRTCSimpleServer(object):
 
     ############### Helper functions ###############
 
+    def expect_rtc_config(self):
+        """Marks the RTC config as pending
+
+        Requests to /turn wait until set_rtc_config() or set_turn_shared_secret()
+        is called, or RTC_CONFIG_WAIT_TIMEOUT expires.
+        """
+        self.rtc_config_ready.clear()
+
     def set_rtc_config(self, rtc_config):
         self.rtc_config = rtc_config
+        # May be called from monitor threads
+        self.loop.call_soon_threadsafe(self.rtc_config_ready.set)
+
+    def set_turn_shared_secret(self, turn_shared_secret, turn_host, turn_port):
+        """Generates HMAC TURN credentials for each /turn request from the shared secret
+        """
+        if not (turn_host and turn_port):
+            raise Exception("missing turn_host or turn_port options with turn_shared_secret")
+        self.turn_shared_secret = turn_shared_secret
+        self.turn_host = turn_host
+        self.turn_port = turn_port
+        self.loop.call_soon_threadsafe(self.rtc_config_ready.set)
+
+    def cache_web_root(self):
+        """Reads and precompresses all files under web_root into the HTTP cache
+
+        Blocking, meant to run in an executor while the server is already serving.
+        """
+        count = 0
+        for f in Path(self.web_root).rglob('*.*'):
+            try:
+                self.cache_file(os.path.realpath(f))
+                count += 1
+            except OSError as e:
+                logger.warning("failed to cache {}: {}".format(f, e))
+        logger.info("cached {} files from {}".format(count, self.web_root))
+
+    def cached_file(self, full_path):
+        """Returns the cached file if it was checked within cache_ttl, otherwise None
+        """
+        entry, checked = self.http_cache.get(full_path, (None, None))
+        if entry is None or time.time() - checked >= self.cache_ttl:
+            return None
+        return entry
 
     def cache_file(self, full_path):
-        data, ttl = self.http_cache.get(full_path, (None, None))
+        """Reads a file into the HTTP cache with its compressed variants and digest
+
+        Cached files are checked for changes every cache_ttl seconds, only
+        modified files are read and compressed again. Blocking.
+
+        Arguments:
+            full_path {string} -- real path of a file under web_root
+
+        Returns:
+            WebFile -- the cached file
+        """
+        entry, checked = self.http_cache.get(full_path, (None, None))
         now = time.time()
-        if data is None or now - ttl >= self.cache_ttl:
+        if entry is not None and now - checked < self.cache_ttl:
+            return entry
+
+        st = os.stat(full_path)
+        if entry is None or (entry.mtime, entry.size) != (st.st_mtime_ns, st.st_size):
             # refresh cache
-            data = open(full_path, 'rb').read()
-            self.http_cache[full_path] = (data, now)
-        return data
+            with open(full_path, 'rb') as f:
+                data = f.read()
+            extension = full_path.split(".")[-1]
+            bodies = compress_web_file(extension, data)
+            bodies["identity"] = data
+
+            relative_path = os.path.relpath(full_path, os.path.realpath(self.web_root))
+            cache_control = CACHE_CONTROL_REVALIDATE
+            if any(p.search(relative_path) for p in FINGERPRINTED_PATHS):
+                cache_control = CACHE_CONTROL_IMMUTABLE
+            entry = WebFile(st.st_mtime_ns, st.st_size, hashlib.sha256(data).hexdigest()[:32], bodies, cache_control)
+        self.http_cache[full_path] = (entry, now)
+        return entry
 
     async def process_request(self, server_root, path, request_headers):
         response_headers = [
@@ -202,6 +373,11 @@ class WebRTCSimpleServer(object):
             return http.HTTPStatus.OK, response_headers, b"OK\n"
 
         if path == "/turn/" or path == "/turn":
+            if not self.rtc_config_ready.is_set():
+                try:
+                    await asyncio.wait_for(self.rtc_config_ready.wait(), RTC_CONFIG_WAIT_TIMEOUT)
+                except asyncio.TimeoutError:
+                    web_logger.warning("HTTP GET {} timed out waiting for the RTC config".format(path))
             if self.turn_shared_secret:
                 # Get username from auth header.
                 if not username:
@@ -242,10 +418,34 @@ class WebRTCSimpleServer(object):
         mime_type = MIME_TYPES.get(extension, "application/octet-stream")
         response_headers.append(('Content-Type', mime_type))
 
-        # Read the whole file into memory and send it out
-        body = self.cache_file(full_path)
+        # Serve the whole file from memory, reading and compressing it off the loop when stale
+        entry = self.cached_file(full_path)
+        if entry is None:
+            entry = await self.loop.run_in_executor(None, self.cache_file, full_path)
+
+        encoding = select_encoding(request_headers.get("accept-encoding", ""), entry.bodies)
+        if encoding is None:
+            web_logger.info("HTTP GET {} 406 NOT ACCEPTABLE".format(path))
+            return HTTPStatus.NOT_ACCEPTABLE, response_headers, b'406 NOT ACCEPTABLE'
+        # Strong ETags differ between the encoded representations
+        if encoding == "identity":
+            etag = '"{}"'.format(entry.digest)
+        else:
+            etag = '"{}-{}"'.format(entry.digest, encoding)
+        response_headers.append(('ETag', etag))
+        response_headers.append(('Cache-Control', entry.cache_control))
+        if len(entry.bodies) > 1:
+            response_headers.append(('Vary', 'Accept-Encoding'))
+
+        if etag_matches(request_headers.get("if-none-match", ""), etag):
+            web_logger.info("HTTP GET {} 304 NOT MODIFIED".format(path))
+            return HTTPStatus.NOT_MODIFIED, response_headers, b''
+
+        body = entry.bodies[encoding]
+        if encoding != "identity":
+            response_headers.append(('Content-Encoding', encoding))
         response_headers.append(('Content-Length', str(len(body))))
-        web_logger.info("HTTP GET {} 200 OK".format(path))
+        web_logger.info("HTTP GET {} 200 OK ({})".format(path, encoding))
         return HTTPStatus.OK, response_headers, body
 
     async def recv_msg_ping(self, ws, raddr):
@@ -289,7 +489,20 @@ class WebRTCSimpleServer(object):
             logger.info('room {}: {} -> {}: {}'.format(room_id, uid, pid, msg))
             await wsp.send(msg)
 
+    async def notify_peer_waiters(self, uid):
+        for pid in self.peer_waiters.pop(uid, set()):
+            if pid in self.peers:
+                wsp, paddr, _, _ = self.peers[pid]
+                logger.info('{} joined, notifying {}'.format(uid, pid))
+                try:
+                    await wsp.send('PEER_JOINED {}'.format(uid))
+                except websockets.ConnectionClosed as e:
+                    # A closing waiter must not drop the peer that just joined.
+                    logger.warning('failed to notify {} that {} joined: {}'.format(pid, uid, e))
+
     async def remove_peer(self, uid):
+        for waiters in self.peer_waiters.values():
+            waiters.discard(uid)
         await self.cleanup_session(uid)
         if uid in self.peers:
             ws, raddr, status, _ = self.peers[uid]
@@ -306,6 +519,7 @@ class WebRTCSimpleServer(object):
         peer_status = None
         self.peers[uid] = [ws, raddr, peer_status, meta]
         logger.info("Registered peer {!r} at {!r} with meta: {}".format(uid, raddr, meta))
+        await self.notify_peer_waiters(uid)
         while True:
             # Receive command, wait forever if necessary
             msg = await self.recv_msg_ping(ws, raddr)
@@ -353,6 +567,8 @@ class WebRTCSimpleServer(object):
                 logger.info("{!r} command {!r}".format(uid, msg))
                 _, callee_id = msg.split(maxsplit=1)
                 if callee_id not in self.peers:
+                    # Tell the caller as soon as the callee registers so it can retry
+                    self.peer_waiters.setdefault(callee_id, set()).add(uid)
                     await ws.send('ERROR peer {!r} not found'.format(callee_id))
                     continue
                 if peer_status is not None:
@@ -550,6 +766,7 @@ def main():
 
     print('Starting server...')
     asyncio.ensure_future(r.run(), loop=loop)
+    loop.run_in_executor(None, r.cache_web_root)
     print("Started server")
     loop.run_forever()
 
@@ -15,6 +15,7 @@ class SystemMonitor:
         self.period = period
         self.enabled = enabled
         self.running = False
+        self.scheduler = None
 
         self.cpu_percent = 0
         self.mem_total = 0
@@ -23,17 +24,27 @@ class SystemMonitor:
         self.on_timer = lambda: logger.warn(
             "unhandled on_timer")
 
-    def start(self):
+    def start(self, scheduler):
+        """Runs the system monitor as a periodic scheduler job
+
+        Arguments:
+            scheduler {PeriodicScheduler} -- scheduler that runs the job
+        """
+        self.scheduler = scheduler
         self.running = True
-        while self.running:
-            if self.enabled and int(time.time()) % self.period == 0:
-                self.cpu_percent = psutil.cpu_percent()
-                mem = psutil.virtual_memory()
-                self.mem_total = mem.total
-                self.mem_used = mem.used
-                self.on_timer(time.time())
-            time.sleep(0.5)
-        logger.info("system monitor stopped")
+        scheduler.add_job("system_monitor", self.period, self.update, jitter=0.5)
+
+    def update(self):
+        if not self.enabled:
+            return
+        self.cpu_percent = psutil.cpu_percent()
+        mem = psutil.virtual_memory()
+        self.mem_total = mem.total
+        self.mem_used = mem.used
+        self.on_timer(time.time())
 
     def stop(self):
+        if self.running:
+            self.scheduler.remove_job("system_monitor")
+            logger.info("system monitor stopped")
         self.running = False
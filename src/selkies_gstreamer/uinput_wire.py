@@ -0,0 +1,156 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Compact wire format for the uinput mouse socket.
+#
+# One datagram carries all input events of one input message or coalescing
+# window:
+#
+#   header: <2s magic "SU"><u8 version><u8 event count>
+#   events: <u16 type><u16 code><s32 value>, little-endian
+#
+# Events follow the evdev model, an EV_SYN/SYN_REPORT event marks the end of
+# each group of events that the receiver must apply atomically.
+
+import struct
+import threading
+
+import logging
+logger = logging.getLogger("uinput_wire")
+logger.setLevel(logging.INFO)
+
+UINPUT_WIRE_MAGIC = b'SU'
+UINPUT_WIRE_VERSION = 1
+UINPUT_WIRE_HEADER = struct.Struct('<2sBB')
+UINPUT_WIRE_EVENT = struct.Struct('<HHi')
+UINPUT_WIRE_MAX_EVENTS = 64
+
+EV_SYN = 0x00
+SYN_REPORT = 0x00
+SYN_EVENT = (EV_SYN, SYN_REPORT, 0)
+
+
+class UinputWireError(Exception):
+    pass
+
+
+def encode_events(events):
+    """Packs events into one datagram
+
+    Arguments:
+        events {[list of tuple]} -- (type, code, value) events
+
+    Returns:
+        bytes -- the datagram
+    """
+    if len(events) > UINPUT_WIRE_MAX_EVENTS:
+        raise UinputWireError("too many events for one datagram: %d" % len(events))
+    data = bytearray(UINPUT_WIRE_HEADER.size + UINPUT_WIRE_EVENT.size * len(events))
+    UINPUT_WIRE_HEADER.pack_into(data, 0, UINPUT_WIRE_MAGIC, UINPUT_WIRE_VERSION, len(events))
+    offset = UINPUT_WIRE_HEADER.size
+    for event in events:
+        UINPUT_WIRE_EVENT.pack_into(data, offset, *event)
+        offset += UINPUT_WIRE_EVENT.size
+    return bytes(data)
+
+
+def decode_events(data):
+    """Unpacks a datagram, for use by receivers
+
+    Arguments:
+        data {bytes} -- the datagram
+
+    Returns:
+        [list of tuple] -- (type, code, value) events
+    """
+    if len(data) < UINPUT_WIRE_HEADER.size:
+        raise UinputWireError("datagram too short: %d bytes" % len(data))
+    magic, version, count = UINPUT_WIRE_HEADER.unpack_from(data)
+    if magic != UINPUT_WIRE_MAGIC or version != UINPUT_WIRE_VERSION:
+        raise UinputWireError("unsupported datagram: magic %r, version %d" % (magic, version))
+    if len(data) != UINPUT_WIRE_HEADER.size + UINPUT_WIRE_EVENT.size * count:
+        raise UinputWireError("datagram length does not match %d events" % count)
+    return [UINPUT_WIRE_EVENT.unpack_from(data, UINPUT_WIRE_HEADER.size + i * UINPUT_WIRE_EVENT.size) for i in range(count)]
+
+
+class UinputEventBatch:
+    def __init__(self, sock, socket_path):
+        """Collects uinput events and sends them as one datagram on flush()
+
+        Arguments:
+            sock {socket.socket} -- unix datagram socket
+            socket_path {string} -- path of the receiving socket
+        """
+        self.sock = sock
+        self.socket_path = socket_path
+        self.events = []
+        self.lock = threading.Lock()
+
+    def add(self, event, value, syn=True):
+        """Queues an event
+
+        Arguments:
+            event {tuple} -- (type, code) of the event
+            value {integer} -- event value
+
+        Keyword Arguments:
+            syn {bool} -- append a SYN_REPORT marker after the event (default: {True})
+        """
+        with self.lock:
+            self.events.append((event[0], event[1], value))
+            if syn:
+                self.events.append(SYN_EVENT)
+            if len(self.events) >= UINPUT_WIRE_MAX_EVENTS - 1:
+                self.__send_locked()
+
+    def flush(self):
+        with self.lock:
+            self.__send_locked()
+
+    def __send_locked(self):
+        if not self.events:
+            return
+        events, self.events = self.events, []
+        try:
+            self.sock.sendto(encode_events(events), self.socket_path)
+        except OSError as e:
+            logger.warning("failed to send uinput events: %s" % e)
+
+
+if __name__ == '__main__':
+    # Benchmark of one relative move, msgpack with one datagram per axis against one compact datagram.
+    import msgpack
+    import socket
+    import time
+
+    logging.basicConfig(level=logging.INFO)
+
+    iterations = 100000
+    rel_x, rel_y = (0x02, 0x00), (0x02, 0x01)
+    sender, receiver = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    receiver.setblocking(False)
+
+    def drain():
+        try:
+            while True:
+                receiver.recv(4096)
+        except BlockingIOError:
+            pass
+
+    def bench_msgpack():
+        for i in range(iterations):
+            sender.send(msgpack.packb({"args": (rel_x, i % 7), "kwargs": {"syn": False}}, use_bin_type=True))
+            sender.send(msgpack.packb({"args": (rel_y, i % 5), "kwargs": {}}, use_bin_type=True))
+            drain()
+
+    def bench_compact():
+        for i in range(iterations):
+            sender.send(encode_events([(rel_x[0], rel_x[1], i % 7), (rel_y[0], rel_y[1], i % 5), SYN_EVENT]))
+            drain()
+
+    for name, bench, datagrams in (("msgpack", bench_msgpack, 2), ("compact", bench_compact, 1)):
+        start = time.perf_counter()
+        bench()
+        elapsed = time.perf_counter() - start
+        logger.info("%s: %.2fus per move, %d datagrams per move" % (name, elapsed / iterations * 1e6, datagrams))
@@ -20,21 +20,29 @@
 #   limitations under the License.
 
 import Xlib
+# Input is injected from the data channel and the motion coalescer threads.
+import Xlib.threaded
 from Xlib import display
 from Xlib.ext import xfixes, xtest
+from array import array
 import asyncio
 import base64
-import pynput
+import collections
 import io
-import msgpack
 import re
 import os
 import subprocess
 import socket
 import struct
+import sys
+import threading
 import time
-from PIL import Image
-from gamepad import SelkiesGamepad
+
+from xkeyboard import XTestKeyboard
+from xclipboard import XClipboard, XClipboardError
+from cursor_cache import CursorCache, cursor_key, find_theme_cursors, load_xcursor, XCURSOR_DEFAULT_SIZE, XCURSOR_WARM_UP_NAMES
+from uinput_wire import UinputEventBatch
+from input_worker import InputWorker
 
 import logging
 logger = logging.getLogger("webrtc_input")
@@ -59,36 +67,245 @@ UINPUT_REL_X = (0x02, 0x00)
 UINPUT_REL_Y = (0x02, 0x01)
 UINPUT_REL_WHEEL = (0x02, 0x08)
 
-# Local map for uinput and pynput buttons
+# X11 core pointer buttons
+X11_BTN_LEFT = 1
+X11_BTN_MIDDLE = 2
+X11_BTN_RIGHT = 3
+X11_BTN_WHEEL_UP = 4
+X11_BTN_WHEEL_DOWN = 5
+
+# Local map for uinput and X11 buttons
 MOUSE_BUTTON_MAP = {
     MOUSE_BUTTON_LEFT: {
         "uinput": UINPUT_BTN_LEFT,
-        "pynput": pynput.mouse.Button.left,
+        "x11": X11_BTN_LEFT,
     },
     MOUSE_BUTTON_MIDDLE: {
         "uinput": UINPUT_BTN_MIDDLE,
-        "pynput": pynput.mouse.Button.middle,
+        "x11": X11_BTN_MIDDLE,
     },
     MOUSE_BUTTON_RIGHT: {
         "uinput": UINPUT_BTN_RIGHT,
-        "pynput": pynput.mouse.Button.right,
+        "x11": X11_BTN_RIGHT,
     },
 }
 
+# Binary input protocol, frames are <u8 version><u8 type><payload> with
+# fixed size little-endian payloads. Negotiated with the "input_protocol"
+# system action, clients that do not answer keep using the CSV messages.
+# Version 2 adds binary cursor frames sent to the client, see gstwebrtc_app.
+INPUT_PROTOCOL_VERSION = 2
+INPUT_FRAME_HEADER = struct.Struct('<BB')
+INPUT_FRAME_MOUSE = 1
+INPUT_FRAME_KEY = 2
+INPUT_FRAME_GAMEPAD_BUTTON = 3
+INPUT_FRAME_GAMEPAD_AXIS = 4
+
+# flags (bit 0: relative), x, y, button mask, scroll magnitude
+INPUT_MOUSE_STRUCT = struct.Struct('<BiiBB')
+# down, keysym
+INPUT_KEY_STRUCT = struct.Struct('<BI')
+# gamepad number, button or axis number, value
+INPUT_GAMEPAD_STRUCT = struct.Struct('<BBf')
+INPUT_MOUSE_FLAG_RELATIVE = 0x01
+# Optional client send time appended to a frame, milliseconds since the epoch on the client clock.
+INPUT_TIMESTAMP_STRUCT = struct.Struct('<d')
+
+# PIL raw mode of XFixes ARGB cursor words in native byte order.
+CURSOR_RAW_MODE = 'BGRA' if sys.byteorder == 'little' else 'ARGB'
+
+# Number of ping/pong samples the clock offset is estimated from.
+CLOCK_OFFSET_SAMPLES = 16
+
+# Commands handled on the data channel thread, pong needs its receive time.
+INLINE_INPUT_COMMANDS = frozenset(["pong"])
+
+# Commands that may block on subprocesses, file writes or the pipeline, run on the slow input lane.
+# Clipboard writes stay on the fast lane, a paste shortcut after them must see the new contents.
+SLOW_INPUT_COMMANDS = frozenset([
+    "cr", "r", "s", "p", "vb", "ab", "_arg_fps", "_arg_resize",
+    "_f", "_l", "_stats_video", "_stats_audio", "_proto",
+])
+
+# Seconds a clipboard write waits for the X server to confirm ownership.
+CLIPBOARD_OWNERSHIP_TIMEOUT = 0.5
+
+RESOLUTION_RE = re.compile(r'^\d+x\d+$')
+SCALE_RE = re.compile(r'^\d+(\.\d+)?$')
+
 
 class WebRTCInputError(Exception):
     pass
 
 
+class ClockOffsetEstimator:
+    def __init__(self, max_samples=CLOCK_OFFSET_SAMPLES):
+        """Estimates the offset of the client clock from ping/pong exchanges
+
+        The sample with the smallest round trip over the last max_samples
+        exchanges is used, its midpoint has the least queuing error.
+
+        Keyword Arguments:
+            max_samples {integer} -- number of recent samples to keep (default: {CLOCK_OFFSET_SAMPLES})
+        """
+        self.samples = collections.deque(maxlen=max_samples)
+        self.offset = None
+
+    def add_sample(self, ping_start, pong_received, client_time):
+        """Adds a ping/pong exchange, all times in seconds
+
+        Arguments:
+            ping_start {float} -- server time the ping was sent
+            pong_received {float} -- server time the pong was received
+            client_time {float} -- client time the pong was sent
+        """
+        roundtrip = pong_received - ping_start
+        self.samples.append((roundtrip, client_time - (ping_start + roundtrip / 2)))
+        self.offset = min(self.samples)[1]
+
+    def to_server_time(self, client_time):
+        """Converts a client time in seconds to server time, None before the first sample
+        """
+        if self.offset is None:
+            return None
+        return client_time - self.offset
+
+
+class MotionCoalescer:
+    def __init__(self, window, emit):
+        """Merges pointer motion that arrives within a time window
+
+        Absolute positions replace each other and relative deltas are summed.
+        The first motion after an idle window is emitted right away, later ones
+        are held back by a flusher thread until the window has elapsed.
+
+        Arguments:
+            window {float} -- coalescing window in seconds
+            emit {callable} -- injects the motion, called with (x, y, relative)
+        """
+
+        self.window = window
+        self.emit = emit
+
+        # Guards the pending motion, emits happen with the lock held to keep ordering.
+        self.cond = threading.Condition()
+        # [x, y, relative, merged events, arrival time of the first event]
+        self.pending = None
+        self.last_emit = 0.0
+
+        self.running = False
+        self.thread = None
+
+        self.on_flush = lambda count, lag_ms: None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.__run, name="motion-coalescer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.__flush_locked()
+            self.cond.notify()
+
+    def motion(self, x, y, relative, flush=False):
+        """Adds a pointer motion
+
+        Arguments:
+            x {integer} -- position or delta X
+            y {integer} -- position or delta Y
+            relative {bool} -- True if x and y are deltas
+
+        Keyword Arguments:
+            flush {bool} -- emit before returning, used before button transitions (default: {False})
+        """
+        now = time.monotonic()
+        with self.cond:
+            pending = self.pending
+            if pending is not None and pending[2] != relative:
+                self.__flush_locked()
+                pending = None
+
+            if pending is None:
+                self.pending = [x, y, relative, 1, now]
+            elif relative:
+                pending[0] += x
+                pending[1] += y
+                pending[3] += 1
+            else:
+                pending[0] = x
+                pending[1] = y
+                pending[3] += 1
+
+            if flush or not self.running or now - self.last_emit >= self.window:
+                self.__flush_locked()
+            else:
+                self.cond.notify()
+
+    def flush(self):
+        """Emits the pending motion, called before injecting any non-motion event
+        """
+        with self.cond:
+            self.__flush_locked()
+
+    def __flush_locked(self):
+        if self.pending is None:
+            return
+        x, y, relative, count, first = self.pending
+        self.pending = None
+        try:
+            self.emit(x, y, relative)
+        except Exception as e:
+            logger.warning('failed to set mouse cursor: {}'.format(e))
+        self.last_emit = time.monotonic()
+        self.on_flush(count, (self.last_emit - first) * 1000)
+
+    def __run(self):
+        with self.cond:
+            while self.running:
+                if self.pending is None:
+                    self.cond.wait()
+                    continue
+                remaining = self.last_emit + self.window - time.monotonic()
+                if remaining > 0:
+                    self.cond.wait(remaining)
+                    continue
+                self.__flush_locked()
+
+
 class WebRTCInput:
-    def __init__(self, uinput_mouse_socket_path="", js_socket_path="", enable_clipboard="", enable_cursors=True, cursor_size=16, cursor_scale=1.0, cursor_debug=False):
+    def __init__(self, uinput_mouse_socket_path="", js_socket_path="", enable_clipboard="", enable_cursors=True, cursor_size=16, cursor_scale=1.0, cursor_debug=False, mouse_coalesce_window=0.0, uinput_mouse_format="msgpack", gamepad_axis_deadzone=(0.0,), gamepad_axis_threshold=0, gamepad_axis_rate_limit=0):
         """Initializes WebRTC input instance
+
+        Keyword Arguments:
+            mouse_coalesce_window {float} -- seconds to merge pointer motion for, 0 to inject every event
+            uinput_mouse_format {string} -- "msgpack" for one datagram per event or "compact" for batched uinput_wire datagrams
+            gamepad_axis_deadzone {[list of float]} -- gamepad stick deadzone per axis as a fraction of the range, a single value applies to all axes
+            gamepad_axis_threshold {integer} -- minimum change of a gamepad axis value in joystick units before it is sent
+            gamepad_axis_rate_limit {float} -- maximum events per second per gamepad axis, 0 for no limit
         """
         self.loop = None
+        self.scheduler = None
 
         self.clipboard_running = False
+        self.clipboard_last_data = ""
+        # In-process clipboard engine, None when falling back to polling xsel.
+        self.clipboard = None
+        # Second X connection that only receives events for the cursor monitor,
+        # clipboard and keyboard mapping. It is read on the event loop when its
+        # socket is readable, no other thread reads from it.
+        self.xevents = None
+        self.x11_events_running = False
+        # Set while the XTest keyboard consumes MappingNotify events from the reader.
+        self.keyboard_events_running = False
         self.uinput_mouse_socket_path = uinput_mouse_socket_path
         self.uinput_mouse_socket = None
+        self.uinput_mouse_format = uinput_mouse_format
+        # Batches the events of one input message in the compact format.
+        self.uinput_mouse_batch = None
+        # msgpack module, only needed in uinput mode and loaded when the mouse connects.
+        self.msgpack = None
 
         # Map of gamepad numbers to socket paths
         self.js_socket_path_map = {i: os.path.join(js_socket_path, "selkies_js%d.sock" % i) for i in range(4)}
@@ -96,22 +313,79 @@ class WebRTCInput:
         # Map of gamepad number to SelkiesGamepad objects
         self.js_map = {}
 
+        self.gamepad_axis_deadzone = gamepad_axis_deadzone
+        self.gamepad_axis_threshold = gamepad_axis_threshold
+        self.gamepad_axis_rate_limit = gamepad_axis_rate_limit
+
         self.enable_clipboard = enable_clipboard
 
         self.enable_cursors = enable_cursors
         self.cursors_running = False
-        self.cursor_cache = {}
+        # Incremented on each cursor change, results of older fetches are discarded.
+        self.cursor_generation = 0
+        # Kept across sessions, clients get the handle of images they have seen.
+        self.cursor_cache = CursorCache()
         self.cursor_scale = cursor_scale
         self.cursor_size = cursor_size
         self.cursor_debug = cursor_debug
+        # PIL.Image module, only needed when cursors are enabled and loaded on first use.
+        self.pil_image = None
 
         self.keyboard = None
-        self.mouse = None
         self.joystick = None
         self.xdisplay = None
         self.button_mask = 0
 
+        self.mouse_coalesce_window = mouse_coalesce_window
+        self.motion_coalescer = None
+
         self.ping_start = None
+        self.clock_offset = ClockOffsetEstimator()
+
+        # Runs input handlers off the data channel thread, started by connect().
+        self.input_worker = InputWorker()
+        self.input_worker.on_timing = lambda command, duration_ms: self.on_input_message_timing(command, duration_ms)
+        self.input_worker.on_latency = lambda command, latency_ms: self.on_input_inject_latency(command, latency_ms)
+        self.input_worker.on_queue = lambda lane, depth, age_ms: self.on_input_queue(lane, depth, age_ms)
+        self.input_worker.on_dropped = lambda reason: self.on_input_message_dropped(reason)
+        # Button mask of the last mouse event handed to the input worker.
+        self.queued_button_mask = 0
+
+        # Binary input protocol version acknowledged by the client, 0 for CSV only.
+        self.client_input_protocol = 0
+
+        # Data channel command to handler, handlers receive the split message.
+        self.message_handlers = {
+            "m": self.__on_mouse,
+            "m2": self.__on_mouse,
+            "kd": self.__on_key_down,
+            "ku": self.__on_key_up,
+            "js": self.__on_joystick,
+            "pong": self.__on_pong,
+            "_proto": self.__on_input_protocol,
+            "kr": self.__on_key_reset,
+            "p": self.__on_pointer_visible,
+            "vb": self.__on_video_bitrate,
+            "ab": self.__on_audio_bitrate,
+            "cr": self.__on_clipboard_read,
+            "cw": self.__on_clipboard_write,
+            "r": self.__on_resize,
+            "s": self.__on_scaling,
+            "_arg_fps": self.__on_set_fps,
+            "_arg_resize": self.__on_set_enable_resize,
+            "_f": self.__on_client_fps,
+            "_l": self.__on_client_latency,
+            "_stats_video": self.__on_client_webrtc_stats,
+            "_stats_audio": self.__on_client_webrtc_stats,
+        }
+
+        # Binary frame type to (command name, payload struct, handler), handlers receive the unpacked fields.
+        self.binary_handlers = {
+            INPUT_FRAME_MOUSE: ("bin_m", INPUT_MOUSE_STRUCT, self.__on_binary_mouse),
+            INPUT_FRAME_KEY: ("bin_k", INPUT_KEY_STRUCT, self.__on_binary_key),
+            INPUT_FRAME_GAMEPAD_BUTTON: ("bin_js_b", INPUT_GAMEPAD_STRUCT, self.__js_emit_btn),
+            INPUT_FRAME_GAMEPAD_AXIS: ("bin_js_a", INPUT_GAMEPAD_STRUCT, self.__js_emit_axis),
+        }
 
         self.on_video_encoder_bit_rate = lambda bitrate: logger.warn(
             'unhandled on_video_encoder_bit_rate')
@@ -119,8 +393,10 @@ class WebRTCInput:
             'unhandled on_audio_encoder_bit_rate')
         self.on_mouse_pointer_visible = lambda visible: logger.warn(
             'unhandled on_mouse_pointer_visible')
-        self.on_clipboard_read = lambda data: logger.warn(
+        self.on_clipboard_read = lambda data, force=False: logger.warn(
             'unhandled on_clipboard_read')
+        self.on_input_protocol = lambda version: logger.warn(
+            'unhandled on_input_protocol')
         self.on_set_fps = lambda fps: logger.warn(
             'unhandled on_set_fps')
         self.on_set_enable_resize = lambda enable_resize, res: logger.warn(
@@ -139,9 +415,18 @@ class WebRTCInput:
             'unhandled on_cursor_change')
         self.on_client_webrtc_stats = lambda webrtc_stat_type, webrtc_stats: logger.warn(
             'unhandled on_client_webrtc_stats')
+        self.on_mouse_motion_flush = lambda count, lag_ms: None
+        self.on_gamepad_events = lambda js_num, count, delay_ms: None
+        self.on_gamepad_event_suppressed = lambda js_num, reason: None
+        # Called for every input message, no-op unless metrics are enabled.
+        self.on_input_message_timing = lambda command, duration_ms: None
+        self.on_input_message_dropped = lambda reason: None
+        self.on_input_queue = lambda lane, depth, age_ms: None
+        self.on_input_network_latency = lambda command, latency_ms: None
+        self.on_input_inject_latency = lambda command, latency_ms: None
 
     def __keyboard_connect(self):
-        self.keyboard = pynput.keyboard.Controller()
+        self.keyboard = XTestKeyboard(self.xdisplay)
 
     def __mouse_connect(self):
         if self.uinput_mouse_socket_path:
@@ -150,18 +435,34 @@ class WebRTCInput:
                         self.uinput_mouse_socket_path)
             self.uinput_mouse_socket = socket.socket(
                 socket.AF_UNIX, socket.SOCK_DGRAM)
-
-        self.mouse = pynput.mouse.Controller()
+            if self.uinput_mouse_format == "compact":
+                logger.info("using compact batched uinput mouse datagrams")
+                self.uinput_mouse_batch = UinputEventBatch(
+                    self.uinput_mouse_socket, self.uinput_mouse_socket_path)
+            elif self.msgpack is None:
+                import msgpack
+                self.msgpack = msgpack
+
+        # Pointer requests are not flushed one by one, errors are reported
+        # asynchronously through the error handler instead of sync().
+        self.xdisplay.set_error_handler(self.__on_x11_error)
 
     def __mouse_disconnect(self):
-        if self.mouse:
-            del self.mouse
-            self.mouse = None
+        self.uinput_mouse_batch = None
+        if self.uinput_mouse_socket:
+            self.uinput_mouse_socket.close()
+            self.uinput_mouse_socket = None
+
+    def __on_x11_error(self, error, request):
+        logger.warning("X11 error: %s" % error)
 
     def __mouse_emit(self, *args, **kwargs):
-        if self.uinput_mouse_socket_path:
+        if self.uinput_mouse_batch is not None:
+            # Sent by __flush_mouse() at the end of the input message.
+            self.uinput_mouse_batch.add(*args, **kwargs)
+        elif self.uinput_mouse_socket_path:
             cmd = {"args": args, "kwargs": kwargs}
-            data = msgpack.packb(cmd, use_bin_type=True)
+            data = self.msgpack.packb(cmd, use_bin_type=True)
             self.uinput_mouse_socket.sendto(
                 data, self.uinput_mouse_socket_path)
 
@@ -177,11 +478,20 @@ class WebRTCInput:
             logger.error("failed to connect js%d because socket_path was not found" % js_num)
             return
 
+        # Gamepad support is loaded on first use.
+        from gamepad import SelkiesGamepad
+
         # Create the gamepad and button config.
-        js = SelkiesGamepad(socket_path, self.loop)
+        js = SelkiesGamepad(socket_path, self.loop,
+                            axis_deadzone=self.gamepad_axis_deadzone,
+                            axis_threshold=self.gamepad_axis_threshold,
+                            axis_rate_limit=self.gamepad_axis_rate_limit)
         js.set_config(name, num_btns, num_axes)
+        js.on_events_sent = lambda count, delay_ms: self.on_gamepad_events(js_num, count, delay_ms)
+        js.on_event_suppressed = lambda reason: self.on_gamepad_event_suppressed(js_num, reason)
 
-        asyncio.ensure_future(js.run_server(), loop=self.loop)
+        # Called from the input worker thread.
+        asyncio.run_coroutine_threadsafe(js.run_server(), self.loop)
 
         self.js_map[js_num] = js
 
@@ -220,8 +530,18 @@ class WebRTCInput:
         js.send_axis(axis_num, axis_val)
 
     async def connect(self):
+        # Opening the X11 connections blocks on the X server, run it off the loop.
+        await asyncio.get_event_loop().run_in_executor(None, self.__connect)
+
+        # Keyboard mapping changes arrive as MappingNotify events, the XTest
+        # keyboard needs them even without the clipboard and cursor monitors.
+        self.keyboard_events_running = True
+        self.__start_x11_events()
+
+    def __connect(self):
         # Create connection to the X11 server provided by the DISPLAY env var.
         self.xdisplay = display.Display()
+        self.xevents = display.Display()
 
         self.__keyboard_connect()
 
@@ -230,8 +550,23 @@ class WebRTCInput:
 
         self.__mouse_connect()
 
+        if self.mouse_coalesce_window > 0:
+            logger.info("coalescing pointer motion within %.1fms" % (self.mouse_coalesce_window * 1000))
+            self.motion_coalescer = MotionCoalescer(self.mouse_coalesce_window, self.__send_motion)
+            self.motion_coalescer.on_flush = lambda count, lag_ms: self.on_mouse_motion_flush(count, lag_ms)
+            self.motion_coalescer.start()
+
+        self.input_worker.start()
+
     def disconnect(self):
+        if self.keyboard_events_running:
+            self.keyboard_events_running = False
+            self.__stop_x11_events()
+        self.input_worker.stop()
         self.__js_disconnect()
+        if self.motion_coalescer is not None:
+            self.motion_coalescer.stop()
+            self.motion_coalescer = None
         self.__mouse_disconnect()
 
     def reset_keyboard(self):
@@ -263,11 +598,16 @@ class WebRTCInput:
             self.send_x11_keypress(k, down=False)
 
     def send_mouse(self, action, data):
+        """Queues a mouse action
+
+        X11 requests are buffered by the connection, the caller flushes them
+        once per input message with self.xdisplay.flush().
+        """
         if action == MOUSE_POSITION:
             # data is a tuple of (x, y)
             # using X11 mouse even when virtual mouse is enabled for non-relative actions.
-            if self.mouse:
-                self.mouse.position = data
+            x, y = data
+            xtest.fake_input(self.xdisplay, Xlib.X.MotionNotify, detail=False, root=Xlib.X.NONE, x=x, y=y)
         elif action == MOUSE_MOVE:
             # data is a tuple of (x, y)
             x, y = data
@@ -277,45 +617,46 @@ class WebRTCInput:
                 self.__mouse_emit(UINPUT_REL_X, x, syn=False)
                 self.__mouse_emit(UINPUT_REL_Y, y)
             else:
-                # NOTE: the pynput mouse.move method moves the mouse relative to the current position using its internal tracked position.
-                #       this does not work for relative motion where the input should just be a delta value.
-                #       instead, send the X fake input directly.
                 xtest.fake_input(self.xdisplay, Xlib.X.MotionNotify, detail=True, root=Xlib.X.NONE, x=x, y=y)
-                self.xdisplay.sync()
         elif action == MOUSE_SCROLL_UP:
             # Scroll up
             if self.uinput_mouse_socket_path:
                 self.__mouse_emit(UINPUT_REL_WHEEL, 1)
             else:
-                self.mouse.scroll(0, -1)
+                self.__x11_click(X11_BTN_WHEEL_DOWN)
         elif action == MOUSE_SCROLL_DOWN:
             # Scroll down
             if self.uinput_mouse_socket_path:
                 self.__mouse_emit(UINPUT_REL_WHEEL, -1)
             else:
-                self.mouse.scroll(0, 1)
+                self.__x11_click(X11_BTN_WHEEL_UP)
         elif action == MOUSE_BUTTON:
             # Button press/release, data is a tuple of (MOUSE_BUTTON_PRESS|MOUSE_BUTTON_RELEASE, MOUSE_BUTTON_enum)
             if self.uinput_mouse_socket_path:
                 btn = MOUSE_BUTTON_MAP[data[1]]["uinput"]
             else:
-                btn = MOUSE_BUTTON_MAP[data[1]]["pynput"]
+                btn = MOUSE_BUTTON_MAP[data[1]]["x11"]
 
             if data[0] == MOUSE_BUTTON_PRESS:
                 if self.uinput_mouse_socket_path:
                     self.__mouse_emit(btn, 1)
                 else:
-                    self.mouse.press(btn)
+                    xtest.fake_input(self.xdisplay, Xlib.X.ButtonPress, btn)
             else:
                 if self.uinput_mouse_socket_path:
                     self.__mouse_emit(btn, 0)
                 else:
-                    self.mouse.release(btn)
+                    xtest.fake_input(self.xdisplay, Xlib.X.ButtonRelease, btn)
+
+    def __x11_click(self, btn):
+        xtest.fake_input(self.xdisplay, Xlib.X.ButtonPress, btn)
+        xtest.fake_input(self.xdisplay, Xlib.X.ButtonRelease, btn)
 
     def send_x11_keypress(self, keysym, down=True):
         """Sends keypress to X server
 
-        The key sym is converted to a keycode using the X server library.
+        The key sym is converted to a keycode with the cached keyboard mapping
+        and injected with XTest.
 
         Arguments:
             keysym {integer} -- the key symbol to send
@@ -324,20 +665,33 @@ class WebRTCInput:
             down {bool} -- toggle key down or up (default: {True})
         """
 
+        # Key events must not overtake motion still held by the coalescer.
+        if self.motion_coalescer is not None:
+            self.motion_coalescer.flush()
+
         try:
             # With the Generic 105-key PC layout (default in Linux without a real keyboard), the key '<' is redirected to keycode 94
             # Because keycode 94 with Shift pressed is instead the key '>', the keysym for '<' should instead be redirected to ','
             # Although prevented in most cases, this fix may present issues in some keyboard layouts
-            if keysym == 60 and self.keyboard._display.keysym_to_keycode(keysym) == 94:
+            if keysym == 60 and self.keyboard.keycode(keysym) == 94:
                 keysym = 44
-            keycode = pynput.keyboard.KeyCode(keysym)
-            if down:
-                self.keyboard.press(keycode)
-            else:
-                self.keyboard.release(keycode)
+            self.keyboard.send(keysym, down)
         except Exception as e:
             logger.error('failed to send keypress: {}'.format(e))
 
+    def __send_motion(self, x, y, relative):
+        # Injects motion merged by the motion coalescer.
+        if relative:
+            self.send_mouse(MOUSE_MOVE, (x, y))
+        else:
+            self.send_mouse(MOUSE_POSITION, (x, y))
+        self.__flush_mouse()
+
+    def __flush_mouse(self):
+        self.xdisplay.flush()
+        if self.uinput_mouse_batch is not None:
+            self.uinput_mouse_batch.flush()
+
     def send_x11_mouse(self, x, y, button_mask, scroll_magnitude, relative=False):
         """Sends mouse events to the X server.
 
@@ -353,7 +707,13 @@ class WebRTCInput:
         """
 
         # Mouse motion
-        if relative:
+        if self.motion_coalescer is not None:
+            if button_mask == self.button_mask:
+                self.motion_coalescer.motion(x, y, relative)
+                return
+            # Button transitions flush the pending motion first to keep strict ordering.
+            self.motion_coalescer.motion(x, y, relative, flush=True)
+        elif relative:
             self.send_mouse(MOUSE_MOVE, (x, y))
         else:
             self.send_mouse(MOUSE_POSITION, (x, y))
@@ -398,10 +758,12 @@ class WebRTCInput:
             # Update the button mask to remember positions.
             self.button_mask = button_mask
 
-        if not relative:
-            self.xdisplay.sync()
+        # One write for the motion, buttons and scroll burst of this message.
+        self.__flush_mouse()
 
     def read_clipboard(self):
+        if self.clipboard is not None:
+            return self.clipboard.text
         try:
             result = subprocess.run(('xsel', '--clipboard', '--output'), check=True, text=True, capture_output=True, timeout=3)
             return result.stdout
@@ -409,6 +771,14 @@ class WebRTCInput:
             logger.warning(f"Error while capturing clipboard: {e}")
 
     def write_clipboard(self, data):
+        if self.clipboard is not None:
+            owned = self.clipboard.set_text(data)
+            # The flush may have read events from the socket without waking the reader.
+            self.loop.call_soon_threadsafe(self.__on_x11_events)
+            # Key events queued after the write are injected once we own the selection.
+            if not owned.wait(CLIPBOARD_OWNERSHIP_TIMEOUT):
+                logger.warning("timed out taking ownership of the clipboard")
+            return True
         try:
             subprocess.run(('xsel', '--clipboard', '--input'), input=data.encode(), check=True, timeout=3)
             return True
@@ -416,91 +786,211 @@ class WebRTCInput:
             logger.warning(f"Error while writing to clipboard: {e}")
             return False
 
-    def start_clipboard(self):
-        if self.enable_clipboard in ["true", "out"]:
-            logger.info("starting clipboard monitor")
-            self.clipboard_running = True
-            last_data = ""
-            while self.clipboard_running:
-                curr_data = self.read_clipboard()
-                if curr_data and curr_data != last_data:
-                    logger.info(
-                        "sending clipboard content, length: %d" % len(curr_data))
-                    self.on_clipboard_read(curr_data)
-                    last_data = curr_data
-                time.sleep(0.5)
-            logger.info("clipboard monitor stopped")
-        else:
-            logger.info("skipping outbound clipboard service.")
+    def start_clipboard(self, scheduler):
+        """Watches the clipboard with XFixes selection events, polls it with xsel when XFIXES is not available
+
+        Arguments:
+            scheduler {PeriodicScheduler} -- scheduler that runs the xsel poll job
+        """
+        if self.enable_clipboard not in ["true", "out", "in"]:
+            logger.info("skipping clipboard service.")
+            return
+
+        self.scheduler = scheduler
+        try:
+            clipboard = XClipboard(self.xevents)
+        except XClipboardError as e:
+            logger.warning("%s, falling back to polling the clipboard with xsel" % e)
+            if self.enable_clipboard in ["true", "out"]:
+                logger.info("starting clipboard monitor")
+                self.clipboard_running = True
+                self.clipboard_last_data = ""
+                scheduler.add_job("clipboard_monitor", 0.5, self.__poll_clipboard, blocking=True)
+            return
+
+        logger.info("starting clipboard monitor")
+        clipboard.on_change = self.__on_clipboard_change
+        # Property reads on the clipboard thread may read events without waking the reader.
+        clipboard.on_events_read = lambda: self.loop.call_soon_threadsafe(self.__on_x11_events)
+        clipboard.start()
+        self.clipboard = clipboard
+        self.clipboard_running = True
+        self.__start_x11_events()
+
+    def __on_clipboard_change(self, data):
+        if data and self.enable_clipboard in ["true", "out"]:
+            logger.info(
+                "sending clipboard content, length: %d" % len(data))
+            self.on_clipboard_read(data)
+
+    def __poll_clipboard(self):
+        curr_data = self.read_clipboard()
+        if curr_data and curr_data != self.clipboard_last_data:
+            logger.info(
+                "sending clipboard content, length: %d" % len(curr_data))
+            self.on_clipboard_read(curr_data)
+            self.clipboard_last_data = curr_data
 
     def stop_clipboard(self):
         logger.info("stopping clipboard monitor")
+        if self.clipboard_running:
+            self.clipboard_running = False
+            if self.clipboard is not None:
+                self.__stop_x11_events()
+                self.clipboard.stop()
+                self.clipboard = None
+            else:
+                self.scheduler.remove_job("clipboard_monitor")
+            logger.info("clipboard monitor stopped")
         self.clipboard_running = False
 
-    def start_cursor_monitor(self):
-        if not self.xdisplay.has_extension('XFIXES'):
-            if self.xdisplay.query_extension('XFIXES') is None:
+    def __start_x11_events(self):
+        if not self.x11_events_running:
+            self.x11_events_running = True
+            self.loop.add_reader(self.xevents.fileno(), self.__on_x11_events)
+            # Events that arrived before the reader was added do not wake it.
+            self.__on_x11_events()
+
+    def __stop_x11_events(self):
+        # The reader is shared, keep it while another consumer is running.
+        if self.x11_events_running and not (self.cursors_running or self.clipboard_running or self.keyboard_events_running):
+            self.loop.remove_reader(self.xevents.fileno())
+            self.x11_events_running = False
+
+    def start_cursor_monitor(self, scheduler):
+        """Watches cursor changes, X events are handled on the event loop as soon as they arrive
+
+        Arguments:
+            scheduler {PeriodicScheduler} -- scheduler that runs the job
+        """
+        if not self.xevents.has_extension('XFIXES'):
+            if self.xevents.query_extension('XFIXES') is None:
                 logger.error(
                     'XFIXES extension not supported, cannot watch cursor changes')
                 return
 
-        xfixes_version = self.xdisplay.xfixes_query_version()
+        xfixes_version = self.xevents.xfixes_query_version()
         logger.info('Found XFIXES version %s.%s' % (
             xfixes_version.major_version,
             xfixes_version.minor_version,
         ))
 
         logger.info("starting cursor monitor")
-        self.cursor_cache = {}
+        self.scheduler = scheduler
         self.cursors_running = True
-        screen = self.xdisplay.screen()
-        self.xdisplay.xfixes_select_cursor_input(
+        screen = self.xevents.screen()
+        self.xevents.xfixes_select_cursor_input(
             screen.root, xfixes.XFixesDisplayCursorNotifyMask)
         logger.info("watching for cursor changes")
 
         # Fetch initial cursor
+        self.cursor_generation += 1
+        self.loop.run_in_executor(scheduler.executor, self.__fetch_cursor, self.cursor_generation)
+
+        self.__start_x11_events()
+        self.loop.run_in_executor(scheduler.executor, self.__warm_cursor_cache)
+
+    def __on_x11_events(self):
+        # pending_events() reads everything the socket has buffered, handlers
+        # with round trips may queue more events, all are drained here.
+        while self.x11_events_running and self.xevents.pending_events() > 0:
+            event = self.xevents.next_event()
+            if event.type == Xlib.X.MappingNotify:
+                if event.request == Xlib.X.MappingKeyboard and self.keyboard:
+                    # Serialized with key injection on the fast lane.
+                    self.input_worker.submit("mapping", self.keyboard.refresh, ())
+            elif (event.type, 0) == self.xevents.extension_event.DisplayCursorNotify:
+                if self.cursors_running:
+                    self.__on_cursor_notify(event)
+            elif self.clipboard is not None:
+                self.clipboard.handle_event(event)
+
+    def __on_cursor_notify(self, event):
+        self.cursor_generation += 1
+        msg = None
+        key = self.cursor_cache.key_for_serial(event.cursor_serial)
+        if key is not None:
+            msg = self.cursor_cache.get(key)
+        if msg is not None:
+            if self.cursor_debug:
+                logger.warning(
+                    "cursor changed to cached serial: {}, handle: {}".format(event.cursor_serial, msg["handle"]))
+            self.on_cursor_change(msg)
+            return
+
+        # The image round trip and conversion block, they run in the scheduler pool.
+        self.loop.run_in_executor(self.scheduler.executor, self.__fetch_cursor, self.cursor_generation)
+
+    def __fetch_cursor(self, generation):
+        msg = None
         try:
-            image = self.xdisplay.xfixes_get_cursor_image(screen.root)
-            self.cursor_cache[image.cursor_serial] = self.cursor_to_msg(
-                image, self.cursor_scale, self.cursor_size)
-            self.on_cursor_change(self.cursor_cache[image.cursor_serial])
-        except Exception as e:
-            logger.warning("exception from fetching cursor image: %s" % e)
+            # Request the cursor image.
+            cursor = self.xevents.xfixes_get_cursor_image(
+                self.xevents.screen().root)
+            msg = self.__cursor_msg(cursor)
 
-        while self.cursors_running:
-            if self.xdisplay.pending_events() == 0:
-                time.sleep(0.1)
+            if self.cursor_debug:
+                logger.warning("New cursor: position={},{}, size={}x{}, length={}, xyhot={},{}, cursor_serial={}, handle={}".format(
+                    cursor.x, cursor.y, cursor.width, cursor.height, len(cursor.cursor_image), cursor.xhot, cursor.yhot, cursor.cursor_serial, msg["handle"]))
+        except Exception as e:
+            logger.warning(
+                "exception from fetching cursor image: %s" % e)
+        self.loop.call_soon_threadsafe(self.__on_cursor_fetched, generation, msg)
+
+    def __on_cursor_fetched(self, generation, msg):
+        # The round trip may have read events from the socket without waking the reader.
+        self.__on_x11_events()
+        if self.cursors_running and generation == self.cursor_generation:
+            self.on_cursor_change(msg)
+
+    def __cursor_msg(self, cursor):
+        # Re-created cursors get new serials, identical images share one entry.
+        key = cursor_key(cursor)
+        self.cursor_cache.set_serial(cursor.cursor_serial, key)
+        msg = self.cursor_cache.get(key)
+        if msg is None:
+            msg = self.cursor_cache.put(key, self.cursor_to_msg(
+                cursor, self.cursor_scale, self.cursor_size))
+        return msg
+
+    def __warm_cursor_cache(self):
+        """Converts the common cursors of the active Xcursor theme ahead of their first use
+        """
+        theme = os.environ.get("XCURSOR_THEME", "default")
+        try:
+            size = int(os.environ.get("XCURSOR_SIZE", XCURSOR_DEFAULT_SIZE))
+        except ValueError:
+            size = XCURSOR_DEFAULT_SIZE
+
+        # Leave room for cursors of applications that are not in the theme.
+        limit = self.cursor_cache.max_entries // 2
+        count = 0
+        for path in find_theme_cursors(theme, XCURSOR_WARM_UP_NAMES):
+            try:
+                images = load_xcursor(path, size)
+            except (OSError, ValueError, struct.error) as e:
+                logger.debug("failed to load cursor %s: %s" % (path, e))
                 continue
-            event = self.xdisplay.next_event()
-            if (event.type, 0) == self.xdisplay.extension_event.DisplayCursorNotify:
-                cache_key = event.cursor_serial
-                if cache_key in self.cursor_cache:
-                    if self.cursor_debug:
-                        logger.warning(
-                            "cursor changed to cached serial: {}".format(cache_key))
-                else:
+            for image in images:
+                if count >= limit:
+                    break
+                key = cursor_key(image)
+                if self.cursor_cache.get(key) is None:
                     try:
-                        # Request the cursor image.
-                        cursor = self.xdisplay.xfixes_get_cursor_image(
-                            screen.root)
-
-                        # Convert cursor image and cache.
-                        self.cursor_cache[cache_key] = self.cursor_to_msg(
-                            cursor, self.cursor_scale, self.cursor_size)
-
-                        if self.cursor_debug:
-                            logger.warning("New cursor: position={},{}, size={}x{}, length={}, xyhot={},{}, cursor_serial={}".format(
-                                cursor.x, cursor.y, cursor.width, cursor.height, len(cursor.cursor_image), cursor.xhot, cursor.yhot, cursor.cursor_serial))
+                        self.cursor_cache.put(key, self.cursor_to_msg(
+                            image, self.cursor_scale, self.cursor_size))
                     except Exception as e:
-                        logger.warning(
-                            "exception from fetching cursor image: %s" % e)
-
-                self.on_cursor_change(self.cursor_cache.get(cache_key))
-
-        logger.info("cursor monitor stopped")
+                        logger.debug("failed to convert cursor %s: %s" % (path, e))
+                        continue
+                    count += 1
+        logger.info("pre-rendered %d cursors of theme '%s' at size %d" % (count, theme, size))
 
     def stop_cursor_monitor(self):
         logger.info("stopping cursor monitor")
+        if self.cursors_running:
+            self.cursors_running = False
+            self.__stop_x11_events()
+            logger.info("cursor monitor stopped")
         self.cursors_running = False
 
     def cursor_to_msg(self, cursor, scale=1.0, cursor_size=-1):
@@ -515,15 +1005,19 @@ class WebRTCInput:
             xhot_scaled = int(cursor.xhot * scale)
             yhot_scaled = int(cursor.yhot * scale)
 
-        png_data_b64 = base64.b64encode(
-            self.cursor_to_png(cursor, target_width, target_height))
+        image = self.cursor_to_image(cursor)
+        png_data = self.cursor_to_png(cursor, target_width, target_height, image)
 
         override = None
-        if sum(cursor.cursor_image) == 0:
+        # Fully transparent, the application hides the cursor.
+        if image.getbbox() is None:
             override = "none"
 
+        # The app sends the PNG as a binary frame or base64 in JSON, depending on the client.
         return {
-            "curdata": png_data_b64.decode(),
+            "png": png_data,
+            "width": target_width,
+            "height": target_height,
             "handle": cursor.cursor_serial,
             "override": override,
             "hotspot": {
@@ -532,19 +1026,29 @@ class WebRTCInput:
             },
         }
 
-    def cursor_to_png(self, cursor, resize_width, resize_height):
-        with io.BytesIO() as f:
-            # Extract each component to RGBA bytes.
-            s = [((i >> b) & 0xFF)
-                 for i in cursor.cursor_image for b in [16, 8, 0, 24]]
+    def __image_module(self):
+        if self.pil_image is None:
+            from PIL import Image
+            self.pil_image = Image
+        return self.pil_image
+
+    def cursor_to_image(self, cursor):
+        """Converts an XFixes cursor image to a PIL RGBA image
+
+        The ARGB pixels are packed into one buffer of native 32-bit words and
+        swizzled by the raw decoder of PIL in a single pass.
+        """
+        pixels = array('I', cursor.cursor_image)
+        return self.__image_module().frombuffer(
+            'RGBA', (cursor.width, cursor.height), pixels.tobytes(), 'raw', CURSOR_RAW_MODE, 0, 1)
 
-            # Create raw image from pixel bytes
-            im = Image.frombytes(
-                'RGBA', (cursor.width, cursor.height), bytes(s), 'raw')
+    def cursor_to_png(self, cursor, resize_width, resize_height, image=None):
+        with io.BytesIO() as f:
+            im = image if image is not None else self.cursor_to_image(cursor)
 
             if cursor.width != resize_width or cursor.height != resize_height:
-                # Resize cursor to target size
-                im = im.resize((resize_width, resize_height))
+                # Resize cursor to target size, LANCZOS keeps edges of downscaled HiDPI cursors sharp
+                im = im.resize((resize_width, resize_height), self.__image_module().LANCZOS)
 
             # Save image as PNG
             im.save(f, "PNG")
@@ -558,6 +1062,53 @@ class WebRTCInput:
     def stop_js_server(self):
         self.__js_disconnect()
 
+    def on_binary_message(self, data):
+        """Handles binary input frames from the data channel
+
+        Frame format: <u8 version><u8 type><payload>, see INPUT_FRAME_*.
+
+        Arguments:
+            data {bytes} -- the raw data channel message
+        """
+
+        if len(data) < INPUT_FRAME_HEADER.size:
+            self.on_input_message_dropped("malformed")
+            logger.debug("dropping truncated binary input frame of %d bytes" % len(data))
+            return
+
+        version, frame_type = INPUT_FRAME_HEADER.unpack_from(data)
+        if version != INPUT_PROTOCOL_VERSION:
+            self.on_input_message_dropped("unknown")
+            logger.debug("dropping binary input frame with unsupported version: %d" % version)
+            return
+
+        entry = self.binary_handlers.get(frame_type)
+        if entry is None:
+            self.on_input_message_dropped("unknown")
+            logger.debug("dropping unknown binary input frame type: %d" % frame_type)
+            return
+
+        command, frame_struct, handler = entry
+        try:
+            fields = frame_struct.unpack_from(data, INPUT_FRAME_HEADER.size)
+        except struct.error as e:
+            self.on_input_message_dropped("malformed")
+            logger.debug("dropping malformed binary input frame %s: %s" % (command, e))
+            return
+
+        timestamp_offset = INPUT_FRAME_HEADER.size + frame_struct.size
+        if len(data) == timestamp_offset + INPUT_TIMESTAMP_STRUCT.size:
+            client_time_ms, = INPUT_TIMESTAMP_STRUCT.unpack_from(data, timestamp_offset)
+            sent = self.clock_offset.to_server_time(client_time_ms / 1000)
+            if sent is not None:
+                self.on_input_network_latency(command, max(0.0, (time.time() - sent) * 1000))
+
+        droppable = False
+        if frame_type == INPUT_FRAME_MOUSE:
+            flags, _, _, button_mask, scroll_magnitude = fields
+            droppable = self.__is_droppable_motion(bool(flags & INPUT_MOUSE_FLAG_RELATIVE), button_mask, scroll_magnitude)
+        self.input_worker.submit(command, handler, fields, droppable)
+
     def on_message(self, msg):
         """Handles incoming input messages
 
@@ -571,169 +1122,246 @@ class WebRTCInput:
           m: mouse event, data is csv of: x,y,button mask
           b: bitrate event, data is the desired encoder bitrate in bps.
           js: joystick connect/disconnect/button/axis event
+          _proto: binary input protocol version accepted by the client
+
+        See self.message_handlers for the full list. Mouse, key and joystick
+        button/axis events are sent as binary frames once the binary protocol
+        is negotiated, see on_binary_message().
+
+        Handlers run on the input worker, commands in SLOW_INPUT_COMMANDS on
+        its slow lane.
 
         Arguments:
             msg {string} -- the raw data channel message packed in the <command>,<data> format.
         """
 
         toks = msg.split(",")
-        if toks[0] == "pong":
-            if self.ping_start is None:
-                logger.warning('received pong before ping')
-                return
+        handler = self.message_handlers.get(toks[0])
+        if handler is None:
+            self.on_input_message_dropped("unknown")
+            logger.debug('unknown data channel message: %s' % msg[:64])
+            return
 
-            roundtrip = time.time() - self.ping_start
-            latency = (roundtrip / 2) * 1000
-            latency = float("%.3f" % latency)
-            self.on_ping_response(latency)
-        elif toks[0] == "kd":
-            # Key down
-            self.send_x11_keypress(int(toks[1]), down=True)
-        elif toks[0] == "ku":
-            # Key up
-            self.send_x11_keypress(int(toks[1]), down=False)
-        elif toks[0] == "kr":
-            # Keyboard reset
-            self.reset_keyboard()
-        elif toks[0] in ["m", "m2"]:
-            # Mouse action
-            # x,y,button_mask
-            relative = False
-            if toks[0] == "m2":
-                relative = True
-            try:
-                x, y, button_mask, scroll_magnitude = [int(i) for i in toks[1:]]
-            except:
-                x, y, button_mask, scroll_magnitude = 0, 0, self.button_mask, 0
-                relative = False
+        if toks[0] in INLINE_INPUT_COMMANDS:
             try:
-                self.send_x11_mouse(x, y, button_mask, scroll_magnitude, relative)
-            except Exception as e:
-                logger.warning('failed to set mouse cursor: {}'.format(e))
-        elif toks[0] == "p":
-            # toggle mouse pointer visibility
-            visible = bool(int(toks[1]))
-            logger.info("Setting pointer visibility to: %s" % str(visible))
-            self.on_mouse_pointer_visible(visible)
-        elif toks[0] == "vb":
-            # Set video bitrate
-            bitrate = int(toks[1])
-            logger.info("Setting video bitrate to: %d" % bitrate)
-            self.on_video_encoder_bit_rate(bitrate)
-        elif toks[0] == "ab":
-            # Set audio bitrate
-            bitrate = int(toks[1])
-            logger.info("Setting audio bitrate to: %d" % bitrate)
-            self.on_audio_encoder_bit_rate(bitrate)
-        elif toks[0] == "js":
-            # Joystick
-            # button: b,<btn_num>,<value>
-            # axis: a,<axis_num>,<value>
-            if toks[1] == 'c':
-                js_num = int(toks[2])
-                name = base64.b64decode(toks[3]).decode()[:255]
-                num_axes = int(toks[4])
-                num_btns = int(toks[5])
-                self.__js_connect(js_num, name, num_btns, num_axes)
-            elif toks[1] == 'd':
-                js_num = int(toks[2])
-                self.__js_disconnect(js_num)
-            elif toks[1] == 'b':
-                js_num = int(toks[2])
-                btn_num = int(toks[3])
-                btn_val = float(toks[4])
-                self.__js_emit_btn(js_num, btn_num, btn_val)
-            elif toks[1] == 'a':
-                js_num = int(toks[2])
-                axis_num = int(toks[3])
-                axis_val = float(toks[4])
-                self.__js_emit_axis(js_num, axis_num, axis_val)
-            else:
-                logger.warning('unhandled joystick command: %s' % toks[1])
-        elif toks[0] == "cr":
-            # Clipboard read
-            if self.enable_clipboard in ["true", "out"]:
-                data = self.read_clipboard()
-                if data:
-                    logger.info("read clipboard content, length: %d" %
-                                len(data))
-                    self.on_clipboard_read(data)
-                else:
-                    logger.warning("no clipboard content to send")
-            else:
-                logger.warning(
-                    "rejecting clipboard read because outbound clipboard is disabled.")
-        elif toks[0] == "cw":
-            # Clipboard write
-            if self.enable_clipboard in ["true", "in"]:
-                data = base64.b64decode(toks[1]).decode("utf-8")
-                self.write_clipboard(data)
-                logger.info("set clipboard content, length: %d" % len(data))
-            else:
-                logger.warning(
-                    "rejecting clipboard write because inbound clipboard is disabled.")
-        elif toks[0] == "r":
-            # resize event
-            res = toks[1]
-            if re.match(re.compile(r'^\d+x\d+$'), res):
-                # Make sure resolution is divisible by 2
-                w, h = [int(i) + int(i) % 2 for i in res.split("x")]
-                self.on_resize("%dx%d" % (w, h))
-            else:
-                logger.warning(
-                    "rejecting resolution change, invalid WxH resolution: %s" % res)
-        elif toks[0] == "s":
-            # scaling info
-            scale = toks[1]
-            if re.match(re.compile(r'^\d+(\.\d+)?$'), scale):
-                self.on_scaling_ratio(float(scale))
-            else:
-                logger.warning(
-                    "rejecting scaling change, invalid scale ratio: %s" % scale)
-        elif toks[0] == "_arg_fps":
-            # Set framerate
-            fps = int(toks[1])
-            logger.info("Setting framerate to: %d" % fps)
-            self.on_set_fps(fps)
-        elif toks[0] == "_arg_resize":
-            if len(toks) != 3:
-                logger.error("invalid _arg_resize command, expected 2 arguments <enabled>,<resolution>")
+                handler(toks)
+            except (IndexError, ValueError) as e:
+                self.on_input_message_dropped("malformed")
+                logger.debug('malformed data channel message %s: %s' % (toks[0], e))
+            return
+
+        if toks[0] in SLOW_INPUT_COMMANDS:
+            self.input_worker.submit_slow(toks[0], handler, (toks,))
+            return
+
+        droppable = False
+        if toks[0] in ("m", "m2") and len(toks) == 5 and toks[3].isdigit():
+            droppable = self.__is_droppable_motion(toks[0] == "m2", int(toks[3]), toks[4] != "0")
+        self.input_worker.submit(toks[0], handler, (toks,), droppable)
+
+    def __is_droppable_motion(self, relative, button_mask, scroll):
+        # Absolute motion without a button transition or scroll is superseded by the next motion.
+        # Every queued mouse event updates the mask, so transitions after relative motion are kept.
+        droppable = not relative and not scroll and button_mask == self.queued_button_mask
+        self.queued_button_mask = button_mask
+        return droppable
+
+    ############### Data channel message handlers ###############
+
+    def __on_pong(self, toks):
+        if self.ping_start is None:
+            logger.warning('received pong before ping')
+            return
+
+        now = time.time()
+        roundtrip = now - self.ping_start
+        latency = (roundtrip / 2) * 1000
+        latency = float("%.3f" % latency)
+        self.on_ping_response(latency)
+
+        # pong,<client time in seconds>
+        if len(toks) > 1:
+            self.clock_offset.add_sample(self.ping_start, now, float(toks[1]))
+
+    def __on_input_protocol(self, toks):
+        # Binary input protocol acknowledgement from client
+        try:
+            version = int(toks[1])
+        except (IndexError, ValueError):
+            version = 0
+        if version == INPUT_PROTOCOL_VERSION:
+            logger.info("client accepted binary input protocol version %d" % version)
+            self.client_input_protocol = version
+        else:
+            logger.warning("client requested unsupported input protocol %s, using CSV" % toks[1:])
+            self.client_input_protocol = 0
+        self.on_input_protocol(self.client_input_protocol)
+
+    def __on_key_down(self, toks):
+        self.send_x11_keypress(int(toks[1]), down=True)
+
+    def __on_key_up(self, toks):
+        self.send_x11_keypress(int(toks[1]), down=False)
+
+    def __on_key_reset(self, toks):
+        self.reset_keyboard()
+
+    def __on_mouse(self, toks):
+        # x,y,button_mask,scroll_magnitude
+        relative = toks[0] == "m2"
+        try:
+            x, y, button_mask, scroll_magnitude = [int(i) for i in toks[1:]]
+        except:
+            x, y, button_mask, scroll_magnitude = 0, 0, self.button_mask, 0
+            relative = False
+        self.__emit_mouse(x, y, button_mask, scroll_magnitude, relative)
+
+    def __emit_mouse(self, x, y, button_mask, scroll_magnitude, relative):
+        try:
+            self.send_x11_mouse(x, y, button_mask, scroll_magnitude, relative)
+        except Exception as e:
+            logger.warning('failed to set mouse cursor: {}'.format(e))
+
+    def __on_binary_mouse(self, flags, x, y, button_mask, scroll_magnitude):
+        self.__emit_mouse(x, y, button_mask, scroll_magnitude, bool(flags & INPUT_MOUSE_FLAG_RELATIVE))
+
+    def __on_binary_key(self, down, keysym):
+        self.send_x11_keypress(keysym, down=bool(down))
+
+    def __on_pointer_visible(self, toks):
+        # toggle mouse pointer visibility
+        visible = bool(int(toks[1]))
+        logger.info("Setting pointer visibility to: %s" % str(visible))
+        self.on_mouse_pointer_visible(visible)
+
+    def __on_video_bitrate(self, toks):
+        bitrate = int(toks[1])
+        logger.info("Setting video bitrate to: %d" % bitrate)
+        self.on_video_encoder_bit_rate(bitrate)
+
+    def __on_audio_bitrate(self, toks):
+        bitrate = int(toks[1])
+        logger.info("Setting audio bitrate to: %d" % bitrate)
+        self.on_audio_encoder_bit_rate(bitrate)
+
+    def __on_joystick(self, toks):
+        # button: b,<btn_num>,<value>
+        # axis: a,<axis_num>,<value>
+        if toks[1] == 'c':
+            js_num = int(toks[2])
+            name = base64.b64decode(toks[3]).decode()[:255]
+            num_axes = int(toks[4])
+            num_btns = int(toks[5])
+            self.__js_connect(js_num, name, num_btns, num_axes)
+        elif toks[1] == 'd':
+            js_num = int(toks[2])
+            self.__js_disconnect(js_num)
+        elif toks[1] == 'b':
+            js_num = int(toks[2])
+            btn_num = int(toks[3])
+            btn_val = float(toks[4])
+            self.__js_emit_btn(js_num, btn_num, btn_val)
+        elif toks[1] == 'a':
+            js_num = int(toks[2])
+            axis_num = int(toks[3])
+            axis_val = float(toks[4])
+            self.__js_emit_axis(js_num, axis_num, axis_val)
+        else:
+            logger.warning('unhandled joystick command: %s' % toks[1])
+
+    def __on_clipboard_read(self, toks):
+        if self.enable_clipboard in ["true", "out"]:
+            data = self.read_clipboard()
+            if data:
+                logger.info("read clipboard content, length: %d" %
+                            len(data))
+                # Explicit reads are always answered, even with unchanged contents.
+                self.on_clipboard_read(data, force=True)
             else:
-                # Set resizing enabled
-                enabled = toks[1].lower() == "true"
-                logger.info("Setting enable_resize to : %s" % str(enabled))
-
-                res = toks[2]
-                if re.match(re.compile(r'^\d+x\d+$'), res):
-                    # Make sure resolution is divisible by 2
-                    w, h = [int(i) + int(i) % 2 for i in res.split("x")]
-                    enable_res = "%dx%d" % (w, h)
-                else:
-                    logger.warning(
-                        "rejecting enable resize with resolution change to invalid resolution: %s" % res)
-                    enable_res = None
+                logger.warning("no clipboard content to send")
+        else:
+            logger.warning(
+                "rejecting clipboard read because outbound clipboard is disabled.")
 
-                self.on_set_enable_resize(enabled, enable_res)
-        elif toks[0] == "_f":
-            # Reported FPS from client.
-            try:
-                fps = int(toks[1])
-                self.on_client_fps(fps)
-            except:
-                logger.error("failed to parse fps from client: " + str(toks))
-        elif toks[0] == "_l":
-            # Reported latency from client.
-            try:
-                latency_ms = int(toks[1])
-                self.on_client_latency(latency_ms)
-            except:
-                logger.error(
-                    "failed to parse latency report from client" + str(toks))
-        elif toks[0] == "_stats_video" or toks[0] == "_stats_audio":
-            # WebRTC Statistics API data from client
-            try:
-                self.on_client_webrtc_stats(toks[0], ",".join(toks[1:]))
-            except:
-                logger.error("failed to parse WebRTC Statistics JSON object")
+    def __on_clipboard_write(self, toks):
+        self.__set_clipboard(base64.b64decode(toks[1]).decode("utf-8"))
+
+    def receive_clipboard(self, data):
+        """Writes clipboard contents received on the clipboard data channel
+
+        Arguments:
+            data {string} -- clipboard contents
+        """
+        self.input_worker.submit("cw", self.__set_clipboard, (data,))
+
+    def __set_clipboard(self, data):
+        if self.enable_clipboard in ["true", "in"]:
+            self.write_clipboard(data)
+            logger.info("set clipboard content, length: %d" % len(data))
+        else:
+            logger.warning(
+                "rejecting clipboard write because inbound clipboard is disabled.")
+
+    def __on_resize(self, toks):
+        res = toks[1]
+        if RESOLUTION_RE.match(res):
+            # Make sure resolution is divisible by 2
+            w, h = [int(i) + int(i) % 2 for i in res.split("x")]
+            self.on_resize("%dx%d" % (w, h))
+        else:
+            logger.warning(
+                "rejecting resolution change, invalid WxH resolution: %s" % res)
+
+    def __on_scaling(self, toks):
+        scale = toks[1]
+        if SCALE_RE.match(scale):
+            self.on_scaling_ratio(float(scale))
         else:
-            logger.info('unknown data channel message: %s' % msg)
+            logger.warning(
+                "rejecting scaling change, invalid scale ratio: %s" % scale)
+
+    def __on_set_fps(self, toks):
+        fps = int(toks[1])
+        logger.info("Setting framerate to: %d" % fps)
+        self.on_set_fps(fps)
+
+    def __on_set_enable_resize(self, toks):
+        if len(toks) != 3:
+            logger.error("invalid _arg_resize command, expected 2 arguments <enabled>,<resolution>")
+            return
+
+        enabled = toks[1].lower() == "true"
+        logger.info("Setting enable_resize to : %s" % str(enabled))
+
+        res = toks[2]
+        if RESOLUTION_RE.match(res):
+            # Make sure resolution is divisible by 2
+            w, h = [int(i) + int(i) % 2 for i in res.split("x")]
+            enable_res = "%dx%d" % (w, h)
+        else:
+            logger.warning(
+                "rejecting enable resize with resolution change to invalid resolution: %s" % res)
+            enable_res = None
+
+        self.on_set_enable_resize(enabled, enable_res)
+
+    def __on_client_fps(self, toks):
+        try:
+            fps = int(toks[1])
+            self.on_client_fps(fps)
+        except:
+            logger.error("failed to parse fps from client: " + str(toks))
+
+    def __on_client_latency(self, toks):
+        try:
+            latency_ms = int(toks[1])
+            self.on_client_latency(latency_ms)
+        except:
+            logger.error(
+                "failed to parse latency report from client" + str(toks))
+
+    def __on_client_webrtc_stats(self, toks):
+        try:
+            self.on_client_webrtc_stats(toks[0], ",".join(toks[1:]))
+        except:
+            logger.error("failed to parse WebRTC Statistics JSON object")
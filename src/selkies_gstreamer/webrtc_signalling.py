@@ -23,6 +23,7 @@ import asyncio
 import base64
 import json
 import logging
+import random
 import re
 import ssl
 import websockets
@@ -52,6 +53,70 @@ class WebRTCSignallingErrorNoPeer(Exception):
     pass
 
 
+class ReconnectBackoff:
+    def __init__(self, initial_delay=0.05, max_delay=2.0, factor=2.0, jitter=0.2):
+        """Exponential backoff between reconnect attempts
+
+        Waiting never blocks the event loop and can be cut short with wake(),
+        for example when the server reports that the awaited peer has joined.
+
+        Arguments:
+            initial_delay {float} -- delay before the first retry in seconds
+            max_delay {float} -- cap of the delay in seconds
+            factor {float} -- multiplier applied to the delay after each attempt
+            jitter {float} -- random +/- fraction applied to each delay
+        """
+
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+        self.wakeup = None
+
+    def reset(self):
+        """Starts over from the initial delay after a successful attempt
+        """
+        self.attempts = 0
+        self.wakeup = None
+
+    def next_delay(self):
+        delay = self.initial_delay * (self.factor ** min(self.attempts, 32))
+        self.attempts += 1
+        delay *= random.uniform(1.0 - self.jitter, 1.0 + self.jitter)
+        return min(self.max_delay, delay)
+
+    def arm(self):
+        """Makes wake() end the next wait, for a wait that is scheduled but not started yet
+        """
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+
+    async def wait(self):
+        """Waits for the next backoff delay
+
+        Returns:
+            [bool] -- True when woken up before the delay expired
+        """
+        # A wake() from before the wait was armed is stale, start from a clear event.
+        wakeup = self.wakeup or asyncio.Event()
+        self.wakeup = wakeup
+        try:
+            await asyncio.wait_for(wakeup.wait(), self.next_delay())
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            if self.wakeup is wakeup:
+                self.wakeup = None
+
+    def wake(self):
+        """Ends the current or armed wait immediately, does nothing otherwise
+        """
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+
 class WebRTCSignalling:
     def __init__(self, server, id, peer_id, enable_https=False, enable_basic_auth=False, basic_auth_user=None, basic_auth_password=None):
         """Initialize the signalling instance
@@ -71,6 +136,10 @@ class WebRTCSignalling:
         self.basic_auth_password = basic_auth_password
         self.conn = None
 
+        # Backoff for server connection and call setup retries.
+        self.backoff = ReconnectBackoff()
+        self.retry_task = None
+
         self.on_ice = lambda mlineindex, candidate: logger.warn(
             'unhandled ice event')
         self.on_sdp = lambda sdp_type, sdp: logger.warn('unhandled sdp event')
@@ -89,6 +158,26 @@ class WebRTCSignalling:
         logger.debug("setting up call")
         await self.conn.send('SESSION %d' % self.peer_id)
 
+    def retry_setup_call(self):
+        """Retries setup_call in the background after the backoff delay
+
+        The retry happens right away when the server reports that the peer
+        has joined. Does nothing if a retry is already pending.
+        """
+        if self.retry_task is not None and not self.retry_task.done():
+            return
+        # The task starts later, a PEER_JOINED read before then must still end its wait.
+        self.backoff.arm()
+        self.retry_task = asyncio.ensure_future(self.__retry_setup_call())
+
+    async def __retry_setup_call(self):
+        if await self.backoff.wait():
+            logger.info("peer %s joined, setting up call" % self.peer_id)
+        try:
+            await self.setup_call()
+        except websockets.ConnectionClosed:
+            logger.info("connection closed before retrying call setup")
+
     async def connect(self):
         """Connects to and registers id with signalling server
 
@@ -112,7 +201,8 @@ class WebRTCSignalling:
                     break
                 except ConnectionRefusedError:
                     logger.info("Connecting to signal server...")
-                    await asyncio.sleep(2)
+                    await self.backoff.wait()
+            self.backoff.reset()
 
             await self.conn.send('HELLO %d' % self.id)
         except websockets.ConnectionClosed:
@@ -146,6 +236,8 @@ class WebRTCSignalling:
 
     async def stop(self):
         logger.warning("stopping")
+        if self.retry_task is not None:
+            self.retry_task.cancel()
         await self.conn.close()
 
     async def start(self):
@@ -153,6 +245,7 @@ class WebRTCSignalling:
 
         Message types:
           HELLO: response from server indicating peer is registered.
+          PEER_JOINED <peer_id>: a peer that setup_call() did not find has registered.
           ERROR*: error messages from server.
           {"sdp": ...}: JSON SDP message
           {"ice": ...}: JSON ICE message
@@ -161,7 +254,8 @@ class WebRTCSignalling:
 
         on_connect: fired when HELLO is received.
         on_session: fired after setup_call() succeeds and SESSION_OK is received.
-        on_error(WebRTCSignallingErrorNoPeer): fired when setup_call() fails and peer not found message is received.
+        on_error(WebRTCSignallingErrorNoPeer): fired when setup_call() fails and peer not found message is received,
+            usually handled with retry_setup_call().
         on_error(WebRTCSignallingError): fired when message parsing fails or unexpected message is received.
 
         """
@@ -175,7 +269,13 @@ class WebRTCSignalling:
                 if len(toks) > 1:
                     meta = json.loads(base64.b64decode(toks[1]))
                 logger.info("started session with peer: %s, meta: %s", self.peer_id, json.dumps(meta))
+                self.backoff.reset()
                 self.on_session(self.peer_id, (meta))
+            elif message.startswith('PEER_JOINED'):
+                toks = message.split()
+                if len(toks) > 1 and toks[1] == str(self.peer_id):
+                    # Cut the backoff of a pending retry_setup_call() short.
+                    self.backoff.wake()
             elif message.startswith('ERROR'):
                 if message == "ERROR peer '%s' not found" % self.peer_id:
                     await self.on_error(WebRTCSignallingErrorNoPeer("'%s' not found" % self.peer_id))
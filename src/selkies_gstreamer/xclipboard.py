@@ -0,0 +1,323 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import collections
+import concurrent.futures
+import threading
+
+from Xlib import X, Xatom
+from Xlib.ext import xfixes
+from Xlib.protocol import event as xevent
+
+import logging
+logger = logging.getLogger("xclipboard")
+logger.setLevel(logging.INFO)
+
+# Larger clipboard contents from other applications are ignored.
+CLIPBOARD_MAX_BYTES = 16 * 1024 * 1024
+# Upper bound of one property write, larger contents are served with INCR.
+INCR_CHUNK_BYTES = 256 * 1024
+
+# Property on our window that receives converted selections.
+CLIPBOARD_PROPERTY = 'SELKIES_CLIPBOARD'
+# Property appended to with zero length data, the notify event carries the server time.
+TIMESTAMP_PROPERTY = 'SELKIES_TIMESTAMP'
+
+
+class XClipboardError(Exception):
+    pass
+
+
+class XClipboard:
+    def __init__(self, xdisplay):
+        """Reads and owns the CLIPBOARD selection in-process
+
+        Changes of the selection owner are reported by XFixes, the contents
+        are only converted when the owner changes. Written contents are served
+        to other clients by owning the selection, large transfers in both
+        directions use the INCR protocol.
+
+        Ownership and conversions use server timestamps as required by the
+        ICCCM, taken from the triggering event or from a zero length property
+        change. Properties are read on a worker thread, never in handle_event().
+
+        Events of the connection must be passed to handle_event().
+
+        Arguments:
+            xdisplay {Xlib.display.Display} -- X connection to use
+        """
+
+        if not xdisplay.has_extension('XFIXES'):
+            if xdisplay.query_extension('XFIXES') is None:
+                raise XClipboardError("XFIXES extension not supported, cannot watch clipboard changes")
+
+        self.xdisplay = xdisplay
+        self.lock = threading.RLock()
+        self.window = None
+        self.atoms = {}
+        self.chunk_size = INCR_CHUNK_BYTES
+
+        # Last known clipboard contents.
+        self.text = None
+        # Contents served while we own the selection, and the server time we took ownership.
+        self.owned = None
+        self.owned_time = X.CurrentTime
+        # Contents waiting for a server timestamp to take ownership, and the
+        # events of set_text() callers waiting for it.
+        self.pending = None
+        self.pending_waiters = []
+        # Called with the server time of each zero length change of TIMESTAMP_PROPERTY.
+        self.timestamp_actions = collections.deque()
+        # Reads properties in order, off the thread handling events.
+        self.reader = None
+        # INCR transfer being read from another client.
+        self.incoming = None
+        # INCR transfers being served: (requestor id, property) -> [requestor, type, data, offset]
+        self.outgoing = {}
+
+        self.on_change = lambda text: logger.warning("unhandled on_change")
+        # Called after a property read on the worker thread, which may have queued events
+        # without waking readers of the connection.
+        self.on_events_read = lambda: None
+
+    def start(self):
+        screen = self.xdisplay.screen()
+        self.window = screen.root.create_window(
+            -10, -10, 1, 1, 0, X.CopyFromParent, event_mask=X.PropertyChangeMask)
+        for name in ('CLIPBOARD', 'UTF8_STRING', 'TEXT', 'TARGETS', 'INCR', CLIPBOARD_PROPERTY, TIMESTAMP_PROPERTY):
+            self.atoms[name] = self.xdisplay.intern_atom(name)
+
+        # Leave room for the request header in each property write.
+        max_request_bytes = self.xdisplay.display.info.max_request_length * 4
+        self.chunk_size = min(INCR_CHUNK_BYTES, max_request_bytes - 1024)
+
+        self.reader = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="xclipboard")
+        self.xdisplay.xfixes_select_selection_input(
+            self.window, self.atoms['CLIPBOARD'], xfixes.XFixesSetSelectionOwnerNotifyMask)
+        # Read the contents owned before we started watching.
+        with self.lock:
+            self.__with_timestamp(self.__convert)
+        logger.info("watching for clipboard changes")
+
+    def stop(self):
+        with self.lock:
+            if self.window is not None:
+                self.window.destroy()
+                self.xdisplay.flush()
+                self.window = None
+            self.owned = None
+            self.pending = None
+            self.__release_waiters()
+            self.timestamp_actions.clear()
+            self.incoming = None
+            self.outgoing = {}
+            if self.reader is not None:
+                self.reader.shutdown(wait=False)
+                self.reader = None
+
+    def set_text(self, text):
+        """Takes ownership of the clipboard with the given contents
+
+        Ownership is taken when the server timestamp arrives, events of the
+        connection must keep being handled for that.
+
+        Arguments:
+            text {string} -- new clipboard contents
+
+        Returns:
+            threading.Event -- set once we own the selection with these contents
+        """
+        owned = threading.Event()
+        with self.lock:
+            if self.window is None:
+                owned.set()
+                return owned
+            self.pending = text
+            self.pending_waiters.append(owned)
+            self.text = text
+            self.__with_timestamp(self.__take_ownership)
+        return owned
+
+    def handle_event(self, event):
+        """Handles a selection related event
+
+        Arguments:
+            event {Xlib.protocol.rq.Event} -- event from the X connection
+
+        Returns:
+            bool -- True if the event was consumed
+        """
+        if self.window is None:
+            return False
+
+        with self.lock:
+            if event.type == X.SelectionNotify:
+                if event.requestor.id == self.window.id:
+                    self.__on_selection_notify(event)
+            elif event.type == X.SelectionRequest:
+                self.__on_selection_request(event)
+            elif event.type == X.SelectionClear:
+                if event.atom == self.atoms['CLIPBOARD'] and event.time >= self.owned_time:
+                    self.owned = None
+            elif event.type == X.PropertyNotify:
+                self.__on_property_notify(event)
+            elif (event.type, getattr(event, 'sub_code', None)) == self.xdisplay.extension_event.SetSelectionOwnerNotify:
+                owner = getattr(event.owner, 'id', event.owner)
+                if owner not in (X.NONE, self.window.id):
+                    self.__convert(event.timestamp)
+            else:
+                return False
+        return True
+
+    def __with_timestamp(self, action):
+        # Appending nothing leaves the property unchanged, the PropertyNotify
+        # event reports the server time the action is called with.
+        self.timestamp_actions.append(action)
+        self.window.change_property(
+            self.atoms[TIMESTAMP_PROPERTY], self.atoms[TIMESTAMP_PROPERTY], 8, b'', X.PropModeAppend)
+        self.xdisplay.flush()
+
+    def __take_ownership(self, timestamp):
+        if self.pending is None:
+            return
+        self.owned = self.pending.encode('utf-8')
+        self.owned_time = timestamp
+        self.pending = None
+        self.window.set_selection_owner(self.atoms['CLIPBOARD'], timestamp)
+        self.xdisplay.flush()
+        self.__release_waiters()
+
+    def __release_waiters(self):
+        for owned in self.pending_waiters:
+            owned.set()
+        self.pending_waiters = []
+
+    def __convert(self, timestamp):
+        self.window.convert_selection(
+            self.atoms['CLIPBOARD'], self.atoms['UTF8_STRING'], self.atoms[CLIPBOARD_PROPERTY], timestamp)
+        self.xdisplay.flush()
+
+    def __read_property(self, func):
+        # Round trips block, the property is read on the reader thread.
+        if self.reader is not None:
+            self.reader.submit(self.__run_reader, func)
+
+    def __run_reader(self, func):
+        try:
+            window = self.window
+            if window is None:
+                return
+            prop = window.get_full_property(self.atoms[CLIPBOARD_PROPERTY], X.AnyPropertyType)
+            with self.lock:
+                if self.window is not window:
+                    return
+                func(prop)
+                # Deleted after func, the owner of an INCR transfer writes the next
+                # chunk once it is gone and the transfer must be known by then.
+                window.delete_property(self.atoms[CLIPBOARD_PROPERTY])
+                self.xdisplay.flush()
+        except Exception as e:
+            logger.warning("failed to read clipboard property: %s" % e)
+        finally:
+            self.on_events_read()
+
+    def __on_selection_notify(self, event):
+        if event.property == X.NONE:
+            logger.debug("clipboard owner refused the conversion")
+            return
+        self.__read_property(self.__on_converted)
+
+    def __on_converted(self, prop):
+        if prop is None:
+            return
+        if prop.property_type == self.atoms['INCR']:
+            # Deleting the property asks the owner for the first chunk.
+            self.incoming = bytearray()
+            return
+        self.__set_contents(prop.value)
+
+    def __on_chunk(self, prop):
+        if self.incoming is None or prop is None:
+            return
+        if not prop.value:
+            # A zero length chunk ends the transfer.
+            data, self.incoming = self.incoming, None
+            self.__set_contents(bytes(data))
+        elif len(self.incoming) + len(prop.value) > CLIPBOARD_MAX_BYTES:
+            logger.warning("ignoring clipboard contents larger than %d bytes" % CLIPBOARD_MAX_BYTES)
+            self.incoming = None
+        else:
+            self.incoming.extend(prop.value)
+
+    def __on_property_notify(self, event):
+        if event.window.id == self.window.id:
+            if event.atom == self.atoms[TIMESTAMP_PROPERTY]:
+                if self.timestamp_actions:
+                    self.timestamp_actions.popleft()(event.time)
+            elif event.atom == self.atoms[CLIPBOARD_PROPERTY] and event.state == X.PropertyNewValue:
+                # Other values are read when the SelectionNotify event arrives.
+                if self.incoming is not None:
+                    self.__read_property(self.__on_chunk)
+            return
+
+        transfer = self.outgoing.get((event.window.id, event.atom))
+        if transfer is None or event.state != X.PropertyDelete:
+            return
+        requestor, prop_type, data, offset = transfer
+        chunk = data[offset:offset + self.chunk_size]
+        requestor.change_property(event.atom, prop_type, 8, chunk)
+        if chunk:
+            transfer[3] = offset + len(chunk)
+        else:
+            # The zero length chunk was written, the transfer is complete.
+            del self.outgoing[(event.window.id, event.atom)]
+            requestor.change_attributes(event_mask=X.NoEventMask)
+        self.xdisplay.flush()
+
+    def __on_selection_request(self, event):
+        requestor = event.requestor
+        # Obsolete clients pass None as property, the target is used instead.
+        prop = event.property if event.property != X.NONE else event.target
+        text_targets = (self.atoms['UTF8_STRING'], self.atoms['TEXT'], Xatom.STRING)
+
+        if self.owned is None or event.selection != self.atoms['CLIPBOARD']:
+            prop = X.NONE
+        elif event.time != X.CurrentTime and event.time < self.owned_time:
+            # Requests from before we owned the selection are refused.
+            prop = X.NONE
+        elif event.target == self.atoms['TARGETS']:
+            requestor.change_property(prop, Xatom.ATOM, 32, [self.atoms['TARGETS']] + list(text_targets))
+        elif event.target in text_targets:
+            if event.target == Xatom.STRING:
+                prop_type, data = Xatom.STRING, self.text.encode('latin-1', 'replace')
+            else:
+                prop_type, data = self.atoms['UTF8_STRING'], self.owned
+            if len(data) > self.chunk_size:
+                # Announce the size, chunks are written each time the requestor deletes the property.
+                requestor.change_attributes(event_mask=X.PropertyChangeMask)
+                requestor.change_property(prop, self.atoms['INCR'], 32, [len(data)])
+                self.outgoing[(requestor.id, prop)] = [requestor, prop_type, data, 0]
+            else:
+                requestor.change_property(prop, prop_type, 8, data)
+        else:
+            prop = X.NONE
+
+        notify = xevent.SelectionNotify(
+            time=event.time,
+            requestor=requestor,
+            selection=event.selection,
+            target=event.target,
+            property=prop)
+        requestor.send_event(notify)
+        self.xdisplay.flush()
+
+    def __set_contents(self, data):
+        if isinstance(data, str):
+            text = data
+        else:
+            text = bytes(data).decode('utf-8', 'replace')
+        if text != self.text:
+            self.text = text
+            self.on_change(text)
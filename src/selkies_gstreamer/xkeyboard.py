@@ -0,0 +1,170 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import threading
+from collections import OrderedDict
+
+from Xlib import X, XK
+from Xlib.ext import xtest
+
+import logging
+logger = logging.getLogger("xkeyboard")
+logger.setLevel(logging.INFO)
+
+# Number of unused keycodes that can be borrowed for keysyms missing from the keyboard mapping.
+SPARE_KEYCODES = 8
+
+SHIFT_KEYSYMS = (XK.XK_Shift_L, XK.XK_Shift_R)
+
+
+class XTestKeyboardError(Exception):
+    pass
+
+
+class XTestKeyboard:
+    def __init__(self, xdisplay, spare_keycodes=SPARE_KEYCODES):
+        """Injects key events with XTest on an existing X connection
+
+        Keysyms are resolved from a table built from the keyboard mapping, so
+        key events need no round trip to the X server. Call refresh() when a
+        MappingNotify event for the keyboard is received.
+
+        Arguments:
+            xdisplay {Xlib.display.Display} -- X connection used for injection
+
+        Keyword Arguments:
+            spare_keycodes {integer} -- unused keycodes reserved for unmapped keysyms (default: {SPARE_KEYCODES})
+        """
+
+        if not xdisplay.has_extension('XTEST'):
+            if xdisplay.query_extension('XTEST') is None:
+                raise XTestKeyboardError("XTEST extension not supported, cannot inject key events")
+
+        self.xdisplay = xdisplay
+        self.spare_keycodes = spare_keycodes
+        self.lock = threading.RLock()
+
+        # keysym -> (keycode, shift level), only levels 0 and 1 are used.
+        self.keysyms = {}
+        # Unused keycodes available for borrowing.
+        self.spare = []
+        # Borrowed keysym -> keycode, least recently used first.
+        self.borrowed = OrderedDict()
+        # Keysyms held down -> keycode they were pressed with.
+        self.down = {}
+        self.shift_keycodes = set()
+
+        self.refresh()
+
+    def refresh(self):
+        """Rebuilds the keysym table from the keyboard mapping of the X server
+        """
+        min_keycode = self.xdisplay.display.info.min_keycode
+        max_keycode = self.xdisplay.display.info.max_keycode
+        mapping = self.xdisplay.get_keyboard_mapping(min_keycode, max_keycode - min_keycode + 1)
+        self.__discard_events()
+
+        keysyms = {}
+        unused = []
+        for offset, syms in enumerate(mapping):
+            keycode = min_keycode + offset
+            if not any(syms):
+                unused.append(keycode)
+                continue
+            # Prefer the lowest shift level, then the lowest keycode.
+            for level, keysym in enumerate(syms[:2]):
+                if keysym == X.NoSymbol:
+                    continue
+                entry = keysyms.get(keysym)
+                if entry is None or level < entry[1]:
+                    keysyms[keysym] = (keycode, level)
+
+        with self.lock:
+            self.keysyms = keysyms
+            # Keep borrowed keycodes that still carry their keysym.
+            self.borrowed = OrderedDict(
+                (keysym, keycode) for keysym, keycode in self.borrowed.items()
+                if keysyms.get(keysym, (None, 0))[0] == keycode)
+            in_use = set(self.borrowed.values())
+            free = [keycode for keycode in reversed(unused) if keycode not in in_use]
+            self.spare = free[:max(0, self.spare_keycodes - len(self.borrowed))]
+            self.shift_keycodes = set(keysyms[k][0] for k in SHIFT_KEYSYMS if k in keysyms)
+
+        logger.info("loaded keyboard mapping with %d keysyms, %d spare keycodes" % (len(keysyms), len(self.spare)))
+
+    def keycode(self, keysym):
+        """Returns the keycode of a keysym, None if it is not mapped
+        """
+        entry = self.keysyms.get(keysym)
+        return entry[0] if entry else None
+
+    def send(self, keysym, down=True):
+        """Sends a key press or release
+
+        Arguments:
+            keysym {integer} -- the key symbol to send
+
+        Keyword Arguments:
+            down {bool} -- toggle key down or up (default: {True})
+        """
+        with self.lock:
+            if not down:
+                keycode = self.down.pop(keysym, None)
+                if keycode is None:
+                    keycode = self.keycode(keysym)
+                    if keycode is None:
+                        # Never pressed and not mapped, nothing to release.
+                        return
+                xtest.fake_input(self.xdisplay, X.KeyRelease, keycode)
+                self.xdisplay.flush()
+                return
+
+            entry = self.keysyms.get(keysym)
+            if entry is None:
+                entry = self.__borrow(keysym)
+            elif keysym in self.borrowed:
+                self.borrowed.move_to_end(keysym)
+            keycode, level = entry
+
+            # Shifted keysyms need Shift held while the key goes down.
+            shift_keycode = None
+            if level == 1 and self.shift_keycodes and not self.shift_keycodes.intersection(self.down.values()):
+                shift_keycode = min(self.shift_keycodes)
+                xtest.fake_input(self.xdisplay, X.KeyPress, shift_keycode)
+            xtest.fake_input(self.xdisplay, X.KeyPress, keycode)
+            if shift_keycode is not None:
+                xtest.fake_input(self.xdisplay, X.KeyRelease, shift_keycode)
+            self.down[keysym] = keycode
+            self.xdisplay.flush()
+
+    def __borrow(self, keysym):
+        if self.spare:
+            keycode = self.spare.pop()
+        else:
+            # Reuse the least recently used borrowed keycode that is not held down.
+            held = set(self.down.values())
+            for old_keysym, keycode in self.borrowed.items():
+                if keycode not in held:
+                    break
+            else:
+                raise XTestKeyboardError("no spare keycode left to map keysym %d" % keysym)
+            del self.borrowed[old_keysym]
+            self.keysyms.pop(old_keysym, None)
+
+        logger.debug("mapping keysym %d to spare keycode %d" % (keysym, keycode))
+        self.xdisplay.change_keyboard_mapping(keycode, [(keysym, keysym)])
+        # Clients must see the new mapping before the key event.
+        self.xdisplay.sync()
+        self.__discard_events()
+
+        self.borrowed[keysym] = keycode
+        self.keysyms[keysym] = (keycode, 0)
+        return self.keysyms[keysym]
+
+    def __discard_events(self):
+        # The injection connection selects no events, but every client receives
+        # MappingNotify, also for our own borrowed keycodes. Round trips read
+        # them into the queue, nothing else would ever remove them.
+        while self.xdisplay.pending_events() > 0:
+            self.xdisplay.next_event()